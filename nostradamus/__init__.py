@@ -4,8 +4,19 @@ This is NOT an ODM.
 
 from abc import ABC, abstractmethod, ABCMeta
 import collections
+import collections.abc
 import uuid
 import functools
+import hashlib
+import itertools
+import json
+import time
+import weakref
+
+from .identity import IdentityMap, LRUIdentityMap, WeakIdentityMap
+from .fields import Field, Value, Embedded, Reference
+from . import fields as _fields
+from .drivers.base import reference_targets
 
 __author__ = [  "Juan Carrano <jc@eiwa.ag>",
                 "Federico M. Pomar <fp@eiwa.ag>"
@@ -15,12 +26,38 @@ __license__ = """Unauthorized copying of this file, via any medium is
                  strictly prohibited. Proprietary and confidential"""
 
 class WithListMeta(ABCMeta):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """Besides adding the List attribute, generate from_dict, as_dict,
+    __init__ and __slots__ for classes that declare fields (see
+    nostradamus.fields)."""
+    def __new__(mcls, name, bases, namespace, slots=True, **kwargs):
+        fields = _fields.collect_fields(bases, namespace)
+        if fields is not None:
+            namespace['_FIELDS'] = fields
+            if 'from_dict' not in namespace:
+                namespace['from_dict'] = _fields.make_from_dict(fields, name)
+            if 'as_dict' not in namespace:
+                namespace['as_dict'] = _fields.make_as_dict(fields, name)
+            if slots and '__slots__' not in namespace:
+                namespace['__slots__'] = _fields.slot_names(bases, fields)
+
+        cls = super().__new__(mcls, name, bases, namespace, **kwargs)
+
+        if fields is not None and '__init__' not in namespace:
+            cls.__init__ = _fields.make_init(fields, cls)
+        return cls
+
+    def __init__(self, name, bases, namespace, slots=True, **kwargs):
+        super().__init__(name, bases, namespace, **kwargs)
         class _ElementList(self._ElementListBase):
             ELEMENT_CLASS = self
         self.List = _ElementList
 
+        compact_base = getattr(self, '_CompactListBase', None)
+        if compact_base is not None:
+            class _CompactList(compact_base):
+                ELEMENT_CLASS = self
+            self.CompactList = _CompactList
+
 class RefList(collections.UserList):
     LIST_KEY = 'contents'
 
@@ -43,6 +80,145 @@ class RefList(collections.UserList):
 
         return {self.LIST_KEY: contents_d}
 
+class CompactRefList(collections.abc.MutableSequence):
+    """List of references that keeps only the names of the elements.
+
+    Serializes exactly like RefList, but from_dict does not read the
+    elements: they are read when first accessed (by index or while
+    iterating), BATCH_SIZE of them at a time when the read_func supports it
+    (the ones given by Database do). Elements that were never accessed are
+    written back from their names, without reading them. Memory and reading
+    time thus depend on the number of elements used, not on the length of
+    the list.
+
+    Elements can only be read while the Database that read the list is
+    usable; this does not work with AsyncDatabase.
+    """
+    LIST_KEY = 'contents'
+    BATCH_SIZE = 1000
+
+    @property
+    @abstractmethod
+    def ELEMENT_CLASS(self):
+        pass
+
+    def __init__(self, contents=()):
+        self._names = []
+        self._objects = {}
+        self._read_many = None
+        for obj in contents:
+            self.append(obj)
+
+    @classmethod
+    def from_dict(cls, d, read_func = None, **kwargs):
+        self = cls(**kwargs)
+        self._names = [element_d['target_name'] for element_d in d[cls.LIST_KEY]]
+        # Keep only the batch reader, read_func may hold on to every document
+        # read together with this list.
+        self._read_many = getattr(read_func, 'many', None)
+        if self._read_many is None and read_func is not None:
+            self._read_many = lambda cls_names: [read_func(c) for c in cls_names]
+        return self
+
+    def as_dict(self, write_func):
+        contents_d = []
+        for i, name in enumerate(self._names):
+            obj = self._objects.get(i)
+            if obj is None:
+                contents_d.append({'_IS_REFERENCE': True, 'target_name': name})
+            else:
+                contents_d.append(obj.as_ref(write_func))
+
+        return {self.LIST_KEY: contents_d}
+
+    @property
+    def names(self):
+        """The names of the elements (do not modify)."""
+        return self._names
+
+    def is_loaded(self, i):
+        return (i % len(self._names) if i < 0 else i) in self._objects
+
+    def _load(self, start, stop):
+        """Read the elements in range(start, stop) that are not loaded yet."""
+        missing = [i for i in range(start, stop) if i not in self._objects]
+        if not missing:
+            return
+        if self._read_many is None:
+            raise KeyError("{} element {} was not read".format(
+                                type(self).__name__, self._names[missing[0]]))
+        cls = self.ELEMENT_CLASS
+        objs = self._read_many([(cls, self._names[i]) for i in missing])
+        self._objects.update(zip(missing, objs))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            positions = range(*i.indices(len(self._names)))
+            if positions:
+                self._load(min(positions), max(positions) + 1)
+            return [self._objects[j] for j in positions]
+
+        if i < 0:
+            i += len(self._names)
+        if not 0 <= i < len(self._names):
+            raise IndexError("list index out of range")
+        obj = self._objects.get(i)
+        if obj is None:
+            self._load(i, i + 1)
+            obj = self._objects[i]
+        return obj
+
+    def __iter__(self):
+        for start in range(0, len(self._names), self.BATCH_SIZE):
+            stop = min(start + self.BATCH_SIZE, len(self._names))
+            self._load(start, stop)
+            for i in range(start, stop):
+                yield self._objects[i]
+
+    def __setitem__(self, i, obj):
+        if isinstance(i, slice):
+            raise TypeError("{} does not support slice assignment".format(
+                                type(self).__name__))
+        if i < 0:
+            i += len(self._names)
+        self._names[i] = obj.name
+        self._objects[i] = obj
+
+    def _shift(self, start, offset):
+        """Move the loaded objects at positions >= start by offset."""
+        moved = {i + offset if i >= start else i: obj
+                    for i, obj in self._objects.items()}
+        self._objects = moved
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            for j in sorted(range(*i.indices(len(self._names))), reverse=True):
+                del self[j]
+            return
+        if i < 0:
+            i += len(self._names)
+        del self._names[i]
+        self._objects.pop(i, None)
+        self._shift(i + 1, -1)
+
+    def insert(self, i, obj):
+        n = len(self._names)
+        i = max(0, min(n, i + n if i < 0 else i))
+        self._names.insert(i, obj.name)
+        self._shift(i, 1)
+        self._objects[i] = obj
+
+    def append(self, obj):
+        self._objects[len(self._names)] = obj
+        self._names.append(obj.name)
+
+    def __repr__(self):
+        return "<{} of {} ({} loaded)>".format(type(self).__name__,
+                                              len(self._names), len(self._objects))
+
 class List(collections.UserList):
     LIST_KEY = 'contents'
 
@@ -68,7 +244,6 @@ class List(collections.UserList):
 class Serializable(metaclass=WithListMeta):
     """Base class for objects which can be read and written to and from
     a dict."""
-
     _ElementListBase = List
 
     @classmethod
@@ -93,6 +268,7 @@ class Serializable(metaclass=WithListMeta):
         pass
 
 Serializable.register(RefList)
+Serializable.register(CompactRefList)
 Serializable.register(List)
 
 class Referenceable(Serializable):
@@ -103,7 +279,15 @@ class Referenceable(Serializable):
 
     Thanks to metaclass voodoo, all subclasses of Referenceable have a 'RefList' class
     attribute that contains a class dervived from RefList. This class can be used to
-    build lists of references.
+    build lists of references. 'CompactList' is the same for CompactRefList,
+    which reads the elements only when they are used.
+
+    INDEXES lists dotted paths that are often used in queries. Database asks
+    the driver to index them (see Driver.ensure_indexes) before the first query
+    or write involving the class.
+
+    Instead of implementing from_dict and as_dict, subclasses can declare
+    their fields, see nostradamus.fields.
 
     Notes:
         from_dict must not take any kwargs, as deserialization of an independent object
@@ -111,6 +295,9 @@ class Referenceable(Serializable):
         from_dict must take the objects name as an argument following read_func.
     """
     _ElementListBase = RefList
+    _CompactListBase = CompactRefList
+
+    INDEXES = ()
 
     def __init__(self, name = None, **kwargs):
         self.name = name or self.generate_name()
@@ -137,12 +324,143 @@ class Referenceable(Serializable):
     def generate_name(cls):
         return "{}-{}".format(cls.__name__, uuid.uuid1())
 
+class LazyReference:
+    """Stand-in for a Referenceable that has not been read yet.
+
+    It holds only the class and the name. The object is read from the database
+    the first time one of its attributes is accessed; the references created
+    by the same from_dict call (e.g. all the elements of a RefList) are fetched
+    together at that point. isinstance() and as_ref() work without reading the
+    object.
+    """
+    __slots__ = ('_cls', 'name', '_loader', '_siblings', '_target')
+
+    def __init__(self, cls, name, loader, siblings):
+        object.__setattr__(self, '_cls', cls)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_siblings', siblings)
+        object.__setattr__(self, '_target', None)
+
+    @property
+    def __class__(self):
+        return self._cls
+
+    @property
+    def SECTION(self):
+        return self._cls.SECTION
+
+    def _resolve(self):
+        if self._target is None:
+            object.__setattr__(self, '_target', self._loader.resolve(self))
+            object.__setattr__(self, '_siblings', None)
+        return self._target
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._resolve(), attr, value)
+
+    def as_ref(self, write_func):
+        """An unresolved object cannot have been modified, so it is not
+        written."""
+        if self._target is None:
+            return {'_IS_REFERENCE': True,
+                    'target_name': self.name}
+        return self._target.as_ref(write_func)
+
+    def __repr__(self):
+        if self._target is None:
+            return "<{} {}({!r})>".format(type(self).__name__,
+                                          self._cls.__name__, self.name)
+        return repr(self._target)
+
+class _LazyLoader:
+    """read_func used by Database in lazy mode: references are returned as
+    LazyReference objects, which are resolved through this loader.
+    """
+    def __init__(self, driver, read_cache, loaded=None):
+        """loaded: callable taking (key, document, object), called for each
+        object built."""
+        self._driver = driver
+        self.read_cache = read_cache
+        self._loaded = loaded
+        self.doc_cache = {}
+        self._group = None
+
+    def __call__(self, cls_name):
+        obj = self.read_cache.get(cls_name)
+        if obj is not None:
+            return obj
+
+        cls, name = cls_name
+        siblings = self._group if self._group is not None else []
+        ref = LazyReference(cls, name, self, siblings)
+        siblings.append(ref)
+        return ref
+
+    def fetch(self, cls_names):
+        """Fetch the documents for cls_names in one getitems() call."""
+        keys = [(cls.SECTION, name) for cls, name in cls_names
+                    if (cls.SECTION, name) not in self.doc_cache]
+        if keys:
+            self.doc_cache.update(self._driver.getitems(keys))
+
+    def read(self, cls_name):
+        cls, name = cls_name
+
+        obj = self.read_cache.get(cls_name)
+        if obj is None:
+            key = (cls.SECTION, name)
+            d = self.doc_cache.pop(key, None)
+            if d is None:
+                d = self._driver.getitem(key)
+
+            outer_group, self._group = self._group, []
+            try:
+                obj = cls.from_dict(d, self, name=name)
+            finally:
+                self._group = outer_group
+            self.read_cache[cls_name] = obj
+            if self._loaded is not None:
+                self._loaded(key, d, obj)
+
+        return obj
+
+    def many(self, cls_names):
+        """Read many objects, fetching their documents in one call."""
+        cls_names = list(cls_names)
+        self.fetch(c for c in cls_names if c not in self.read_cache)
+        return [self.read(c) for c in cls_names]
+
+    def resolve(self, ref):
+        pending = [(s._cls, s.name) for s in ref._siblings if s._target is None]
+        # The documents are now in doc_cache, the other siblings need not
+        # fetch them again.
+        ref._siblings.clear()
+        if len(pending) > 1:
+            self.fetch(pending)
+        return self.read((ref._cls, ref.name))
 
 class ConsistencyError(Exception):
     """Raised whenever one tries to serialize two different objects with
     the same name."""
     pass
 
+class ReferentialIntegrityError(Exception):
+    """Raised by Database.delete when other objects still refer to the
+    object being deleted.
+
+    key: (section, name) of the object.
+    referrers: list of (section, name) of the objects referring to it.
+    """
+    def __init__(self, key, referrers):
+        self.key = key
+        self.referrers = referrers
+        super().__init__("{} is referred to by {} object(s)".format(
+                             key, len(referrers)))
+
 class ParseError(Exception):
     pass
 
@@ -150,21 +468,232 @@ class ObjectNotFound(Exception):
     #TODO: Use this.
     pass
 
+def _ignore_write(obj):
+    pass
+
+def _classes_by_section():
+    """Map each section to the Referenceable classes stored in it."""
+    by_section = {}
+    pending = [Referenceable]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        section = getattr(cls, 'SECTION', None)
+        if isinstance(section, str):
+            by_section.setdefault(section, []).append(cls)
+    return by_section
+
+def _key(obj):
+    """(section, name) of an object (or LazyReference) or a (class, name)."""
+    if isinstance(obj, tuple):
+        cls, name = obj
+        return (cls.SECTION, name)
+    return (obj.SECTION, obj.name)
+
+def _fingerprint(d):
+    """Stable hash of a dictionary."""
+    s = json.dumps(d, sort_keys=True, separators=(',', ':'), default=repr)
+    return hashlib.md5(s.encode()).digest()
+
 class Database:
-    def __init__(self, driver):
+    def __init__(self, driver, identity_map=None, lazy=False, track_changes=False,
+                 stats=None):
+        """identity_map: IdentityMap shared by all reads on this database, for
+        example an LRUIdentityMap or a WeakIdentityMap. When it is None each
+        read()/read_many() call uses its own map, which is dropped when the
+        call returns.
+        lazy: if True, referenced objects are not read together with the
+        object that refers to them. Instead, from_ref() returns a LazyReference
+        that reads the object when it is first used. Unresolved references
+        are not written back, so objects read lazily should only be written to
+        the database they came from.
+        track_changes: if True, remember a fingerprint of the last version of
+        each document read or written, and do not send documents that did not
+        change. This also enables skip_clean in write().
+        stats: a nostradamus.metrics.TraversalStats to be filled with counts
+        of the objects and references visited by each call (and, in profiling
+        mode, the time spent in each class). None (the default) costs nothing.
+        """
         self._driver = driver
+        self.stats = stats
+        self.identity_map = identity_map
+        self.lazy = lazy
+        self._provisioned = set()
+        self._collectors = weakref.WeakSet()
+        if track_changes:
+            self._fingerprints = {}
+            self._clean = weakref.WeakValueDictionary()
+        else:
+            self._fingerprints = None
+            self._clean = None
+
+    def _new_read_cache(self):
+        if self.identity_map is not None:
+            return self.identity_map
+        return IdentityMap()
+
+    def invalidate(self, cls=None, name=None):
+        """Forget objects held in the shared identity map, so that the next
+        read fetches them from the driver. See IdentityMap.invalidate.
+        When tracking changes, the fingerprints of the corresponding documents
+        are forgotten too, and the objects are no longer considered clean, so
+        that they are written again in full (even with skip_clean).
+        """
+        if self.identity_map is not None:
+            self.identity_map.invalidate(cls, name)
+        if self._fingerprints is not None:
+            if cls is None:
+                self._fingerprints.clear()
+                self._clean.clear()
+                return
+            elif name is not None:
+                self._fingerprints.pop((cls.SECTION, name), None)
+            else:
+                for key in [k for k in self._fingerprints if k[0] == cls.SECTION]:
+                    del self._fingerprints[key]
+            for obj_id, obj in list(self._clean.items()):
+                if isinstance(obj, cls) and (name is None or obj.name == name):
+                    self._clean.pop(obj_id, None)
+
+    def mark_dirty(self, *objs):
+        """Tell the database that objects were modified, see write()."""
+        if self._clean is not None:
+            for obj in objs:
+                self._clean.pop(id(obj), None)
+
+    def _is_clean(self, obj):
+        return self._clean.get(id(obj)) is obj
+
+    def _loaded(self, key, d, obj):
+        """Called for each object built from the document d."""
+        if self.stats is not None:
+            self.stats.read['objects'] += 1
+        if self._fingerprints is not None:
+            self._fingerprints[key] = _fingerprint(d)
+            self._clean[id(obj)] = obj
+
+    def _outgoing(self, write_cache):
+        """Return (items, fingerprints): the items of write_cache that must be
+        sent to the driver, and the fingerprints to record once they are sent.
+        """
+        if self._fingerprints is None:
+            return [(key, d) for key, (obj, d) in write_cache.items()], None
+
+        items = []
+        fingerprints = {}
+        for key, (obj, d) in write_cache.items():
+            fingerprint = _fingerprint(d)
+            if self._fingerprints.get(key) != fingerprint:
+                items.append((key, d))
+                fingerprints[key] = fingerprint
+        return items, fingerprints
+
+    def _remember(self, write_cache, fingerprints=None):
+        """Record the objects just written: point the shared identity map to
+        them and, when tracking changes, store their fingerprints."""
+        if self.identity_map is not None:
+            for obj, d in write_cache.values():
+                self.identity_map[(type(obj), obj.name)] = obj
+        if self._fingerprints is not None:
+            self._fingerprints.update(fingerprints)
+            for obj, d in write_cache.values():
+                self._clean[id(obj)] = obj
 
-    def _write(self, obj, write_cache, follow_refs=True):
-        if (obj.SECTION, obj.name) not in write_cache:
-            write_func = self._write if follow_refs else (lambda *args, **kwargs: None)
-            d = obj.as_dict(functools.partial(write_func, write_cache = write_cache))
+    def _unprovisioned(self, classes):
+        """Return the classes whose INDEXES were not yet requested from the
+        driver, and mark them as requested."""
+        new = [cls for cls in classes if cls not in self._provisioned]
+        self._provisioned.update(new)
+        return new
+
+    def _provision(self, classes):
+        for cls in self._unprovisioned(classes):
+            self._driver.ensure_indexes(cls.SECTION, cls.INDEXES)
+
+    def _commit(self, write_cache, patch=False):
+        self._provision(set(type(obj) for obj, d in write_cache.values()))
+        items, fingerprints = self._outgoing(write_cache)
+        if self.stats is not None:
+            self.stats.write['documents'] += len(items)
+        if items:
+            if patch:
+                self._driver.patch(items)
+            else:
+                self._driver.update(items)
+        self._remember(write_cache, fingerprints)
+        for collector in self._collectors:
+            collector.shade(write_cache)
+
+    @staticmethod
+    def _claim(obj, write_cache):
+        """Reserve the slot for obj in write_cache. Return the object to be
+        serialized, or None if it is already there. Raise ConsistencyError if
+        a different object with the same name is there."""
+        if type(obj) is LazyReference:
+            obj = obj._resolve()
+        key = (obj.SECTION, obj.name)
+        cached = write_cache.get(key)
+        if cached is None:
+            write_cache[key] = (obj, None)
+            return obj
+        c_obj = cached[0]
+        if c_obj is not obj and c_obj != obj:
+            raise ConsistencyError("Tried to serialize different objects with the same name")
+        return None
+
+    def _write(self, obj, write_cache, follow_refs=True, skip_clean=False):
+        """Serialize obj and, if follow_refs, every object it references into
+        write_cache, which maps (section, name) to (object, dictionary).
+
+        Referenced objects are not serialized from inside as_dict (which would
+        recurse once per reference) but put in a work list, so reference
+        chains of any length can be written.
+
+        If skip_clean, referenced objects that were not modified since they
+        were read or written (see write()) are not serialized.
+        """
+        pending = []
+        stats = self.stats
+
+        def write_func(ref):
+            if stats is not None:
+                stats.write['references'] += 1
+            if skip_clean and self._is_clean(ref):
+                if stats is not None:
+                    stats.write['skipped_clean'] += 1
+                return
+            ref = self._claim(ref, write_cache)
+            if ref is not None:
+                pending.append(ref)
+            elif stats is not None:
+                stats.write['dedups'] += 1
+
+        obj = self._claim(obj, write_cache)
+        if obj is None:
+            if stats is not None:
+                stats.write['dedups'] += 1
+            return
+        if not follow_refs:
+            write_func = _ignore_write
+
+        pending.append(obj)
+        if stats is None:
+            while pending:
+                obj = pending.pop()
+                write_cache[(obj.SECTION, obj.name)] = (obj, obj.as_dict(write_func))
+            return
+
+        while pending:
+            obj = pending.pop()
+            t0 = time.perf_counter()
+            d = obj.as_dict(write_func)
+            if stats.profile:
+                stats.add_time(type(obj), 'as_dict', time.perf_counter() - t0)
+            stats.write['objects'] += 1
             write_cache[(obj.SECTION, obj.name)] = (obj, d)
-        else:
-            c_obj, c_d = write_cache[(obj.SECTION, obj.name)]
-            if c_obj != obj:
-                raise ConsistencyError("Tried to serialize different objects with the same name")
 
-    def write(self, obj, write_cache = None, follow_refs=True):
+    def write(self, obj, write_cache = None, follow_refs=True, skip_clean=False,
+              patch=False):
         """Write an object and all directly or indirectly referenced objects.
         Consistency (one name corresponds to only one object) is checked before
         committing to the database.
@@ -173,47 +702,616 @@ class Database:
         is the same as calling write on different instances tied to the same backend.
         If you want to write multiple object in one operation, use write_many.
         If you do not want to write referenced objects, set follow_refs=False. Use with caution.
+
+        If the database tracks changes, documents identical to the last version
+        read or written are not sent to the driver. Moreover, with
+        skip_clean=True, referenced objects that were read or written by this
+        database and not passed to mark_dirty() since are not even serialized,
+        and neither are the objects that are only reachable through them.
+
+        With patch=True, documents are sent with driver.patch(), so drivers that
+        support it send only the fields that changed.
         """
 
+        if self.stats is not None:
+            self.stats.calls['write'] += 1
         if write_cache is None:
             write_cache = {}
 
-        self._write(obj, write_cache, follow_refs=follow_refs)
-        self._driver.update((key, d) for key, (obj, d) in write_cache.items())
+        self._write(obj, write_cache, follow_refs=follow_refs,
+                    skip_clean=skip_clean and self._clean is not None)
+        self._commit(write_cache, patch=patch)
 
-    def read(self, cls_name, read_cache={}):
-        """Read an object from a section. Multiple read() calls will yield different
-        objects for the same name. If you want to read many objects and get the same
-        database object mapped to the same python object, use read_many().
+    @staticmethod
+    def _probe(cls, name, d):
+        """Find out which objects the document d refers to, by deserializing
+        it with a read_func that only records what it is asked for.
+        Return (list of (class, name), complete), complete being False if
+        from_dict failed, so that only part of the references were found.
         """
-        cls, name = cls_name
+        refs = []
 
-        if (cls, name) not in read_cache:
-            d = self._driver.getitem((cls.SECTION, name))
-            read_cache[(cls, name)] = cls.from_dict(d,
-                                        functools.partial(self.read, read_cache=read_cache),
-                                        name=name)
+        def record(cls_name):
+            refs.append(cls_name)
+            return None
 
-        return read_cache[(cls, name)]
+        try:
+            cls.from_dict(d, record, name=name)
+        except Exception:
+            # This from_dict needs the actual referenced objects. They will
+            # be fetched one by one when the object is built.
+            return refs, False
 
-    def read_many(self, cls_names):
+        return refs, True
+
+    @staticmethod
+    def _references(cls, name, d):
+        """The references found by _probe, complete or not."""
+        return Database._probe(cls, name, d)[0]
+
+    def _expand(self, level, seen, read_cache, doc_cache, graph=None):
+        """Return the set of objects referenced by the objects in level (a set
+        of (class, name)) that are not in seen nor in read_cache, and add them
+        to seen. Documents are taken from doc_cache. If graph is given, the
+        references of each object are stored in it.
+
+        Only the documents holding references (see reference_targets) are
+        probed, the others are deserialized once, when they are built. A
+        from_dict that reads references stored in another format still works,
+        but those are fetched one by one.
+        """
+        next_level = set()
+        for cls, name in level:
+            d = doc_cache.get((cls.SECTION, name))
+            if d is None or not reference_targets(d):
+                continue
+            refs = self._references(cls, name, d)
+            if self.stats is not None:
+                self.stats.read['references'] += len(refs)
+            if graph is not None:
+                graph[(cls, name)] = refs
+            for ref in refs:
+                if ref not in seen and ref not in read_cache:
+                    seen.add(ref)
+                    next_level.add(ref)
+        return next_level
+
+    def _prefetch(self, cls_names, read_cache, doc_cache, graph=None):
+        """Fetch the documents for cls_names and for every object reachable
+        from them, breadth first. All the objects at the same depth are
+        fetched with a single getitems() call, so the number of round trips
+        depends on the depth of the graph and not on the number of objects.
+        Documents are stored in doc_cache, keyed by (section, name), and
+        references in graph (see _expand).
+        """
+        level = set(cls_name for cls_name in cls_names
+                        if cls_name not in read_cache)
+        seen = set(level)
+
+        while level:
+            wanted = [(cls.SECTION, name) for cls, name in level
+                            if (cls.SECTION, name) not in doc_cache]
+            docs = self._driver.getitems(wanted)
+            if self.stats is not None:
+                self.stats.read['round_trips'] += 1
+                self.stats.read['documents'] += len(docs)
+            doc_cache.update(docs)
+            level = self._expand(level, seen, read_cache, doc_cache, graph)
+
+    @staticmethod
+    def _build_order(cls_name, graph, read_cache):
+        """Return cls_name and the objects it references that are not yet
+        built, referenced objects first (depth first post-order, without
+        recursion)."""
+        order = []
+        visited = {cls_name}
+        stack = [(cls_name, iter(graph.get(cls_name, ())))]
+        while stack:
+            node, refs = stack[-1]
+            for ref in refs:
+                if ref not in visited and ref not in read_cache:
+                    visited.add(ref)
+                    ref_refs = graph.get(ref)
+                    if not ref_refs:
+                        # Nothing to build before it
+                        order.append(ref)
+                        continue
+                    stack.append((ref, iter(ref_refs)))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        return order
+
+    def _reader(self, read_cache, doc_cache):
+        """Return the read_func passed to from_dict. Documents are taken from
+        doc_cache, or from the driver if they are not there."""
+        stats = self.stats
+
+        def read_func(cls_name):
+            obj = read_cache.get(cls_name)
+            if obj is None:
+                cls, name = cls_name
+                key = (cls.SECTION, name)
+                if key in doc_cache:
+                    d = doc_cache[key]
+                else:
+                    d = self._driver.getitem(key)
+                    if stats is not None:
+                        stats.read['round_trips'] += 1
+                        stats.read['documents'] += 1
+                if stats is not None and stats.profile:
+                    t0 = time.perf_counter()
+                    obj = cls.from_dict(d, read_func, name=name)
+                    stats.add_time(cls, 'from_dict', time.perf_counter() - t0)
+                else:
+                    obj = cls.from_dict(d, read_func, name=name)
+                read_cache[cls_name] = obj
+                self._loaded(key, d, obj)
+            elif stats is not None:
+                stats.read['cache_hits'] += 1
+            return obj
+        read_func.many = functools.partial(self._read_batch, read_cache)
+        return read_func
+
+    def _read_batch(self, read_cache, cls_names):
+        """Read many objects into read_cache, fetching them (and what they
+        reference) in batches. Used by lists that read their elements after
+        the read() call that built them returned."""
+        cls_names = list(cls_names)
+        doc_cache = {}
+        graph = {}
+        self._prefetch(cls_names, read_cache, doc_cache, graph)
+        read_func = self._reader(read_cache, doc_cache)
+        return [self._read(c, read_cache, doc_cache, graph, read_func)
+                    for c in cls_names]
+
+    def _read(self, cls_name, read_cache, doc_cache, graph=None, read_func=None):
+        """Build the object for cls_name. If graph (see _prefetch) is given,
+        referenced objects are built before the objects that refer to them, so
+        from_dict finds them already in read_cache and deep graphs are read
+        without deep recursion.
+        """
+        if read_func is None:
+            read_func = self._reader(read_cache, doc_cache)
+        if graph:
+            # Hold the objects built here until the end: a weak identity map
+            # would otherwise drop each one before its referrer is built.
+            built = [read_func(dependency)
+                        for dependency in self._build_order(cls_name, graph,
+                                                            read_cache)]
+            return built[-1]
+        return read_func(cls_name)
+
+    def read(self, cls_name, read_cache=None):
+        """Read an object from a section. Unless the database has a shared
+        identity_map, multiple read() calls will yield different objects for the
+        same name. If you want to read many objects and get the same database
+        object mapped to the same python object, use read_many().
+
+        read_cache: mapping (or IdentityMap) to use instead of the default one.
+
+        Referenced objects are fetched in batches, see read_many().
+        """
+        if self.stats is not None:
+            self.stats.calls['read'] += 1
+        if read_cache is None:
+            read_cache = self._new_read_cache()
+        if self.lazy:
+            return _LazyLoader(self._driver, read_cache, self._loaded).read(cls_name)
+        doc_cache = {}
+        graph = {}
+        self._prefetch([cls_name], read_cache, doc_cache, graph)
+        return self._read(cls_name, read_cache, doc_cache, graph)
+
+    def read_many(self, cls_names, read_cache=None):
         """
             :param section_names: Iterable yielding (section, name)
+            :param read_cache: see read()
+
+        The objects and all the objects they reference are loaded level by
+        level: every name that is not yet known at one depth of the graph is
+        fetched in one driver.getitems() call.
+        In lazy mode, only the objects in cls_names are fetched (all of them in
+        one call).
         """
-        read_cache = {}
-        return (self.read(cls_name, read_cache = read_cache)
+        if self.stats is not None:
+            self.stats.calls['read_many'] += 1
+        cls_names = list(cls_names)
+        if read_cache is None:
+            read_cache = self._new_read_cache()
+        if self.lazy:
+            loader = _LazyLoader(self._driver, read_cache, self._loaded)
+            loader.fetch(cls_name for cls_name in cls_names
+                            if cls_name not in read_cache)
+            return (loader.read(cls_name) for cls_name in cls_names)
+        doc_cache = {}
+        graph = {}
+        self._prefetch(cls_names, read_cache, doc_cache, graph)
+        read_func = self._reader(read_cache, doc_cache)
+        return (self._read(cls_name, read_cache, doc_cache, graph, read_func)
                     for cls_name in cls_names)
 
-    def write_many(self, objs):
+    def write_many(self, objs, skip_clean=False, patch=False):
+        """Write many objects in one operation, see write()."""
+        if self.stats is not None:
+            self.stats.calls['write_many'] += 1
         write_cache = {}
+        skip_clean = skip_clean and self._clean is not None
 
         for obj in objs:
-            self._write(obj, write_cache=write_cache)
+            self._write(obj, write_cache=write_cache, skip_clean=skip_clean)
+
+        self._commit(write_cache, patch=patch)
+
+    def _referrers(self, key, classes):
+        """Return the keys of the objects referring to the object key.
+
+        The candidates given by driver.referrers() are checked by decoding
+        them (see _references), since references do not record the section
+        of their target. Candidates from sections with no known class (see
+        _classes_by_section), whose from_dict fails without the actual
+        referenced objects, or that hold a reference to the name that
+        from_dict does not read (e.g. in a CompactRefList), are kept.
+        """
+        section, name = key
+        candidates = [k for k in self._driver.referrers(name) if k != key]
+        if not candidates:
+            return []
+        docs = self._driver.getitems(candidates)
+        found = []
+        for k in candidates:
+            d = docs.get(k)
+            if d is None:
+                continue
+            ref_classes = classes.get(k[0])
+            if not ref_classes:
+                found.append(k)
+                continue
+            for cls in ref_classes:
+                refs, complete = self._probe(cls, k[1], d)
+                if (not complete or any(_key(ref) == key for ref in refs)
+                        or (all(ref[1] != name for ref in refs)
+                            and name in reference_targets(d))):
+                    found.append(k)
+                    break
+        return found
+
+    def _forget(self, keys, classes):
+        """Drop everything remembered about the deleted objects keys."""
+        keys = set(keys)
+        for section, name in keys:
+            if self.identity_map is not None:
+                for cls in classes.get(section, ()):
+                    self.identity_map.invalidate(cls, name)
+            if self._fingerprints is not None:
+                self._fingerprints.pop((section, name), None)
+        if self._clean is not None:
+            for obj_id, obj in list(self._clean.items()):
+                if _key(obj) in keys:
+                    self._clean.pop(obj_id, None)
+
+    def delete(self, obj, cascade=False):
+        """Delete an object, given as the object itself or as (class, name).
+
+        If other objects refer to it (see Driver.referrers), nothing is
+        deleted and ReferentialIntegrityError is raised, unless cascade is
+        True: the objects referring to it are then deleted too, and the ones
+        referring to those, and so on.
+        Objects referred to by the deleted ones are kept, even if nothing
+        else refers to them; see collect_orphans().
+
+        Return the list of (section, name) deleted.
+        """
+        if self.stats is not None:
+            self.stats.calls['delete'] += 1
+        classes = _classes_by_section()
+        deleted = [_key(obj)]
+        seen = set(deleted)
+        i = 0
+        while i < len(deleted):
+            referrers = [k for k in self._referrers(deleted[i], classes)
+                            if k not in seen]
+            if referrers and not cascade:
+                raise ReferentialIntegrityError(deleted[i], referrers)
+            seen.update(referrers)
+            deleted.extend(referrers)
+            i += 1
+        self._driver.delitems(deleted)
+        self._forget(deleted, classes)
+        return deleted
 
-        self._driver.update((key, d) for key, (obj, d) in write_cache.items())
+    def orphan_collector(self, roots, sections=None, batch_size=1000):
+        """Return an OrphanCollector, to delete the objects that cannot be
+        reached from roots a batch at a time. See collect_orphans()."""
+        return OrphanCollector(self, roots, sections, batch_size)
+
+    def collect_orphans(self, roots, sections=None, batch_size=1000):
+        """Delete the objects that cannot be reached from roots by following
+        references. roots is an iterable of objects, (class, name) pairs and
+        classes (all the objects of the class are roots).
+
+        Only the given sections (all the sections of the driver by default)
+        are swept. Return the number of documents deleted.
+        """
+        if self.stats is not None:
+            self.stats.calls['collect_orphans'] += 1
+        return self.orphan_collector(roots, sections, batch_size).run()
+
+    def session(self, **kwargs):
+        """Return a Session (unit of work) on this database. See Session for
+        the arguments. Use it as a context manager:
+
+            with db.session(max_documents=500) as s:
+                for obj in stream:
+                    s.write(obj)
+        """
+        return Session(self, **kwargs)
 
     def query_names(self, cls, query=None):
+        if self.stats is not None:
+            self.stats.calls['query_names'] += 1
+        self._provision([cls])
         return self._driver.query_names(cls.SECTION, query)
 
-    def query_elements(self, cls, projection, query=None):
-        return self._driver.query_elements(cls.SECTION, projection, query)
+    def query_elements(self, cls, projection, query=None, limit=None, skip=0,
+                       batch_size=None):
+        """Return an iterable of dictionaries containing only the dotted paths
+        in projection of each object matching query. The objects are not
+        deserialized. See Driver.query_elements.
+        """
+        if self.stats is not None:
+            self.stats.calls['query_elements'] += 1
+        self._provision([cls])
+        return self._driver.query_elements(cls.SECTION, projection, query,
+                                           limit=limit, skip=skip,
+                                           batch_size=batch_size)
+
+class OrphanCollector:
+    """Incremental mark and sweep of the objects that cannot be reached from
+    a set of roots, see Database.collect_orphans().
+
+    Each step() does one batch of work: following the references of
+    batch_size objects (mark), listing the objects of a root class, or
+    deleting up to batch_size unreachable documents (sweep). The
+    application can go on using the database between steps: objects written
+    through it are marked, and their references followed before anything
+    else is swept, so they are never collected. Writes made through other
+    Database instances or processes are not seen.
+
+    References are found by decoding the documents (see
+    Database._references). When that fails, every object with a name the
+    document refers to is kept.
+    """
+    def __init__(self, db, roots, sections=None, batch_size=1000):
+        self.db = db
+        self.sections = sections
+        self.batch_size = batch_size
+        # (section, name) of the objects found to be reachable.
+        self.marked = set()
+        self.deleted = 0
+        self.done = False
+
+        self._classes = _classes_by_section()
+        self._gray = collections.deque()
+        self._root_classes = collections.deque()
+        self._sweep = None
+        keys = []
+        for root in roots:
+            if isinstance(root, type):
+                self._root_classes.append(root)
+            else:
+                keys.append(_key(root))
+        self.shade(keys)
+        db._collectors.add(self)
+
+    def shade(self, keys):
+        """Mark the objects (section, name) as reachable. Their references
+        are followed in the next steps."""
+        for key in keys:
+            if key not in self.marked:
+                self.marked.add(key)
+                self._gray.append(key)
+
+    def _mark(self):
+        batch = [self._gray.popleft()
+                    for i in range(min(self.batch_size, len(self._gray)))]
+        docs = self.db._driver.getitems(batch)
+        for (section, name), d in docs.items():
+            found = set()
+            for cls in self._classes.get(section, ()):
+                found.update(_key(ref) for ref in self.db._references(cls, name, d))
+            self.shade(found)
+            missing = reference_targets(d) - set(k[1] for k in found)
+            if missing:
+                sections = set(self._classes).union(self.sections or ())
+                self.shade((s, target) for target in missing for s in sections)
+
+    def _unreachable(self):
+        """Yield the keys of the documents that are not marked. Each key is
+        checked when it is produced."""
+        driver = self.db._driver
+        sections = self.sections if self.sections is not None else driver.sections()
+        for section in sections:
+            for name in list(driver.query_names(section)):
+                if (section, name) not in self.marked:
+                    yield (section, name)
+
+    def step(self):
+        """Do one batch of work. Return True once the collection is over."""
+        if self.done:
+            return True
+        if self._gray:
+            self._mark()
+        elif self._root_classes:
+            section = self._root_classes.popleft().SECTION
+            self.shade((section, name) for name in self.db._driver.query_names(section))
+        else:
+            if self._sweep is None:
+                self._sweep = self._unreachable()
+            batch = list(itertools.islice(self._sweep, self.batch_size))
+            if batch:
+                self.db._driver.delitems(batch)
+                self.db._forget(batch, self._classes)
+                self.deleted += len(batch)
+            else:
+                self.done = True
+                self.db._collectors.discard(self)
+        return self.done
+
+    def run(self):
+        """Step until the end, return the number of documents deleted."""
+        while not self.step():
+            pass
+        return self.deleted
+
+class _SessionCache(dict):
+    """write_cache for one Session.write_many() call. It holds the documents
+    serialized by the call, but lookups also see the documents already
+    pending in the session, so those are not serialized again, except for
+    the keys in fresh (the objects passed to the call)."""
+    __slots__ = ('pending', 'fresh')
+
+    def __init__(self, pending, fresh):
+        super().__init__()
+        self.pending = pending
+        self.fresh = fresh
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        if key not in self.fresh:
+            entry = self.pending.get(key)
+            if entry is not None:
+                return entry
+        return default
+
+class Session:
+    """Unit of work on a Database.
+
+    Objects written through the session are not sent to the driver right away
+    but buffered, and flushed in one driver.update() (or patch()) call when
+    one of the limits is exceeded, when flush() is called and when the
+    session ends. Consistency (one name corresponds to only one object) is
+    checked across all the writes of the session, not only within one call.
+    Flushed objects are only weakly referenced for this, so they can be
+    freed during the session (if the identity map does not keep them).
+
+    Reads share one identity map, which also holds the objects written, so
+    reading a name written in the session returns the written object even if
+    it was not flushed yet.
+
+    Objects that are already pending are not serialized again when they are
+    reached through references, only when they are passed to write() or
+    write_many() themselves, so call these on the objects you modify.
+
+    If the with block raises, the writes not yet flushed are discarded.
+    """
+    def __init__(self, db, max_documents=1000, max_bytes=None, max_delay=None,
+                 identity_map=None, skip_clean=False, patch=False):
+        """max_documents: flush when this many documents are pending.
+        max_bytes: flush when the pending documents take this many bytes as
+            JSON (computing it costs one json.dumps per document).
+        max_delay: flush when the oldest pending document is this many
+            seconds old. This is checked on each write, there is no timer.
+        None disables a limit.
+        identity_map: identity map for the session, by default a new
+            IdentityMap (or the database's shared one, if it has one).
+        skip_clean, patch: see Database.write.
+        """
+        self.db = db
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.skip_clean = skip_clean
+        self.patch = patch
+        if identity_map is None:
+            identity_map = db._new_read_cache()
+        self.identity_map = identity_map
+
+        self._written = weakref.WeakValueDictionary()
+        self._pending = {}
+        self._pending_bytes = 0
+        # key -> size of the pending document, only with max_bytes
+        self._pending_sizes = {}
+        self._pending_since = None
+        self.flushes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def __len__(self):
+        """Number of documents waiting to be flushed."""
+        return len(self._pending)
+
+    def read(self, cls_name):
+        """See Database.read"""
+        return self.db.read(cls_name, read_cache=self.identity_map)
+
+    def read_many(self, cls_names):
+        """See Database.read_many"""
+        return self.db.read_many(cls_names, read_cache=self.identity_map)
+
+    def _add(self, write_cache):
+        """Move the documents serialized in write_cache to the pending ones.
+        Nothing is moved if one of them conflicts with an object written
+        earlier in the session."""
+        for key, (obj, d) in write_cache.items():
+            written = self._written.get(key)
+            if written is not None and written is not obj and written != obj:
+                raise ConsistencyError("Tried to serialize different objects "
+                                       "with the same name")
+
+        for key, (obj, d) in write_cache.items():
+            self._written[key] = obj
+            self.identity_map[(type(obj), obj.name)] = obj
+            self._pending[key] = (obj, d)
+            if self.max_bytes is not None:
+                size = len(json.dumps(d, separators=(',', ':'), default=repr))
+                self._pending_bytes += size - self._pending_sizes.get(key, 0)
+                self._pending_sizes[key] = size
+        if self._pending_since is None and self._pending:
+            self._pending_since = time.monotonic()
+
+    def _full(self):
+        return ((self.max_documents is not None
+                    and len(self._pending) >= self.max_documents)
+                or (self.max_bytes is not None
+                    and self._pending_bytes >= self.max_bytes)
+                or (self.max_delay is not None and self._pending_since is not None
+                    and time.monotonic() - self._pending_since >= self.max_delay))
+
+    def write(self, obj, follow_refs=True):
+        """Write obj and the objects it references, see Database.write."""
+        self.write_many([obj], follow_refs=follow_refs)
+
+    def write_many(self, objs, follow_refs=True):
+        objs = list(objs)
+        write_cache = _SessionCache(self._pending, set(_key(obj) for obj in objs))
+        skip_clean = self.skip_clean and self.db._clean is not None
+        for obj in objs:
+            self.db._write(obj, write_cache, follow_refs=follow_refs,
+                           skip_clean=skip_clean)
+        self._add(write_cache)
+        if self._full():
+            self.flush()
+
+    def flush(self):
+        """Send the pending documents to the driver."""
+        if self._pending:
+            self.db._commit(self._pending, patch=self.patch)
+            self.flushes += 1
+        self.discard()
+
+    def discard(self):
+        """Drop the pending documents without writing them."""
+        self._pending = {}
+        self._pending_bytes = 0
+        self._pending_sizes = {}
+        self._pending_since = None
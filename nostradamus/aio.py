@@ -0,0 +1,169 @@
+"""asyncio version of Database.
+
+AsyncDatabase works on top of an AsyncDriver (see nostradamus.drivers.aio).
+Serialization is the same as in Database; only the driver calls are
+awaited. When reading, the documents of the objects at one depth of the
+graph (e.g. all the entries of a RefList) are fetched concurrently.
+"""
+
+import asyncio
+
+from . import Database
+from .drivers.base import Driver
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+class _NotFetched(Exception):
+    """A document that was not prefetched is needed."""
+    def __init__(self, key):
+        self.key = key
+        super().__init__(key)
+
+class _PrefetchedOnly(Driver):
+    """Driver for the synchronous Database used to build objects: every
+    document must have been fetched beforehand. Writes and queries go
+    through the AsyncDriver of the AsyncDatabase, never through this one."""
+
+    def getitem(self, k):
+        raise _NotFetched(k)
+
+    def setitem(self, k, v):
+        raise NotImplementedError("AsyncDatabase cannot write {!r} "
+                                  "synchronously, the AsyncDriver must be "
+                                  "used".format(k))
+
+    def query_names(self, query_section_name, query=None):
+        raise NotImplementedError("AsyncDatabase cannot query {!r} "
+                                  "synchronously, the AsyncDriver must be "
+                                  "used".format(query_section_name))
+
+class AsyncDatabase:
+    def __init__(self, driver, identity_map=None, concurrency=10, batch_size=100,
+                 track_changes=False):
+        """driver: an AsyncDriver.
+        identity_map, track_changes: see Database.
+        concurrency: maximum number of driver calls in flight while reading.
+        batch_size: maximum number of keys per getitems() call.
+        """
+        self._driver = driver
+        self._db = Database(_PrefetchedOnly(), identity_map=identity_map,
+                            track_changes=track_changes)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+
+    @property
+    def identity_map(self):
+        return self._db.identity_map
+
+    def invalidate(self, cls=None, name=None):
+        self._db.invalidate(cls, name)
+
+    def mark_dirty(self, *objs):
+        self._db.mark_dirty(*objs)
+
+    async def _provision(self, classes):
+        for cls in self._db._unprovisioned(classes):
+            await self._driver.ensure_indexes(cls.SECTION, cls.INDEXES)
+
+    async def _commit(self, write_cache, patch=False):
+        await self._provision(set(type(obj) for obj, d in write_cache.values()))
+        items, fingerprints = self._db._outgoing(write_cache)
+        if items:
+            if patch:
+                await self._driver.patch(items)
+            else:
+                await self._driver.update(items)
+        self._db._remember(write_cache, fingerprints)
+
+    async def _fetch(self, keys, doc_cache):
+        """Fetch keys into doc_cache, in batches of batch_size, at most
+        concurrency of them at the same time."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_batch(batch):
+            async with semaphore:
+                doc_cache.update(await self._driver.getitems(batch))
+
+        await asyncio.gather(*(fetch_batch(keys[i:i + self.batch_size])
+                                for i in range(0, len(keys), self.batch_size)))
+
+    async def _prefetch(self, cls_names, read_cache, doc_cache, graph=None):
+        """See Database._prefetch"""
+        level = set(cls_name for cls_name in cls_names
+                        if cls_name not in read_cache)
+        seen = set(level)
+
+        while level:
+            wanted = [(cls.SECTION, name) for cls, name in level
+                            if (cls.SECTION, name) not in doc_cache]
+            await self._fetch(wanted, doc_cache)
+            level = self._db._expand(level, seen, read_cache, doc_cache, graph)
+
+    async def _build(self, cls_name, read_cache, doc_cache, graph):
+        """Build an object from the prefetched documents. Documents that could
+        not be prefetched are fetched as they are found missing."""
+        while True:
+            try:
+                return self._db._read(cls_name, read_cache, doc_cache, graph)
+            except _NotFetched as e:
+                await self._fetch([e.key], doc_cache)
+                if e.key not in doc_cache:
+                    raise KeyError(e.key) from None
+
+    async def read(self, cls_name, read_cache=None):
+        """See Database.read"""
+        if read_cache is None:
+            read_cache = self._db._new_read_cache()
+        doc_cache = {}
+        graph = {}
+        await self._prefetch([cls_name], read_cache, doc_cache, graph)
+        return await self._build(cls_name, read_cache, doc_cache, graph)
+
+    async def read_many(self, cls_names):
+        """See Database.read_many. Return a list."""
+        cls_names = list(cls_names)
+        read_cache = self._db._new_read_cache()
+        doc_cache = {}
+        graph = {}
+        await self._prefetch(cls_names, read_cache, doc_cache, graph)
+        return [await self._build(cls_name, read_cache, doc_cache, graph)
+                    for cls_name in cls_names]
+
+    async def write(self, obj, write_cache=None, follow_refs=True,
+                    skip_clean=False, patch=False):
+        """See Database.write"""
+        if write_cache is None:
+            write_cache = {}
+
+        self._db._write(obj, write_cache, follow_refs=follow_refs,
+                        skip_clean=skip_clean and self._db._clean is not None)
+        await self._commit(write_cache, patch=patch)
+
+    async def write_many(self, objs, skip_clean=False, patch=False):
+        """See Database.write_many"""
+        write_cache = {}
+        skip_clean = skip_clean and self._db._clean is not None
+
+        for obj in objs:
+            self._db._write(obj, write_cache=write_cache, skip_clean=skip_clean)
+
+        await self._commit(write_cache, patch=patch)
+
+    async def query_names(self, cls, query=None):
+        await self._provision([cls])
+        return await self._driver.query_names(cls.SECTION, query)
+
+    async def query_elements(self, cls, projection, query=None, limit=None,
+                             skip=0, batch_size=None):
+        """Asynchronous iterator, see Database.query_elements."""
+        await self._provision([cls])
+        async for element in self._driver.query_elements(cls.SECTION, projection,
+                                                         query, limit=limit,
+                                                         skip=skip,
+                                                         batch_size=batch_size):
+            yield element
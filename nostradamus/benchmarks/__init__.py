@@ -0,0 +1,263 @@
+"""Benchmarks for reading, writing and querying object graphs.
+
+Run with:
+
+    python -m nostradamus.benchmarks [--drivers dict,mongo] [--shapes wide,deep]
+                                     [--scale 0.1] [--memory] [--output out.json]
+                                     [--compare baseline.json]
+
+Every operation (write, write_many, read, read_many, query_names,
+query_elements) is run on every combination of driver and graph shape (see
+models). The results are written as JSON, one record per combination,
+with the total time, the throughput in objects per second, the latency of
+the individual calls and, with --memory, the peak memory allocated during
+the operation (measured with tracemalloc in a separate run, since tracing
+slows everything down). With --compare, operations that got slower than in
+a previous result file are reported and the exit status is 1.
+
+The mongo driver runs against an in-process stand-in (see mongo_standin),
+so it measures the driver and BSON encoding, not a server.
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from .. import Database
+from ..drivers.built_in import DictionaryDriver, ChainDriver, \
+                               ConcurrentDictionaryDriver
+from ..drivers.yaml import YAMLDriver
+from ..drivers.mongo import MongoDriver
+from ..drivers.sqlite import SQLiteDriver
+from ..drivers.log import LogDriver
+from ..drivers.directory import DirectoryDriver
+from .mongo_standin import MongoStandIn
+from .models import SHAPES
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+# Each factory takes a scratch directory and returns a new, empty driver.
+DRIVERS = collections.OrderedDict([
+    ('dict', lambda tmpdir: DictionaryDriver()),
+    ('concurrent', lambda tmpdir: ConcurrentDictionaryDriver()),
+    ('yaml', lambda tmpdir: YAMLDriver(filename=os.path.join(tmpdir, 'db.yaml'))),
+    ('chain', lambda tmpdir: ChainDriver([DictionaryDriver(), DictionaryDriver()])),
+    ('mongo', lambda tmpdir: MongoDriver(MongoStandIn())),
+    ('sqlite', lambda tmpdir: SQLiteDriver(os.path.join(tmpdir, 'db.sqlite'))),
+    ('log', lambda tmpdir: LogDriver(os.path.join(tmpdir, 'db.log'))),
+    ('dir', lambda tmpdir: DirectoryDriver(os.path.join(tmpdir, 'db'))),
+])
+
+# Arguments of the shape generators for scale=1.
+SIZES = {
+    'wide': {'n_roots': 10, 'width': 1000},
+    'deep': {'n_roots': 10, 'depth': 1000},
+    'embedded': {'n_roots': 10, 'length': 1000},
+    'dag': {'n_roots': 100, 'layers': 5, 'width': 200, 'fan_out': 10},
+}
+
+OPERATIONS = ('write', 'write_many', 'read', 'read_many', 'query_names',
+              'query_elements')
+
+def make_workload(shape, scale=1):
+    sizes = {k: max(1, int(v * scale)) if k not in ('n_roots', 'fan_out', 'layers')
+                else v
+             for k, v in SIZES[shape].items()}
+    return SHAPES[shape](**sizes)
+
+def count_objects(workload):
+    """Number of documents written when writing all the roots."""
+    write_cache = {}
+    db = Database(DictionaryDriver())
+    for root in workload.roots:
+        db._write(root, write_cache)
+    return len(write_cache)
+
+def _close(driver):
+    close = getattr(driver, 'close', None)
+    if close is not None:
+        close()
+
+def _filled(factory, tmpdir, workload):
+    driver = factory(tmpdir)
+    Database(driver).write_many(workload.roots)
+    return driver
+
+def _operation(op, factory, tmpdir, workload):
+    """Return (driver, calls): calls is a list of callables, each one timed
+    on its own."""
+    if op == 'write':
+        driver = factory(tmpdir)
+        db = Database(driver)
+        return driver, [lambda root=root: db.write(root) for root in workload.roots]
+    if op == 'write_many':
+        driver = factory(tmpdir)
+        db = Database(driver)
+        return driver, [lambda: db.write_many(workload.roots)]
+
+    driver = _filled(factory, tmpdir, workload)
+    db = Database(driver)
+    if op == 'read':
+        return driver, [lambda c=c: db.read(c) for c in workload.cls_names]
+    if op == 'read_many':
+        return driver, [lambda: list(db.read_many(workload.cls_names))]
+    if op == 'query_names':
+        return driver, [lambda: list(db.query_names(workload.query_cls,
+                                                    workload.query))] * 10
+    if op == 'query_elements':
+        return driver, [lambda: list(db.query_elements(workload.query_cls,
+                                                       workload.projection,
+                                                       workload.query))] * 10
+    raise ValueError("Unknown operation {!r}".format(op))
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+def measure(op, factory, workload, n_objects, memory=False):
+    """Run one operation and return its record (without driver and shape)."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        driver, calls = _operation(op, factory, tmpdir, workload)
+        latencies = []
+        try:
+            for call in calls:
+                t0 = time.perf_counter()
+                call()
+                latencies.append(time.perf_counter() - t0)
+        finally:
+            _close(driver)
+
+    peak = None
+    if memory:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            driver, calls = _operation(op, factory, tmpdir, workload)
+            try:
+                tracemalloc.start()
+                for call in calls:
+                    call()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+                _close(driver)
+
+    total = sum(latencies)
+    # Queries go over one section only, the rest touch every object.
+    objects = n_objects if op not in ('query_names', 'query_elements') else None
+    latencies.sort()
+    return {'op': op,
+            'calls': len(latencies),
+            'objects': objects,
+            'seconds': total,
+            'objects_per_second': objects / total if objects and total else None,
+            'calls_per_second': len(latencies) / total if total else None,
+            'latency': {'mean': total / len(latencies),
+                        'p50': _percentile(latencies, 0.5),
+                        'p95': _percentile(latencies, 0.95),
+                        'max': latencies[-1]},
+            'peak_memory': peak}
+
+def run(drivers=None, shapes=None, operations=OPERATIONS, scale=1, memory=False,
+        log=None):
+    """Run the benchmarks, return the report as a dictionary."""
+    results = []
+    for shape in shapes or SHAPES:
+        workload = make_workload(shape, scale)
+        n_objects = count_objects(workload)
+        for driver_name in drivers or DRIVERS:
+            for op in operations:
+                record = measure(op, DRIVERS[driver_name], workload, n_objects,
+                                 memory)
+                record['driver'] = driver_name
+                record['shape'] = shape
+                results.append(record)
+                if log is not None:
+                    log("{:8} {:8} {:15} {:10.4f}s".format(driver_name, shape, op,
+                                                           record['seconds']))
+
+    report = {'timestamp': time.time(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'scale': scale,
+              'results': results}
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+def compare(report, baseline, threshold=1.2):
+    """Return a list of (driver, shape, op, ratio) for the operations that
+    take more than threshold times as long as in baseline."""
+    old = {(r['driver'], r['shape'], r['op']): r for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        key = (r['driver'], r['shape'], r['op'])
+        if key in old and old[key]['seconds']:
+            ratio = r['seconds'] / old[key]['seconds']
+            if ratio > threshold:
+                regressions.append(key + (ratio,))
+    return regressions
+
+def _names(choices):
+    def parse(s):
+        names = [n for n in s.split(',') if n]
+        unknown = [n for n in names if n not in choices]
+        if unknown:
+            raise argparse.ArgumentTypeError("unknown: {}".format(', '.join(unknown)))
+        return names
+    return parse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m nostradamus.benchmarks',
+                                     description="Benchmark nostradamus.")
+    parser.add_argument('--drivers', type=_names(DRIVERS), default=list(DRIVERS),
+                        help="comma separated, from: " + ', '.join(DRIVERS))
+    parser.add_argument('--shapes', type=_names(SHAPES), default=list(SHAPES),
+                        help="comma separated, from: " + ', '.join(SHAPES))
+    parser.add_argument('--operations', type=_names(OPERATIONS),
+                        default=list(OPERATIONS),
+                        help="comma separated, from: " + ', '.join(OPERATIONS))
+    parser.add_argument('--scale', type=float, default=1,
+                        help="multiply the size of the graphs")
+    parser.add_argument('--memory', action='store_true',
+                        help="also measure peak memory (slower)")
+    parser.add_argument('--output', help="write the JSON report here instead "
+                                         "of stdout")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="JSON report of a previous run")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    log = lambda s: print(s, file=sys.stderr)
+    report = run(args.drivers, args.shapes, args.operations, args.scale,
+                 args.memory, log)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for driver, shape, op, ratio in regressions:
+            log("REGRESSION {} {} {}: {:.2f} times the baseline".format(driver, shape, op,
+                                                             ratio))
+        return 1 if regressions else 0
+    return 0
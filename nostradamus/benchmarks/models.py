@@ -0,0 +1,186 @@
+"""Models and object graph generators used by the benchmarks.
+
+Each generator returns a Workload: the root objects to write, the
+(class, name) pairs to read them back, and a query to run on one of the
+sections. Names are deterministic, so every run writes the same documents.
+"""
+
+import collections
+
+from .. import Referenceable, Serializable
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+Workload = collections.namedtuple('Workload', 'roots cls_names query_cls query projection')
+
+class Leaf(Referenceable):
+    SECTION = 'leaves'
+    INDEXES = ('group',)
+
+    def __init__(self, value, group, payload, **kwargs):
+        super().__init__(**kwargs)
+        self.value = value
+        self.group = group
+        self.payload = payload
+
+    @classmethod
+    def from_dict(cls, d, read_func = None, **kwargs):
+        return cls(value = d['value'], group = d['group'], payload = d['payload'],
+                   **kwargs)
+
+    def as_dict(self, write_func = None):
+        return {'value': self.value, 'group': self.group, 'payload': self.payload}
+
+class Hub(Referenceable):
+    """Holds a wide list of references."""
+    SECTION = 'hubs'
+
+    def __init__(self, leaves, **kwargs):
+        super().__init__(**kwargs)
+        self.leaves = Leaf.List(leaves)
+
+    @classmethod
+    def from_dict(cls, d, read_func = None, **kwargs):
+        return cls(leaves = Leaf.List.from_dict(d['leaves'], read_func = read_func),
+                   **kwargs)
+
+    def as_dict(self, write_func = None):
+        return {'leaves': self.leaves.as_dict(write_func = write_func)}
+
+class Link(Referenceable):
+    """Element of a chain of references."""
+    SECTION = 'links'
+    INDEXES = ('depth',)
+
+    def __init__(self, depth, next_link = None, **kwargs):
+        super().__init__(**kwargs)
+        self.depth = depth
+        self.next_link = next_link
+
+    @classmethod
+    def from_dict(cls, d, read_func = None, **kwargs):
+        next_link = d['next_link']
+        if next_link is not None:
+            next_link = Link.from_ref(next_link, read_func = read_func)
+        return cls(depth = d['depth'], next_link = next_link, **kwargs)
+
+    def as_dict(self, write_func = None):
+        next_link = self.next_link
+        if next_link is not None:
+            next_link = next_link.as_ref(write_func = write_func)
+        return {'depth': self.depth, 'next_link': next_link}
+
+class Item(Serializable):
+    def __init__(self, sku, quantity, tags):
+        self.sku = sku
+        self.quantity = quantity
+        self.tags = tags
+
+    @classmethod
+    def from_dict(cls, d, read_func = None, **kwargs):
+        return cls(d['sku'], d['quantity'], d['tags'])
+
+    def as_dict(self, write_func = None):
+        return {'sku': self.sku, 'quantity': self.quantity, 'tags': self.tags}
+
+class Bag(Referenceable):
+    """Holds a large embedded list."""
+    SECTION = 'bags'
+    INDEXES = ('owner',)
+
+    def __init__(self, owner, items, **kwargs):
+        super().__init__(**kwargs)
+        self.owner = owner
+        self.items = Item.List(items)
+
+    @classmethod
+    def from_dict(cls, d, read_func = None, **kwargs):
+        return cls(owner = d['owner'],
+                   items = Item.List.from_dict(d['items'], read_func = read_func),
+                   **kwargs)
+
+    def as_dict(self, write_func = None):
+        return {'owner': self.owner,
+                'items': self.items.as_dict(write_func = write_func)}
+
+class DagNode(Referenceable):
+    """Node of a layered graph in which nodes share their children."""
+    SECTION = 'dag'
+    INDEXES = ('layer',)
+
+    def __init__(self, layer, children = (), **kwargs):
+        super().__init__(**kwargs)
+        self.layer = layer
+        self.children = DagNode.List(children)
+
+    @classmethod
+    def from_dict(cls, d, read_func = None, **kwargs):
+        return cls(layer = d['layer'],
+                   children = DagNode.List.from_dict(d['children'], read_func = read_func),
+                   **kwargs)
+
+    def as_dict(self, write_func = None):
+        return {'layer': self.layer,
+                'children': self.children.as_dict(write_func = write_func)}
+
+def wide(n_roots=10, width=1000, payload_size=64):
+    """Hubs, each referencing width leaves of its own."""
+    roots = [Hub([Leaf(value = i, group = i % 10, payload = 'x' * payload_size,
+                       name = 'leaf-{}-{}'.format(r, i))
+                  for i in range(width)],
+                 name = 'hub-{}'.format(r))
+             for r in range(n_roots)]
+    return Workload(roots, [(Hub, h.name) for h in roots],
+                    Leaf, {'group': 3}, ['value', 'group'])
+
+def deep(n_roots=10, depth=1000):
+    """Chains of depth references."""
+    roots = []
+    for r in range(n_roots):
+        link = None
+        for i in reversed(range(depth)):
+            link = Link(depth = i, next_link = link,
+                        name = 'link-{}-{}'.format(r, i))
+        roots.append(link)
+    return Workload(roots, [(Link, l.name) for l in roots],
+                    Link, {'depth': 0}, ['depth'])
+
+def embedded(n_roots=10, length=1000):
+    """Bags with long embedded lists."""
+    roots = [Bag(owner = 'owner-{}'.format(r % 3),
+                 items = [Item('sku-{}'.format(i), i % 7, ['a', 'b'])
+                          for i in range(length)],
+                 name = 'bag-{}'.format(r))
+             for r in range(n_roots)]
+    return Workload(roots, [(Bag, b.name) for b in roots],
+                    Bag, {'owner': 'owner-1'}, ['owner'])
+
+def dag(n_roots=10, layers=5, width=100, fan_out=10):
+    """Layered DAG: each node references fan_out nodes of the next layer,
+    so subgraphs are shared by many roots."""
+    below = []
+    for layer in reversed(range(1, layers)):
+        below = [DagNode(layer = layer,
+                         children = [below[(i + k) % len(below)]
+                                     for k in range(fan_out)] if below else (),
+                         name = 'dag-{}-{}'.format(layer, i))
+                 for i in range(width)]
+    roots = [DagNode(layer = 0,
+                     children = [below[(r * fan_out + k) % len(below)]
+                                 for k in range(fan_out)],
+                     name = 'dag-0-{}'.format(r))
+             for r in range(n_roots)]
+    return Workload(roots, [(DagNode, n.name) for n in roots],
+                    DagNode, {'layer': 1}, ['layer'])
+
+SHAPES = collections.OrderedDict([
+    ('wide', wide),
+    ('deep', deep),
+    ('embedded', embedded),
+    ('dag', dag),
+])
@@ -0,0 +1,167 @@
+"""In-process stand-in for a MongoDB database, for benchmarking MongoDriver
+without a server.
+
+It implements the part of the pymongo Database/Collection API that
+MongoDriver uses. Documents are stored BSON-encoded, so the encoding and
+decoding cost of a real client is kept; only the network and the server
+are missing.
+"""
+
+import bson
+from pymongo import ReplaceOne, UpdateOne, DeleteOne
+
+from ..drivers.base import project
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+def _get(doc, path):
+    for field in path.split('.'):
+        if not isinstance(doc, dict) or field not in doc:
+            return None
+        doc = doc[field]
+    return doc
+
+def _matches(doc, query):
+    for path, value in (query or {}).items():
+        found = _get(doc, path)
+        if isinstance(value, dict) and '$in' in value:
+            if found not in value['$in']:
+                return False
+        elif isinstance(found, list) and not isinstance(value, list):
+            # Like mongo, a scalar matches the arrays that contain it.
+            if value not in found:
+                return False
+        elif found != value:
+            return False
+    return True
+
+def _key(filter):
+    """Key under which the document selected by filter is stored."""
+    if '__ref_name__' in filter:
+        return filter['__ref_name__']
+    return tuple(sorted(filter.items()))
+
+def _set(doc, path, value):
+    *parents, last = path.split('.')
+    for field in parents:
+        doc = doc.setdefault(field, {})
+    doc[last] = value
+
+def _unset(doc, path):
+    *parents, last = path.split('.')
+    for field in parents:
+        doc = doc.get(field, {})
+    doc.pop(last, None)
+
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+class Cursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def batch_size(self, n):
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+class Collection:
+    def __init__(self):
+        # __ref_name__ (or the filter used to write it) -> BSON
+        self._docs = {}
+        self._next_id = 0
+
+    def create_index(self, keys, **kwargs):
+        return keys
+
+    def _load(self, raw):
+        return bson.decode(raw)
+
+    def _store(self, doc, key=None):
+        doc = dict(doc)
+        self._next_id += 1
+        doc.setdefault('_id', self._next_id)
+        self._docs[key if key is not None else doc['__ref_name__']] = bson.encode(doc)
+
+    def _candidates(self, query):
+        """Documents that may match, using the unique __ref_name__ index."""
+        names = (query or {}).get('__ref_name__')
+        if names is None:
+            return self._docs.values()
+        if isinstance(names, dict):
+            names = names.get('$in', ())
+        else:
+            names = (names,)
+        return [self._docs[n] for n in names if n in self._docs]
+
+    def find(self, filter=None, projection=None, skip=0, limit=0):
+        docs = (self._load(raw) for raw in self._candidates(filter))
+        docs = [doc for doc in docs if _matches(doc, filter)]
+        docs = docs[skip:skip + limit if limit else None]
+        if projection is not None:
+            if not isinstance(projection, dict):
+                projection = {path: 1 for path in projection}
+            paths = [tuple(p.split('.')) for p, v in projection.items()
+                        if v and p != '_id']
+            keep_id = projection.get('_id', 1)
+            docs = [dict(project(doc, paths), **({'_id': doc['_id']} if keep_id else {}))
+                        for doc in docs]
+        return Cursor(docs)
+
+    def find_one(self, filter=None):
+        for doc in self.find(filter):
+            return doc
+        return None
+
+    def replace_one(self, filter, replacement, upsert=False):
+        self._store(replacement, _key(filter))
+
+    def delete_many(self, filter):
+        keys = [key for key, raw in self._docs.items()
+                    if _matches(self._load(raw), filter)]
+        for key in keys:
+            del self._docs[key]
+        return DeleteResult(len(keys))
+
+    def delete_one(self, filter):
+        for key, raw in self._docs.items():
+            if _matches(self._load(raw), filter):
+                del self._docs[key]
+                return DeleteResult(1)
+        return DeleteResult(0)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            if isinstance(request, ReplaceOne):
+                self._store(request._doc, _key(request._filter))
+            elif isinstance(request, DeleteOne):
+                self.delete_one(request._filter)
+            elif isinstance(request, UpdateOne):
+                raw = self._docs[request._filter['__ref_name__']]
+                doc = self._load(raw)
+                for path, value in request._doc.get('$set', {}).items():
+                    _set(doc, path, value)
+                for path in request._doc.get('$unset', {}):
+                    _unset(doc, path)
+                self._store(doc)
+            else:
+                raise TypeError("Unsupported request {!r}".format(request))
+
+class MongoStandIn(dict):
+    """Behaves like a pymongo Database: db[section] is a collection."""
+    def __missing__(self, name):
+        collection = self[name] = Collection()
+        return collection
+
+    def list_collection_names(self):
+        return [name for name, collection in self.items() if collection._docs]
+
+    def __repr__(self):
+        return "{}()".format(type(self).__name__)
@@ -1,5 +1,5 @@
 """Database drivers"""
 
-from . import built_in, yaml, mongo
+from . import built_in, yaml, mongo, log, sqlite, directory
 
 from .base import new_driver
@@ -0,0 +1,175 @@
+"""Asynchronous (asyncio) drivers.
+
+AsyncDriver mirrors Driver, with every method being a coroutine. Any
+synchronous driver can be used through ThreadedAsyncDriver, which runs the
+calls in a thread pool so that the event loop is not blocked.
+"""
+
+import asyncio
+import functools
+import itertools
+from abc import ABC, abstractmethod
+
+from .base import projection_paths, project
+from .built_in import DictionaryDriver
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+class AsyncDriver(ABC):
+    @abstractmethod
+    async def getitem(self, k):
+        pass
+
+    @abstractmethod
+    async def setitem(self, k, v):
+        pass
+
+    @abstractmethod
+    async def query_names(self, query_section_name, query=None):
+        pass
+
+    async def ensure_indexes(self, section, paths):
+        """See Driver.ensure_indexes"""
+        pass
+
+    async def getitems(self, keys):
+        """See Driver.getitems. This implementation calls getitem for all
+        the keys concurrently."""
+        keys = list(keys)
+        results = await asyncio.gather(*(self.getitem(k) for k in keys),
+                                       return_exceptions=True)
+        items = {}
+        for k, result in zip(keys, results):
+            if isinstance(result, KeyError):
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            items[k] = result
+        return items
+
+    async def update(self, items):
+        for k, v in items:
+            await self.setitem(k, v)
+
+    async def patch(self, items):
+        """See Driver.patch"""
+        await self.update(items)
+
+    async def query_elements(self, section, projection, query=None, limit=None,
+                             skip=0, batch_size=None):
+        """Asynchronous iterator, see Driver.query_elements."""
+        batch_size = batch_size or 100
+        paths = [tuple(p.split('.')) for p in projection_paths(projection)]
+        names = itertools.islice(await self.query_names(section, query), skip,
+                                 None if limit is None else skip + limit)
+        while True:
+            keys = [(section, name) for name in itertools.islice(names, batch_size)]
+            if not keys:
+                break
+            items = await self.getitems(keys)
+            for k in keys:
+                if k in items:
+                    yield project(items[k], paths)
+
+class AsyncDictionaryDriver(AsyncDriver):
+    """In-process asynchronous driver backed by a DictionaryDriver.
+
+    latency: seconds each call waits before returning, to stand in for the
+        round trip of a networked backend.
+    """
+    def __init__(self, dictionary=None, latency=0, indexes=None):
+        self.driver = DictionaryDriver(dictionary, indexes=indexes)
+        self.latency = latency
+
+    def __repr__(self):
+        return "{}(latency={!r})".format(type(self).__name__, self.latency)
+
+    async def _round_trip(self):
+        await asyncio.sleep(self.latency)
+
+    async def ensure_indexes(self, section, paths):
+        self.driver.ensure_indexes(section, paths)
+
+    async def getitem(self, k):
+        await self._round_trip()
+        return self.driver.getitem(k)
+
+    async def getitems(self, keys):
+        await self._round_trip()
+        return self.driver.getitems(keys)
+
+    async def setitem(self, k, v):
+        await self._round_trip()
+        self.driver.setitem(k, v)
+
+    async def update(self, items):
+        await self._round_trip()
+        self.driver.update(items)
+
+    async def query_names(self, query_section_name, query=None):
+        await self._round_trip()
+        return self.driver.query_names(query_section_name, query)
+
+    async def query_elements(self, section, projection, query=None, **kwargs):
+        await self._round_trip()
+        for element in self.driver.query_elements(section, projection, query,
+                                                  **kwargs):
+            yield element
+
+class ThreadedAsyncDriver(AsyncDriver):
+    """Use a synchronous Driver from asyncio code. Calls run in executor
+    (the loop's default executor if None)."""
+
+    def __init__(self, driver, executor=None):
+        self.driver = driver
+        self.executor = executor
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.driver)
+
+    async def _call(self, f, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(f, *args, **kwargs))
+
+    async def ensure_indexes(self, section, paths):
+        await self._call(self.driver.ensure_indexes, section, paths)
+
+    async def getitem(self, k):
+        return await self._call(self.driver.getitem, k)
+
+    async def getitems(self, keys):
+        return await self._call(self.driver.getitems, list(keys))
+
+    async def setitem(self, k, v):
+        await self._call(self.driver.setitem, k, v)
+
+    async def update(self, items):
+        await self._call(self.driver.update, list(items))
+
+    async def patch(self, items):
+        await self._call(self.driver.patch, list(items))
+
+    async def query_names(self, query_section_name, query=None):
+        return await self._call(lambda: list(self.driver.query_names(
+                                                query_section_name, query)))
+
+    async def query_elements(self, section, projection, query=None, limit=None,
+                             skip=0, batch_size=None):
+        batch_size = batch_size or 100
+        elements = await self._call(self.driver.query_elements, section,
+                                    projection, query, limit=limit, skip=skip,
+                                    batch_size=batch_size)
+        elements = iter(elements)
+        while True:
+            batch = await self._call(lambda: list(itertools.islice(elements,
+                                                                   batch_size)))
+            if not batch:
+                break
+            for element in batch:
+                yield element
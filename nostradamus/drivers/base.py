@@ -1,9 +1,14 @@
 """Base classes for all database drivers"""
 
-from collections.abc import Iterable
+from collections.abc import Iterable, Mapping
+from collections import namedtuple
+import itertools
 from abc import ABCMeta, ABC, abstractmethod
 
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import os
+import posixpath
+import threading
 
 __author__ = [  "Juan Carrano <jc@eiwa.ag>",
                 "Federico M. Pomar <fp@eiwa.ag>"
@@ -12,6 +17,76 @@ __copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
 __license__ = """Unauthorized copying of this file, via any medium is
                  strictly prohibited. Proprietary and confidential"""
 
+WriteFailure = namedtuple('WriteFailure', ['key', 'code', 'message'])
+WriteFailure.__doc__ = """An item that could not be written. key is the
+(section, name) of the item, or None if the failure is not tied to an
+item (e.g. a write concern error)."""
+
+class BulkUpdateError(Exception):
+    """Raised by Driver.update when some of the items could not be written.
+
+    failures: list of WriteFailure.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__("{} item(s) could not be written".format(len(failures)))
+
+_MISSING = object()
+
+def _lookup(obj, fields):
+    """Follow fields into obj, return _MISSING if the path does not exist."""
+    for field in fields:
+        try:
+            obj = obj[field]
+        except (KeyError, TypeError):
+            return _MISSING
+    return obj
+
+def projection_paths(projection):
+    """Return the list of dotted paths in a projection. A projection is an
+    iterable of dotted paths or a mongo-style dictionary {path: 1, ...}.
+    """
+    if isinstance(projection, Mapping):
+        return [path for path, included in projection.items() if included]
+    return list(projection)
+
+def project(obj, paths):
+    """Return a dictionary with only the given dotted paths of obj, nested as
+    they are in obj. Paths missing from obj are left out. paths may be
+    already split into tuples of fields.
+    """
+    projected = {}
+    for fields in paths:
+        if isinstance(fields, str):
+            fields = fields.split('.')
+        v = _lookup(obj, fields)
+        if v is _MISSING:
+            continue
+        d = projected
+        for field in fields[:-1]:
+            d = d.setdefault(field, {})
+        d[fields[-1]] = v
+    return projected
+
+def reference_targets(obj):
+    """Return the set of target names of the references (as written by
+    Referenceable.as_ref) found anywhere inside a document."""
+    targets = set()
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        # Cheap checks first, isinstance on the Mapping ABC is slow.
+        if obj is None or isinstance(obj, (str, int, float)):
+            continue
+        if isinstance(obj, (dict, Mapping)):
+            if obj.get('_IS_REFERENCE') is True and 'target_name' in obj:
+                targets.add(obj['target_name'])
+            else:
+                pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            pending.extend(obj)
+    return targets
+
 class Driver(ABC):
     @abstractmethod
     def getitem(self, k):
@@ -25,10 +100,112 @@ class Driver(ABC):
     def query_names(self, query_section_name, query=None):
         pass
 
+    def close(self):
+        """Release the resources (files, connections) held by the driver."""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def sections(self):
+        """Return the names of the sections that hold items."""
+        raise NotImplementedError("{} cannot list its sections".format(
+                                      type(self).__name__))
+
+    def ensure_indexes(self, section, paths):
+        """Make queries on the given dotted paths of a section fast, if the
+        driver supports indexes. Calling this again with the same arguments
+        must be cheap.
+        """
+        pass
+
+    def getitems(self, keys):
+        """Fetch many items at once. keys is an iterable of (section, name).
+        Return a dict mapping each key that was found to its value. Keys that
+        are not in the database are left out instead of raising KeyError.
+
+        Drivers for which a round trip is expensive should override this.
+        """
+        items = {}
+        for k in keys:
+            try:
+                items[k] = self.getitem(k)
+            except KeyError:
+                pass
+        return items
+
     def update(self, items):
         for k, v in items:
             self.setitem(k, v)
 
+    def patch(self, items):
+        """Like update, but the driver may send only the parts of the items
+        that changed since it last saw them. Drivers that cannot do that just
+        update.
+        """
+        self.update(items)
+
+    def delitem(self, k):
+        """Remove an item, raise KeyError if it does not exist."""
+        raise NotImplementedError("{} cannot delete items".format(
+                                      type(self).__name__))
+
+    def delitems(self, keys):
+        """Remove many items at once. Keys that do not exist are ignored."""
+        for k in keys:
+            try:
+                self.delitem(k)
+            except KeyError:
+                pass
+
+    def referrers(self, target_name):
+        """Return the keys (section, name) of the items holding a reference
+        to target_name (see reference_targets). References do not record the
+        section of their target, so items referring to objects with the same
+        name in other sections are returned too.
+
+        This implementation reads every item of every section. Drivers that
+        keep a reverse index of the references override it.
+        """
+        found = []
+        for section in self.sections():
+            names = list(self.query_names(section))
+            for i in range(0, len(names), 100):
+                keys = [(section, name) for name in names[i:i + 100]]
+                for k, v in self.getitems(keys).items():
+                    if target_name in reference_targets(v):
+                        found.append(k)
+        return found
+
+    def query_elements(self, section, projection, query=None, limit=None,
+                       skip=0, batch_size=None):
+        """Yield, for each item of section that matches query, a dictionary
+        containing only the dotted paths listed in projection (see
+        projection_paths and project).
+
+        limit: maximum number of elements, None for no limit.
+        skip: number of matching items to skip.
+        batch_size: number of items to fetch from the backend at once.
+
+        This implementation fetches the matching items batch_size at a time
+        with getitems(), so only one batch is held in memory.
+        """
+        batch_size = batch_size or 100
+        paths = [tuple(p.split('.')) for p in projection_paths(projection)]
+        names = itertools.islice(self.query_names(section, query), skip,
+                                 None if limit is None else skip + limit)
+        while True:
+            keys = [(section, name) for name in itertools.islice(names, batch_size)]
+            if not keys:
+                break
+            items = self.getitems(keys)
+            for k in keys:
+                if k in items:
+                    yield project(items[k], paths)
+
 class UriMeta(ABCMeta):
     """Metaclass for drivers that can be created from an uri. This
     metaclass takes care of registering the driver with
@@ -41,7 +218,17 @@ class UriMeta(ABCMeta):
                 register_driver_scheme(scheme)(self)
 
 class UriDriver(Driver, metaclass = UriMeta):
-    """Base class for drivers that can be created from an uri"""
+    """Base class for drivers that can be created from an uri.
+
+    Drivers returned by new_driver are shared (see there), so subclasses
+    must not override close(), but _close(), which is called once the last
+    user closes the driver.
+    """
+
+    # Set by new_driver on shared instances.
+    _registry_key = None
+    _registry_pid = None
+    _refcount = 0
 
     @property
     @abstractmethod
@@ -57,6 +244,16 @@ class UriDriver(Driver, metaclass = UriMeta):
         """
         pass
 
+    def close(self):
+        """Close the driver. Drivers shared through new_driver are only closed
+        when every new_driver call that returned them has been matched by a
+        close()."""
+        if _release_shared(self):
+            self._close()
+
+    def _close(self):
+        pass
+
 REGISTERED_DRIVERS = {}
 
 def register_driver_scheme(uri_scheme):
@@ -73,15 +270,98 @@ def register_driver_scheme(uri_scheme):
 
     return _f
 
-def new_driver(uri_txt, default_scheme = ''):
+_SHARED_DRIVERS = {}
+# Reentrant: from_uri of a ChainDriver calls new_driver for its drivers.
+_shared_lock = threading.RLock()
+
+def normalize_uri(uri):
+    """Return a canonical string for a parsed uri: lowercase scheme and
+    host, normalized path and sorted query parameters."""
+    netloc = uri.netloc
+    if '@' in netloc:
+        userinfo, host = netloc.rsplit('@', 1)
+        netloc = userinfo + '@' + host.lower()
+    else:
+        netloc = netloc.lower()
+    path = posixpath.normpath(uri.path) if uri.path else ''
+    query = urlencode(sorted(parse_qsl(uri.query, keep_blank_values=True)))
+    return urlunparse((uri.scheme.lower(), netloc, path, uri.params, query,
+                       uri.fragment))
+
+def _inherited(name):
+    def method(*args, **kwargs):
+        raise RuntimeError("Cannot call {}() on a driver inherited from the "
+                           "parent process, call new_driver() again in the "
+                           "child".format(name))
+    return method
+
+def _forget_shared_after_fork():
+    """Run in a forked child. The parent's drivers (sockets, file offsets)
+    must not be used: start from an empty registry and make the drivers that
+    were in it raise RuntimeError. They can still be closed, which does
+    nothing in the child."""
+    global _shared_lock
+    _shared_lock = threading.RLock()
+    for driver in _SHARED_DRIVERS.values():
+        cls = type(driver)
+        for name in dir(cls):
+            if (not name.startswith('_') and name not in ('close', 'from_uri')
+                    and callable(getattr(cls, name))):
+                setattr(driver, name, _inherited(name))
+    _SHARED_DRIVERS.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_shared_after_fork)
+
+def _release_shared(driver):
+    """Drop one reference to a shared driver. Return True if the driver must
+    actually be closed."""
+    key = driver._registry_key
+    if key is None:
+        return True
+    if driver._registry_pid != os.getpid():
+        # Inherited from the parent process, which still uses its files and
+        # connections. This process's registry may hold another driver for
+        # the same key.
+        return False
+    with _shared_lock:
+        driver._refcount -= 1
+        if driver._refcount > 0:
+            return False
+        if _SHARED_DRIVERS.get(key) is driver:
+            del _SHARED_DRIVERS[key]
+        return True
+
+def new_driver(uri_txt, default_scheme = '', shared = True):
     """Create a driver from a uri. default_scheme is used as the
     `scheme` parameter for urllib.parse.urlparse.
 
     To see the drivers that can be created with this function use the
     module-global variable `REGISTERED_DRIVERS`
+
+    Unless shared is False, drivers are kept in a process-wide registry keyed
+    by the normalized uri: asking again for the same uri returns the same
+    driver (and the same connections and open files). Each call should be
+    matched by a close() (or use the driver as a context manager), the driver
+    is really closed after the last one. After os.fork() the child process
+    starts with an empty registry, and the shared drivers it inherited raise
+    RuntimeError when used.
     """
-    uri = urlparse(uri_txt)
+    uri = urlparse(uri_txt, default_scheme)
 
     cls = REGISTERED_DRIVERS[uri.scheme]
 
-    return cls.from_uri(uri)
+    if not shared:
+        return cls.from_uri(uri)
+
+    key = normalize_uri(uri)
+    with _shared_lock:
+        driver = _SHARED_DRIVERS.get(key)
+        if driver is None:
+            driver = cls.from_uri(uri)
+            driver._registry_key = key
+            driver._registry_pid = os.getpid()
+            _SHARED_DRIVERS[key] = driver
+        driver._refcount += 1
+
+    return driver
@@ -1,8 +1,13 @@
 """This drivers use only built in objects"""
 
-from urllib.parse import unquote
+from urllib.parse import unquote, parse_qs
 
-from .base import Driver, UriDriver, new_driver
+import collections
+import itertools
+import threading
+
+from .base import Driver, UriDriver, new_driver, _MISSING, _lookup, \
+                  projection_paths, project, reference_targets
 
 __author__ = [  "Juan Carrano <jc@eiwa.ag>",
                 "Federico M. Pomar <fp@eiwa.ag>"
@@ -11,70 +16,772 @@ __copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
 __license__ = """Unauthorized copying of this file, via any medium is
                  strictly prohibited. Proprietary and confidential"""
 
+def compile_query(query=None):
+    """Turn a query (a dictionary mapping dotted paths to values) into a
+    function that takes an object and tells whether it matches. Paths are
+    split once, instead of once per object.
+    """
+    conditions = [(tuple(k.split('.')), v) for k, v in (query or {}).items()]
+
+    def match(obj):
+        for fields, v in conditions:
+            if _lookup(obj, fields) != v:
+                return False
+        return True
+
+    return match
+
+def _index_key(v):
+    """Make a hashable version of a value, so that it can be used in an index."""
+    if isinstance(v, dict):
+        return frozenset((k, _index_key(x)) for k, x in v.items())
+    if isinstance(v, (list, tuple)):
+        return tuple(_index_key(x) for x in v)
+    return v
+
+class _HashIndex:
+    """Map the values found at a dotted path to the names of the objects
+    that have them."""
+
+    def __init__(self, path):
+        self.fields = tuple(path.split('.'))
+        self.names = {}
+
+    def add(self, name, obj):
+        v = _lookup(obj, self.fields)
+        if v is not _MISSING:
+            self.names.setdefault(_index_key(v), set()).add(name)
+
+    def discard(self, name, obj):
+        v = _lookup(obj, self.fields)
+        if v is not _MISSING:
+            key = _index_key(v)
+            names = self.names.get(key)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.names[key]
+
+    def lookup(self, value):
+        return self.names.get(_index_key(value), ())
+
 class DictionaryDriver(Driver):
-    def __init__(self, dictionary=None):
+    """Keep everything in a dictionary of sections, each one a dictionary
+    mapping names to items.
+
+    Equality queries on the dotted paths given in `indexes` ({section: [path,
+    ...]}, see create_index) are answered with hash indexes instead of a scan
+    of the section. Indexes are kept up to date by setitem/update, so the
+    dictionary `d` should not be modified directly.
+
+    The first call to referrers() builds a reverse index of the references
+    held by the items, which setitem/update/delitem then keep up to date.
+    """
+    def __init__(self, dictionary=None, indexes=None):
         dictionary = dictionary or {}
         self.d = dict(dictionary)
+        self._indexes = {}
+        # target name -> set of (section, name), None until first needed.
+        self._referrers = None
+        for section_name, paths in (indexes or {}).items():
+            self.create_index(section_name, paths)
+
+    def create_index(self, section_name, paths):
+        """Index the given dotted paths of a section."""
+        section = self.d.setdefault(section_name, {})
+        section_indexes = self._indexes.setdefault(section_name, {})
+        for path in paths:
+            if path not in section_indexes:
+                index = _HashIndex(path)
+                for name, obj in section.items():
+                    index.add(name, obj)
+                section_indexes[path] = index
+
+    def sections(self):
+        return [section for section, items in self.d.items() if items]
+
+    def ensure_indexes(self, section_name, paths):
+        if paths:
+            self.create_index(section_name, paths)
 
     def getitem(self, k):
         section_name, name = k
         section = self.d.setdefault(section_name, {})
         return section[name]
 
+    def getitems(self, keys):
+        items = {}
+        for k in keys:
+            section_name, name = k
+            section = self.d.get(section_name, {})
+            if name in section:
+                items[k] = section[name]
+        return items
+
     def setitem(self, k, v):
         section_name, name = k
         section = self.d.setdefault(section_name, {})
+        section_indexes = self._indexes.get(section_name)
+        if section_indexes:
+            old = section.get(name, _MISSING)
+            for index in section_indexes.values():
+                if old is not _MISSING:
+                    index.discard(name, old)
+                index.add(name, v)
+        if self._referrers is not None:
+            self._track(k, section.get(name), v)
         section[name] = v
 
+    def delitem(self, k):
+        section_name, name = k
+        section = self.d.get(section_name, {})
+        if name not in section:
+            raise KeyError(k)
+        old = section.pop(name)
+        for index in self._indexes.get(section_name, {}).values():
+            index.discard(name, old)
+        if self._referrers is not None:
+            self._track(k, old, None)
+
+    def _track(self, k, old, new):
+        """Update the reverse index for the item k changing from old to new
+        (None for a new or deleted item)."""
+        old_targets = reference_targets(old) if old is not None else set()
+        new_targets = reference_targets(new) if new is not None else set()
+        for target in old_targets - new_targets:
+            keys = self._referrers.get(target)
+            if keys is not None:
+                keys.discard(k)
+                if not keys:
+                    del self._referrers[target]
+        for target in new_targets - old_targets:
+            self._referrers.setdefault(target, set()).add(k)
+
+    def referrers(self, target_name):
+        if self._referrers is None:
+            self._referrers = {}
+            for section_name, section in self.d.items():
+                for name, v in section.items():
+                    self._track((section_name, name), None, v)
+        return list(self._referrers.get(target_name, ()))
+
+    def _candidates(self, section_name, query):
+        """Return the names that may match the query according to the
+        indexes, or None if no index can be used."""
+        section_indexes = self._indexes.get(section_name)
+        if not section_indexes or not query:
+            return None
+        try:
+            found = [section_indexes[path].lookup(v) for path, v in query.items()
+                        if path in section_indexes]
+        except TypeError:
+            # unhashable value in the query
+            return None
+        if not found:
+            return None
+        return list(min(found, key=len))
+
     def query_names(self, query_section_name, query=None):
         section = self.d.setdefault(query_section_name, {})
-        return [name for name, obj in section.items()
-                        if self._dict_match(obj, query)]
+        match = compile_query(query)
+        candidates = self._candidates(query_section_name, query)
+        if candidates is None:
+            return [name for name, obj in section.items() if match(obj)]
+        return [name for name in candidates if match(section[name])]
+
+    def query_elements(self, section_name, projection, query=None, limit=None,
+                       skip=0, batch_size=None):
+        """See Driver.query_elements. batch_size is ignored."""
+        section = self.d.setdefault(section_name, {})
+        match = compile_query(query)
+        paths = [tuple(p.split('.')) for p in projection_paths(projection)]
+        candidates = self._candidates(section_name, query)
+        # Take a snapshot of the section, so that it can be modified while the
+        # caller iterates.
+        if candidates is None:
+            objs = list(section.values())
+        else:
+            objs = [section[name] for name in candidates]
+        matching = itertools.islice((obj for obj in objs if match(obj)), skip,
+                                    None if limit is None else skip + limit)
+        return (project(obj, paths) for obj in matching)
 
     @staticmethod
     def _dict_match(obj, query=None):
-        query = {} if query is None else query
-        for k, v in query.items():
-            k_fields = k.split('.')
-            o_value = obj
-            for field in k_fields:
-                try:
-                    o_value = o_value[field]
-                except KeyError:
-                    return False
-            if o_value != v:
-                return False
-        return True
+        return compile_query(query)(obj)
+
+def _frozen(*args):
+    raise TypeError("Documents returned by the driver cannot be modified, "
+                    "copy them first")
+
+class FrozenDict(dict):
+    """dict that cannot be modified. copy() returns a regular dict, and
+    pickling or deep-copying yields regular containers."""
+    __slots__ = ()
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = \
+        __ior__ = _frozen
+
+    def __reduce_ex__(self, protocol):
+        return (dict, (dict(self),))
+
+class FrozenList(list):
+    """list that cannot be modified, see FrozenDict."""
+    __slots__ = ()
+    __setitem__ = __delitem__ = append = extend = insert = remove = pop = \
+        clear = sort = reverse = __iadd__ = __imul__ = _frozen
+
+    def __reduce_ex__(self, protocol):
+        return (list, (list(self),))
+
+def freeze(v):
+    """Return an immutable deep copy of a document made of dicts, lists and
+    scalars."""
+    if isinstance(v, dict):
+        if type(v) is FrozenDict:
+            return v
+        return FrozenDict((k, freeze(x)) for k, x in v.items())
+    if isinstance(v, (list, tuple)):
+        if type(v) is FrozenList:
+            return v
+        return FrozenList(freeze(x) for x in v)
+    return v
+
+def thaw(v):
+    """Return a modifiable deep copy of a frozen document (see freeze).
+    Anything else is returned as it is."""
+    t = type(v)
+    if t is FrozenDict:
+        return {k: thaw(x) for k, x in v.items()}
+    if t is FrozenList:
+        return [thaw(x) for x in v]
+    return v
+
+class _Buckets:
+    """Immutable hash map, as a trie of buckets: a modified version is made
+    by copying only the path to the buckets that change.
+
+    The root has a fixed number of slots, inner nodes have FANOUT. A slot
+    holds None, a bucket (dict) or an inner node (list). A bucket with more
+    than MAX_LOAD entries is split into an inner node, indexed by the next
+    bits of the hash, so buckets stay small and the cost of a change grows
+    only with the depth of the trie (logarithmically with the size).
+    Nothing reachable from a published map is ever modified.
+    """
+    __slots__ = ('root', 'size')
+
+    FANOUT = 32
+    FANOUT_BITS = 5
+    MAX_LOAD = 16
+    # Beyond this the hash bits are used up: buckets just grow.
+    MAX_DEPTH = 12
+
+    def __init__(self, root, size):
+        self.root = root
+        self.size = size
+
+    @classmethod
+    def empty(cls, n):
+        return cls([None] * n, 0)
+
+    @classmethod
+    def _slot(cls, h, depth, n):
+        if not depth:
+            return h % n
+        return (h // n >> cls.FANOUT_BITS * (depth - 1)) & (cls.FANOUT - 1)
+
+    def get(self, key, default=None):
+        h = hash(key)
+        node = self.root
+        n = len(node)
+        depth = 0
+        while True:
+            child = node[self._slot(h, depth, n)]
+            if child is None:
+                return default
+            if type(child) is dict:
+                return child.get(key, default)
+            node = child
+            depth += 1
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (key for key, value in self.items())
+
+    def items(self):
+        stack = [self.root]
+        while stack:
+            for child in stack.pop():
+                if child is None:
+                    continue
+                if type(child) is dict:
+                    yield from child.items()
+                else:
+                    stack.append(child)
+
+    def _split(self, bucket, depth, n, fresh):
+        """Turn an overfull bucket at depth into an inner node."""
+        node = [None] * self.FANOUT
+        fresh[id(node)] = node
+        for key, value in bucket.items():
+            i = self._slot(hash(key), depth, n)
+            if node[i] is None:
+                node[i] = {}
+                fresh[id(node[i])] = node[i]
+            node[i][key] = value
+        if depth < self.MAX_DEPTH:
+            for i, child in enumerate(node):
+                if child is not None and len(child) > self.MAX_LOAD:
+                    node[i] = self._split(child, depth + 1, n, fresh)
+        return node
+
+    def evolve(self, changes):
+        """Return a new map with changes (a dict) applied. A value of
+        _MISSING removes the key."""
+        root = list(self.root)
+        n = len(root)
+        size = self.size
+        # Nodes and buckets created by this call, which can be modified
+        # in place (id -> object, to keep the ids valid).
+        fresh = {id(root): root}
+        for key, value in changes.items():
+            h = hash(key)
+            parent = root
+            depth = 0
+            while True:
+                i = self._slot(h, depth, n)
+                child = parent[i]
+                if child is None:
+                    if value is _MISSING:
+                        break
+                    child = parent[i] = {}
+                    fresh[id(child)] = child
+                elif id(child) not in fresh:
+                    child = parent[i] = type(child)(child)
+                    fresh[id(child)] = child
+                if type(child) is not dict:
+                    parent = child
+                    depth += 1
+                    continue
+                if value is _MISSING:
+                    if child.pop(key, _MISSING) is not _MISSING:
+                        size -= 1
+                else:
+                    if key not in child:
+                        size += 1
+                    child[key] = value
+                    if len(child) > self.MAX_LOAD and depth < self.MAX_DEPTH:
+                        parent[i] = self._split(child, depth + 1, n, fresh)
+                break
+        return _Buckets(root, size)
+
+# Slots at the root of the set of names of each indexed value.
+_NAME_SET_SLOTS = 8
+
+def _name_set(names):
+    """Immutable set of names (a _Buckets mapping them to True)."""
+    return _Buckets.empty(_NAME_SET_SLOTS).evolve(dict.fromkeys(names, True))
+
+_NO_NAMES = _name_set(())
+
+class _Section:
+    """Immutable state of a section: items and indexes."""
+    __slots__ = ('items', 'indexes')
+
+    def __init__(self, items, indexes):
+        self.items = items
+        # path -> (fields, _Buckets mapping _index_key(value) -> _name_set)
+        self.indexes = indexes
+
+class ConcurrentDictionaryDriver(Driver):
+    """In-memory driver that can be shared by threads.
+
+    Each section is an immutable snapshot. Readers fetch the current
+    snapshot without taking any lock and are never blocked by writers;
+    queries iterate over the snapshot taken when they started, so they
+    never see a half-applied update. Writers are serialized by a lock and
+    publish new snapshots. To keep writes cheap, sections (and indexes) are
+    tries of small buckets and a write copies only the paths it touches.
+    Several items written with one update() call are published at once.
+
+    Documents are frozen (turned into FrozenDict and FrozenList, which
+    cannot be modified) when written, so the ones returned by reads are
+    shared without copying. Value fields (see nostradamus.fields) thaw what
+    they read; hand-written from_dict methods that keep a list or
+    dictionary from the document and modify it later must copy it (see
+    thaw).
+
+    indexes: see DictionaryDriver.
+    buckets: number of slots at the root of each section and index (see
+        _Buckets).
+    """
+    def __init__(self, dictionary=None, indexes=None, buckets=64):
+        self._n_buckets = buckets
+        self._lock = threading.Lock()
+        self._sections = {}
+        if dictionary:
+            self.update(((section_name, name), v)
+                        for section_name, section in dictionary.items()
+                        for name, v in section.items())
+        for section_name, paths in (indexes or {}).items():
+            self.create_index(section_name, paths)
+
+    def _section(self, section_name):
+        section = self._sections.get(section_name)
+        if section is None:
+            return _Section(_Buckets.empty(self._n_buckets), {})
+        return section
+
+    def _publish(self, sections):
+        """Install new section snapshots (called with the lock held)."""
+        published = dict(self._sections)
+        published.update(sections)
+        self._sections = published
+
+    def create_index(self, section_name, paths):
+        """Index the given dotted paths of a section."""
+        with self._lock:
+            section = self._section(section_name)
+            indexes = dict(section.indexes)
+            for path in paths:
+                if path in indexes:
+                    continue
+                fields = tuple(path.split('.'))
+                names = {}
+                for name, obj in section.items.items():
+                    v = _lookup(obj, fields)
+                    if v is not _MISSING:
+                        names.setdefault(_index_key(v), set()).add(name)
+                index = _Buckets.empty(self._n_buckets).evolve(
+                            {key: _name_set(n) for key, n in names.items()})
+                indexes[path] = (fields, index)
+            self._publish({section_name: _Section(section.items, indexes)})
+
+    def ensure_indexes(self, section_name, paths):
+        section = self._sections.get(section_name)
+        known = section.indexes if section is not None else {}
+        missing = [path for path in paths if path not in known]
+        if missing:
+            self.create_index(section_name, missing)
+
+    def sections(self):
+        return [name for name, section in self._sections.items()
+                    if section.items.size]
+
+    def snapshot(self):
+        """Return the contents as {section: {name: item}}, as of now."""
+        return {section_name: dict(section.items.items())
+                    for section_name, section in self._sections.items()
+                    if section.items.size}
+
+    def getitem(self, k):
+        section_name, name = k
+        section = self._sections.get(section_name)
+        if section is not None:
+            v = section.items.get(name, _MISSING)
+            if v is not _MISSING:
+                return v
+        raise KeyError(k)
+
+    def getitems(self, keys):
+        sections = self._sections
+        items = {}
+        for k in keys:
+            section_name, name = k
+            section = sections.get(section_name)
+            if section is not None:
+                v = section.items.get(name, _MISSING)
+                if v is not _MISSING:
+                    items[k] = v
+        return items
+
+    def setitem(self, k, v):
+        self.update([(k, v)])
+
+    def update(self, items):
+        """Write all the items, and make them visible to readers at once."""
+        changes = collections.defaultdict(dict)
+        for (section_name, name), v in items:
+            changes[section_name][name] = freeze(v)
+
+        with self._lock:
+            self._apply(changes)
+
+    def delitem(self, k):
+        section_name, name = k
+        with self._lock:
+            section = self._sections.get(section_name)
+            if section is None or section.items.get(name, _MISSING) is _MISSING:
+                raise KeyError(k)
+            self._apply({section_name: {name: _MISSING}})
+
+    def delitems(self, keys):
+        """Remove the items, and make the removal visible to readers at once."""
+        changes = collections.defaultdict(dict)
+        for section_name, name in keys:
+            changes[section_name][name] = _MISSING
+        with self._lock:
+            self._apply(changes)
+
+    def _apply(self, changes):
+        """Publish the sections with changes ({section: {name: item}}, an
+        item of _MISSING removes it) applied. Called with the lock held."""
+        new_sections = {}
+        for section_name, section_changes in changes.items():
+            section = self._section(section_name)
+            indexes = {}
+            for path, (fields, index) in section.indexes.items():
+                indexes[path] = (fields, self._reindex(index, fields,
+                                                       section.items,
+                                                       section_changes))
+            new_sections[section_name] = _Section(
+                section.items.evolve(section_changes), indexes)
+        self._publish(new_sections)
+
+    @staticmethod
+    def _reindex(index, fields, items, changes):
+        """Return index updated for the items in changes."""
+        removed = collections.defaultdict(set)
+        added = collections.defaultdict(set)
+        for name, v in changes.items():
+            old = items.get(name, _MISSING)
+            if old is not _MISSING:
+                old_v = _lookup(old, fields)
+                if old_v is not _MISSING:
+                    removed[_index_key(old_v)].add(name)
+            new_v = _lookup(v, fields)
+            if new_v is not _MISSING:
+                added[_index_key(new_v)].add(name)
+
+        index_changes = {}
+        for key in set(removed) | set(added):
+            names_changes = dict.fromkeys(removed.get(key, ()), _MISSING)
+            names_changes.update(dict.fromkeys(added.get(key, ()), True))
+            names = index.get(key, _NO_NAMES).evolve(names_changes)
+            index_changes[key] = names if names.size else _MISSING
+        return index.evolve(index_changes)
+
+    def _candidates(self, section, query):
+        """See DictionaryDriver._candidates"""
+        if not section.indexes or not query:
+            return None
+        try:
+            found = [section.indexes[path][1].get(_index_key(v), _NO_NAMES)
+                        for path, v in query.items() if path in section.indexes]
+        except TypeError:
+            return None
+        if not found:
+            return None
+        return min(found, key=len)
+
+    def _matching(self, section_name, query):
+        """Iterate over the items of the current snapshot matching query."""
+        section = self._sections.get(section_name)
+        if section is None:
+            return iter(())
+        match = compile_query(query)
+        candidates = self._candidates(section, query)
+        if candidates is None:
+            pairs = section.items.items()
+        else:
+            pairs = ((name, section.items.get(name)) for name in candidates)
+        return ((name, obj) for name, obj in pairs if match(obj))
+
+    def query_names(self, query_section_name, query=None):
+        return [name for name, obj in self._matching(query_section_name, query)]
+
+    def query_elements(self, section_name, projection, query=None, limit=None,
+                       skip=0, batch_size=None):
+        """See Driver.query_elements. The results come from the snapshot
+        taken when this is called. batch_size is ignored."""
+        paths = [tuple(p.split('.')) for p in projection_paths(projection)]
+        matching = itertools.islice(self._matching(section_name, query), skip,
+                                    None if limit is None else skip + limit)
+        return (project(obj, paths) for name, obj in matching)
+
+class _BoundedSet:
+    """Set that forgets the least recently added elements once it holds more
+    than maxsize."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._elements = collections.OrderedDict()
+
+    def __contains__(self, x):
+        return x in self._elements
+
+    def __len__(self):
+        return len(self._elements)
+
+    def add(self, x):
+        self._elements[x] = None
+        self._elements.move_to_end(x)
+        if len(self._elements) > self.maxsize:
+            self._elements.popitem(last=False)
+
+    def discard(self, x):
+        self._elements.pop(x, None)
+
+    def clear(self):
+        self._elements.clear()
 
 class ChainDriver(UriDriver):
+    """Look items up in a list of drivers, in order. Writes go to the first
+    driver.
+
+    negative_cache_size: if not zero, remember up to this many keys known to
+        be absent from each driver, so that they are not looked up there
+        again. The cache of the first driver is updated by writes done
+        through the chain; writes done to the drivers directly are not
+        seen.
+    read_through: copy items found in a later driver into the first one.
+
+    In a URI these options go in the query string, e.g.
+    chain:///file%3A%2F%2F%2Fcache.yaml/mongodb%3A%2F%2Fhost%2Fdb?read_through=1
+    """
     URI_SCHEMES = ['chain']
 
-    def __init__(self, drivers):
+    def __init__(self, drivers, negative_cache_size=0, read_through=False):
         self.drivers = drivers
+        self.read_through = read_through
+        self._absent = [_BoundedSet(negative_cache_size) if negative_cache_size
+                            else None
+                        for driver in drivers]
 
     @classmethod
     def from_uri(cls, uri):
         sub_driver_uris = [unquote(s) for s in uri.path.split("/") if s]
         sub_drivers = [new_driver(u) for u in sub_driver_uris]
-        return cls(sub_drivers)
+        options = parse_qs(uri.query)
+        negative_cache_size = int(options.get('negative_cache_size', ['0'])[-1])
+        read_through = options.get('read_through', ['0'])[-1] not in ('0', 'false', '')
+        return cls(sub_drivers, negative_cache_size=negative_cache_size,
+                   read_through=read_through)
 
     def __repr__(self):
         return "{}({!r})".format(type(self).__name__, self.drivers)
 
-    def getitem(self, k):
+    def _close(self):
+        """The chain owns its drivers: close them all."""
         for driver in self.drivers:
+            driver.close()
+
+    def clear_negative_cache(self):
+        """Forget which keys are known to be absent, e.g. after the drivers
+        were written directly."""
+        for absent in self._absent:
+            if absent is not None:
+                absent.clear()
+
+    def ensure_indexes(self, section, paths):
+        for driver in self.drivers:
+            driver.ensure_indexes(section, paths)
+
+    def _promote(self, items):
+        """Copy items (a dictionary) found in a later driver into the first."""
+        self.drivers[0].update(items.items())
+        absent = self._absent[0]
+        if absent is not None:
+            for k in items:
+                absent.discard(k)
+
+    def getitem(self, k):
+        for i, (driver, absent) in enumerate(zip(self.drivers, self._absent)):
+            if absent is not None and k in absent:
+                continue
             try:
-                return driver.getitem(k)
+                v = driver.getitem(k)
             except KeyError:
-                pass
+                if absent is not None:
+                    absent.add(k)
+                continue
+            if i and self.read_through:
+                self._promote({k: v})
+            return v
         raise KeyError(k)
 
+    def getitems(self, keys):
+        missing = set(keys)
+        items = {}
+        for i, (driver, absent) in enumerate(zip(self.drivers, self._absent)):
+            if not missing:
+                break
+            if absent is not None:
+                wanted = [k for k in missing if k not in absent]
+            else:
+                wanted = missing
+            found = driver.getitems(wanted)
+            if absent is not None:
+                for k in wanted:
+                    if k not in found:
+                        absent.add(k)
+            if i and found and self.read_through:
+                self._promote(found)
+            items.update(found)
+            missing.difference_update(found)
+        return items
+
+    def _written(self, items):
+        """Pass items through, forgetting that their keys were absent from
+        the first driver."""
+        absent = self._absent[0]
+        for k, v in items:
+            absent.discard(k)
+            yield k, v
+
     def setitem(self, k, v):
         self.drivers[0].setitem(k, v)
+        if self._absent[0] is not None:
+            self._absent[0].discard(k)
 
     def update(self, items):
+        if self._absent[0] is not None:
+            items = self._written(items)
         self.drivers[0].update(items)
 
+    def patch(self, items):
+        if self._absent[0] is not None:
+            items = self._written(items)
+        self.drivers[0].patch(items)
+
+    def delitem(self, k):
+        """Remove the item from every driver. Raise KeyError if none had it."""
+        found = False
+        for driver in self.drivers:
+            try:
+                driver.delitem(k)
+                found = True
+            except KeyError:
+                pass
+        for absent in self._absent:
+            if absent is not None:
+                absent.add(k)
+        if not found:
+            raise KeyError(k)
+
+    def delitems(self, keys):
+        keys = list(keys)
+        for driver in self.drivers:
+            driver.delitems(keys)
+        for absent in self._absent:
+            if absent is not None:
+                for k in keys:
+                    absent.add(k)
+
+    def referrers(self, target_name):
+        referrers = collections.OrderedDict()
+        for driver in self.drivers:
+            for k in driver.referrers(target_name):
+                referrers[k] = None
+        return list(referrers)
+
+    def sections(self):
+        sections = []
+        for driver in self.drivers:
+            sections.extend(s for s in driver.sections() if s not in sections)
+        return sections
+
     def query_names(self, cls, query=None):
         return set([name for driver in self.drivers
                              for name in driver.query_names(cls, query)])
@@ -0,0 +1,250 @@
+"""File tree backend: one JSON file per item.
+
+The item (section, name) is stored in
+
+    root/<section>/<h1>/.../<name>.json
+
+where h1... are the first bytes (in hex) of the MD5 of the name, one
+directory level per byte, so that big sections do not end up with huge
+directories. Section and item names are percent-encoded.
+
+Files are written to a temporary file in the same directory and renamed
+over the old one, so readers (in this or another process) always see a
+whole document. Concurrent writers of the same item do not corrupt it: the
+last rename wins.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import uuid
+from urllib.parse import quote, unquote, parse_qs
+
+from .base import UriDriver, BulkUpdateError, WriteFailure
+from .built_in import compile_query
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+_SUFFIX = '.json'
+_TMP_PREFIX = '.tmp-'
+
+def _encode(name):
+    """File name for a section or item name. Leading dots are encoded so
+    that names never collide with '.', '..' or temporary files."""
+    encoded = quote(name, safe='')
+    if encoded.startswith('.'):
+        encoded = '%2E' + encoded[1:]
+    return encoded
+
+class DirectoryDriver(UriDriver):
+    URI_SCHEMES = ['dir']
+
+    def __init__(self, root, shard_levels=1, cache_size=1024, max_workers=8,
+                 fsync=False):
+        """root: directory holding the sections, created if needed.
+        shard_levels: number of hashed directory levels inside each section
+            (256 directories per level). 0 puts all files directly in the
+            section directory.
+        cache_size: number of files whose contents are kept in memory. A
+            cached file is used only while it keeps the same mtime, size and
+            inode, so changes made by other processes are seen. Every read
+            decodes the contents again, so the documents returned can be
+            modified freely.
+        max_workers: threads used by update() to write files.
+        fsync: call os.fsync on each file before renaming it.
+        """
+        self.root = root
+        self.shard_levels = shard_levels
+        self.cache_size = cache_size
+        self.max_workers = max_workers
+        self.fsync = fsync
+
+        os.makedirs(root, exist_ok=True)
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @classmethod
+    def from_uri(cls, uri):
+        options = parse_qs(uri.query)
+        kwargs = {option: int(options[option][-1])
+                    for option in ('shard_levels', 'cache_size', 'max_workers')
+                    if option in options}
+        if 'fsync' in options:
+            kwargs['fsync'] = options['fsync'][-1] not in ('0', 'false', '')
+        return cls(uri.path, **kwargs)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.root)
+
+    def _close(self):
+        executor = self._executor
+        if executor is not None:
+            executor.shutdown()
+            self._executor = None
+
+    def _section_dir(self, section):
+        return os.path.join(self.root, _encode(section))
+
+    def _path(self, k):
+        section, name = k
+        digest = hashlib.md5(name.encode()).hexdigest()
+        shards = [digest[2*i:2*i + 2] for i in range(self.shard_levels)]
+        return os.path.join(self._section_dir(section), *shards) + os.sep \
+                    + _encode(name) + _SUFFIX
+
+    # Reading
+
+    def _cached(self, k, signature):
+        with self._cache_lock:
+            entry = self._cache.get(k)
+            if entry is None or entry[0] != signature:
+                return None
+            self._cache.move_to_end(k)
+            return entry[1]
+
+    def _remember(self, k, signature, data):
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            self._cache[k] = (signature, data)
+            self._cache.move_to_end(k)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, k):
+        with self._cache_lock:
+            self._cache.pop(k, None)
+
+    def getitem(self, k):
+        path = self._path(k)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._forget(k)
+            raise KeyError(k) from None
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        data = self._cached(k, signature)
+        if data is None:
+            try:
+                with open(path, 'rb') as f:
+                    # The signature of what we actually read (the file may
+                    # have been replaced after the stat).
+                    st = os.fstat(f.fileno())
+                    data = f.read()
+            except FileNotFoundError:
+                raise KeyError(k) from None
+            self._remember(k, (st.st_mtime_ns, st.st_size, st.st_ino), data)
+        return json.loads(data.decode())
+
+    def getitems(self, keys):
+        items = {}
+        for k in keys:
+            try:
+                items[k] = self.getitem(k)
+            except KeyError:
+                pass
+        return items
+
+    # Writing
+
+    def _write(self, k, v):
+        path = self._path(k)
+        directory = os.path.dirname(path)
+        data = json.dumps(v, separators=(',', ':')).encode()
+        os.makedirs(directory, exist_ok=True)
+        # Not tempfile.mkstemp: the file must get the usual permissions.
+        tmp_path = os.path.join(directory, _TMP_PREFIX + uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'xb') as f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
+            self._forget(k)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+            return self._executor
+
+    def setitem(self, k, v):
+        self._write(k, v)
+
+    def update(self, items):
+        """Write the files from a thread pool. Items that cannot be written
+        are reported in a BulkUpdateError once the others are written."""
+        items = list(items)
+        failures = []
+        if len(items) <= 1 or self.max_workers <= 1:
+            for k, v in items:
+                try:
+                    self._write(k, v)
+                except OSError as e:
+                    failures.append(WriteFailure(k, e.errno, str(e)))
+        else:
+            executor = self._get_executor()
+            futures = [(k, executor.submit(self._write, k, v)) for k, v in items]
+            for k, future in futures:
+                e = future.exception()
+                if e is not None:
+                    if not isinstance(e, OSError):
+                        raise e
+                    failures.append(WriteFailure(k, e.errno, str(e)))
+        if failures:
+            raise BulkUpdateError(failures)
+
+    def delitem(self, k):
+        try:
+            os.unlink(self._path(k))
+        except FileNotFoundError:
+            raise KeyError(k) from None
+        finally:
+            self._forget(k)
+
+    # Listing
+
+    def sections(self):
+        return [unquote(entry.name) for entry in os.scandir(self.root)
+                    if entry.is_dir() and not entry.name.startswith('.')]
+
+    def _names(self, section):
+        """Names in a section, from the directory listing."""
+        for dirpath, dirnames, filenames in os.walk(self._section_dir(section)):
+            for filename in filenames:
+                if filename.endswith(_SUFFIX) and not filename.startswith('.'):
+                    yield unquote(filename[:-len(_SUFFIX)])
+
+    def query_names(self, section, query=None):
+        """Without a query, the names come from the directory listing and no
+        document is read."""
+        if not query:
+            return list(self._names(section))
+        match = compile_query(query)
+        names = []
+        for name in self._names(section):
+            try:
+                doc = self.getitem((section, name))
+            except KeyError:
+                continue
+            if match(doc):
+                names.append(name)
+        return names
@@ -0,0 +1,161 @@
+"""Driver wrapper that records metrics (see nostradamus.metrics)."""
+
+import collections.abc
+import time
+
+from .base import Driver
+from ..metrics import DriverMetrics
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+class InstrumentedDriver(Driver):
+    """Forward every call to driver, recording calls, latency and the
+    documents read and written per section in metrics (a DriverMetrics,
+    which can be shared by many drivers).
+
+    query_names/query_elements return what the driver returns. When that is
+    an iterator, it is wrapped so that the latency includes the time spent
+    fetching the results, and is recorded once the iteration ends. Methods
+    not defined by Driver (e.g. transaction) are forwarded without being
+    recorded.
+
+        driver = InstrumentedDriver(MongoDriver(db))
+        ...
+        driver.metrics.snapshot()
+    """
+    def __init__(self, driver, metrics=None):
+        self.driver = driver
+        self.metrics = metrics if metrics is not None else DriverMetrics()
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.driver)
+
+    def __getattr__(self, attr):
+        return getattr(self.driver, attr)
+
+    def _call(self, method, *args):
+        t0 = time.perf_counter()
+        error = True
+        try:
+            result = getattr(self.driver, method)(*args)
+            error = False
+            return result
+        except KeyError:
+            # Not found is an answer, not a failure.
+            error = False
+            raise
+        finally:
+            self.metrics.record_call(method, time.perf_counter() - t0, error)
+
+    def _query(self, method, section, *args, **kwargs):
+        """Call a query method. A collection (e.g. a list) is returned as it
+        is, an iterator is wrapped by _iterate."""
+        t0 = time.perf_counter()
+        try:
+            result = getattr(self.driver, method)(section, *args, **kwargs)
+        except Exception:
+            self.metrics.record_call(method, time.perf_counter() - t0, True)
+            raise
+        elapsed = time.perf_counter() - t0
+        if isinstance(result, collections.abc.Iterator):
+            return self._iterate(method, section, result, elapsed)
+        self.metrics.record_call(method, elapsed)
+        self.metrics.record_count(section, 'queried', len(result))
+        return result
+
+    def _iterate(self, method, section, iterator, elapsed):
+        """Yield from iterator, and record the call (which took elapsed
+        seconds before returning it) once the iteration ends."""
+        metrics = self.metrics
+        n = 0
+        error = True
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    element = next(iterator)
+                except StopIteration:
+                    elapsed += time.perf_counter() - t0
+                    break
+                elapsed += time.perf_counter() - t0
+                n += 1
+                yield element
+            error = False
+        finally:
+            metrics.record_call(method, elapsed, error)
+            metrics.record_count(section, 'queried', n)
+
+    def getitem(self, k):
+        try:
+            v = self._call('getitem', k)
+        except KeyError:
+            self.metrics.record_count(k[0], 'misses')
+            raise
+        self.metrics.record_documents(k[0], 'read', [v])
+        return v
+
+    def getitems(self, keys):
+        keys = list(keys)
+        items = self._call('getitems', keys)
+        self._record_items('read', items.items())
+        if len(items) < len(keys):
+            for section, name in keys:
+                if (section, name) not in items:
+                    self.metrics.record_count(section, 'misses')
+        return items
+
+    def _record_items(self, kind, items):
+        by_section = {}
+        for (section, name), v in items:
+            by_section.setdefault(section, []).append(v)
+        for section, docs in by_section.items():
+            self.metrics.record_documents(section, kind, docs)
+
+    def setitem(self, k, v):
+        self._call('setitem', k, v)
+        self.metrics.record_documents(k[0], 'written', [v])
+
+    def update(self, items):
+        items = list(items)
+        self._call('update', items)
+        self._record_items('written', items)
+
+    def patch(self, items):
+        items = list(items)
+        self._call('patch', items)
+        self._record_items('written', items)
+
+    def delitem(self, k):
+        self._call('delitem', k)
+        self.metrics.record_count(k[0], 'deleted')
+
+    def delitems(self, keys):
+        keys = list(keys)
+        self._call('delitems', keys)
+        for section, name in keys:
+            self.metrics.record_count(section, 'deleted')
+
+    def referrers(self, target_name):
+        return self._call('referrers', target_name)
+
+    def ensure_indexes(self, section, paths):
+        self._call('ensure_indexes', section, paths)
+
+    def sections(self):
+        return self._call('sections')
+
+    def close(self):
+        self.driver.close()
+
+    def query_names(self, query_section_name, query=None):
+        return self._query('query_names', query_section_name, query)
+
+    def query_elements(self, section, projection, query=None, limit=None, skip=0,
+                       batch_size=None):
+        return self._query('query_elements', section, projection, query,
+                           limit=limit, skip=skip, batch_size=batch_size)
@@ -0,0 +1,296 @@
+"""Append-only, log-structured file backend.
+
+The file is a sequence of records, one per line. Each line is the CRC32 of
+the payload (8 hex digits), a space and the payload, which is JSON. An item
+record is `[section, name, value]` and a deletion record (tombstone) is
+`[section, name]`. A commit record `[n]` closes the batch
+formed by the n item records before it; items are only visible once their
+batch is committed. A write therefore costs O(size of the batch), no matter
+how big the database is.
+
+On open, the file is replayed to build an index of (offset, length) for the
+latest version of each item. Anything after the last good commit record (a
+torn write) is cut off. Old versions of items and tombstones are garbage,
+which is removed by compact(): the live records are copied into a new file that
+replaces the old one, so the next open replays only that snapshot.
+"""
+
+import json
+import os
+import threading
+import zlib
+
+from .base import UriDriver
+from .built_in import compile_query
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+class LogDriver(UriDriver):
+    URI_SCHEMES = ['log']
+
+    def __init__(self, filename, compact_ratio=0.5, compact_min_size=1 << 20,
+                 background_compaction=True, fsync=False):
+        """compact_ratio: compact when this fraction of the file is garbage.
+            None disables automatic compaction.
+        compact_min_size: do not compact automatically files smaller than this
+            (in bytes).
+        background_compaction: compact in a separate thread instead of in the
+            write that crossed the threshold.
+        fsync: call os.fsync after each batch.
+        """
+        self.filename = filename
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.background_compaction = background_compaction
+        self.fsync = fsync
+
+        self._lock = threading.RLock()
+        # Only one compaction at a time; it holds _lock only at the end.
+        self._compact_lock = threading.Lock()
+        self._compaction = None
+        self._file = open(filename, 'a+b')
+        self._load()
+
+    @classmethod
+    def from_uri(cls, uri):
+        return cls(uri.path)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.filename)
+
+    def _close(self):
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+        with self._lock:
+            self._file.close()
+
+    @staticmethod
+    def _encode(record):
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+    @staticmethod
+    def _decode(line):
+        """Return the record in line, or None if it is torn or corrupt."""
+        if len(line) < 10 or line[8:9] != b' ' or not line.endswith(b'\n'):
+            return None
+        payload = line[9:-1]
+        try:
+            if int(line[:8], 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload.decode())
+        except ValueError:
+            return None
+
+    def _load(self):
+        self._index = {}
+        self._live = 0
+        pending = []
+        offset = good = 0
+
+        self._file.seek(0)
+        for line in self._file:
+            record = self._decode(line)
+            if record is None:
+                break
+            if len(record) == 1:
+                if record[0] != len(pending):
+                    break
+                self._apply(pending)
+                pending = []
+                good = offset + len(line)
+            elif len(record) == 2:
+                section, name = record
+                pending.append((section, name, None, len(line)))
+            else:
+                section, name, _ = record
+                pending.append((section, name, offset, len(line)))
+            offset += len(line)
+
+        self._size = self._file.seek(0, os.SEEK_END)
+        if self._size != good:
+            self._file.truncate(good)
+            self._size = good
+
+    def _apply(self, entries):
+        """Point the index to new (section, name, offset, length) entries.
+        An offset of None is a tombstone: the item is removed."""
+        for section, name, offset, length in entries:
+            names = self._index.setdefault(section, {})
+            if offset is None:
+                old = names.pop(name, None)
+            else:
+                old = names.get(name)
+                names[name] = (offset, length)
+                self._live += length
+            if old is not None:
+                self._live -= old[1]
+
+    def _read_record(self, location):
+        offset, length = location
+        self._file.seek(offset)
+        return json.loads(self._file.read(length)[9:-1].decode())
+
+    def garbage_ratio(self):
+        with self._lock:
+            return 1 - self._live / self._size if self._size else 0
+
+    def getitem(self, k):
+        section, name = k
+        with self._lock:
+            try:
+                location = self._index[section][name]
+            except KeyError:
+                raise KeyError(k) from None
+            return self._read_record(location)[2]
+
+    def getitems(self, keys):
+        with self._lock:
+            locations = []
+            for k in keys:
+                section, name = k
+                location = self._index.get(section, {}).get(name)
+                if location is not None:
+                    locations.append((location, k))
+            # Read in file order
+            locations.sort()
+            return {k: self._read_record(location)[2]
+                        for location, k in locations}
+
+    def setitem(self, k, v):
+        self.update([(k, v)])
+
+    def update(self, items):
+        """Append all the items as one batch."""
+        with self._lock:
+            self._append([section, name, v] for (section, name), v in items)
+        self._maybe_compact()
+
+    def delitem(self, k):
+        section, name = k
+        with self._lock:
+            if name not in self._index.get(section, {}):
+                raise KeyError(k)
+            self._append([[section, name]])
+        self._maybe_compact()
+
+    def delitems(self, keys):
+        """Append a tombstone for each existing item, as one batch."""
+        with self._lock:
+            self._append([section, name] for section, name in keys
+                            if name in self._index.get(section, {}))
+        self._maybe_compact()
+
+    def _append(self, records):
+        """Write records as one committed batch and apply them to the index.
+        Called with the lock held."""
+        lines = []
+        entries = []
+        offset = self._size
+        for record in records:
+            line = self._encode(record)
+            lines.append(line)
+            entries.append((record[0], record[1],
+                            offset if len(record) == 3 else None, len(line)))
+            offset += len(line)
+        if not entries:
+            return
+        lines.append(self._encode([len(entries)]))
+
+        data = b''.join(lines)
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+        self._size += len(data)
+        self._apply(entries)
+
+    def sections(self):
+        with self._lock:
+            return [section for section, names in self._index.items() if names]
+
+    def query_names(self, section, query=None):
+        with self._lock:
+            names = self._index.get(section, {})
+            if not query:
+                return list(names)
+            match = compile_query(query)
+            return [name for name, location in names.items()
+                        if match(self._read_record(location)[2])]
+
+    def _maybe_compact(self):
+        if (self.compact_ratio is None or self._size < self.compact_min_size
+                or self.garbage_ratio() < self.compact_ratio):
+            return
+
+        if not self.background_compaction:
+            self.compact()
+        elif self._compaction is None or not self._compaction.is_alive():
+            self._compaction = threading.Thread(target=self.compact, daemon=True)
+            self._compaction.start()
+
+    def compact(self):
+        """Rewrite the file keeping only the latest version of each item that
+        was not deleted.
+
+        The live records are copied from a snapshot of the index without
+        holding the lock, so reads and writes go on meanwhile. The lock is
+        taken at the end to copy the batches appended since the snapshot
+        (as they are) and to swap the files.
+        """
+        tmp_filename = self.filename + '.compact'
+        with self._compact_lock:
+            with self._lock:
+                snapshot = [(section, name, location)
+                                for section, names in self._index.items()
+                                for name, location in names.items()]
+                snapshot_size = self._size
+
+            # Records before snapshot_size never change: the file is only
+            # appended to, and replaced only by a compaction.
+            moved = {}
+            offset = 0
+            with open(self.filename, 'rb') as src, open(tmp_filename, 'wb') as out:
+                for section, name, (old_offset, length) in snapshot:
+                    src.seek(old_offset)
+                    out.write(src.read(length))
+                    moved[old_offset] = offset
+                    offset += length
+                commit = self._encode([len(snapshot)])
+                out.write(commit)
+                offset += len(commit)
+                out.flush()
+                os.fsync(out.fileno())
+
+            with self._lock:
+                with open(tmp_filename, 'ab') as out:
+                    self._file.seek(snapshot_size)
+                    tail = self._file.read(self._size - snapshot_size)
+                    out.write(tail)
+                    out.flush()
+                    os.fsync(out.fileno())
+
+                os.replace(tmp_filename, self.filename)
+                self._file.close()
+                self._file = open(self.filename, 'a+b')
+
+                # Items untouched since the snapshot were moved, the others
+                # are in the tail, shifted by the same amount.
+                shift = offset - snapshot_size
+                self._live = 0
+                for names in self._index.values():
+                    for name, (old_offset, length) in names.items():
+                        if old_offset < snapshot_size:
+                            new_offset = moved[old_offset]
+                        else:
+                            new_offset = old_offset + shift
+                        names[name] = (new_offset, length)
+                        self._live += length
+                self._size = offset + len(tail)
@@ -1,10 +1,16 @@
 """MongoDB backend"""
 
+import os
 import posixpath
+import collections
+import threading
 
-from pymongo import MongoClient
+import bson
+from pymongo import MongoClient, ReplaceOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 
-from .base import UriDriver
+from .base import UriDriver, BulkUpdateError, WriteFailure, projection_paths, \
+                  normalize_uri, reference_targets
 
 __author__ = [  "Juan Carrano <jc@eiwa.ag>",
                 "Federico M. Pomar <fp@eiwa.ag>"
@@ -13,9 +19,93 @@ __copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
 __license__ = """Unauthorized copying of this file, via any medium is
                  strictly prohibited. Proprietary and confidential"""
 
+# Clients shared between drivers for the same server: key -> [client, refcount]
+_CLIENTS = {}
+_clients_lock = threading.Lock()
+
+def _client_key(uri):
+    """Drivers for different databases on the same server share the client,
+    unless the uri has credentials (the database is then the default
+    authentication source)."""
+    if uri.username is None:
+        uri = uri._replace(path='')
+    return normalize_uri(uri)
+
+def _forget_clients_after_fork():
+    """MongoClient is not fork-safe: a forked child needs its own pools."""
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _CLIENTS.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_clients_after_fork)
+
+def _acquire_client(uri):
+    key = _client_key(uri)
+    with _clients_lock:
+        entry = _CLIENTS.get(key)
+        if entry is None:
+            entry = _CLIENTS[key] = [MongoClient(uri.geturl()), 0]
+        entry[1] += 1
+        return key, entry[0]
+
+def _release_client(key, client, pid):
+    """Drop one reference to the client acquired by process pid."""
+    with _clients_lock:
+        if pid != os.getpid():
+            # Acquired by the parent process. The registry may by now hold
+            # this process's own client for the same key, which must not be
+            # released, and closing the parent's client would end its
+            # server sessions: just drop it.
+            return
+        entry = _CLIENTS.get(key)
+        if entry is None or entry[0] is not client:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _CLIENTS[key]
+            entry[0].close()
+
+def _snapshot(v):
+    """Deep copy of an item, to be kept as its last version: the caller's
+    item shares lists and dictionaries with objects that may be modified in
+    place."""
+    return bson.decode(bson.encode(v))
+
+def _diff(old, new, prefix=''):
+    """Compute the $set and $unset operations (dictionaries keyed by dotted
+    paths) that turn the document old into new. Sub-documents are compared
+    field by field, anything else (including lists) is set as a whole.
+    Return None if a key cannot be used in a dotted path.
+    """
+    set_ = {}
+    unset = {}
+    for k, v in new.items():
+        if '.' in k or k.startswith('$'):
+            return None
+        path = prefix + k
+        if k not in old:
+            set_[path] = v
+        elif isinstance(v, dict) and isinstance(old[k], dict) and v:
+            sub = _diff(old[k], v, path + '.')
+            if sub is None:
+                return None
+            set_.update(sub[0])
+            unset.update(sub[1])
+        elif old[k] != v:
+            set_[path] = v
+    for k in old:
+        if k not in new:
+            unset[prefix + k] = ''
+    return set_, unset
+
 class MongoDriver(UriDriver):
     URI_SCHEMES = ["mongodb"]
 
+    # Collection holding the reverse index of references, see
+    # track_references.
+    REFERENCES_COLLECTION = '__references__'
+
     @classmethod
     def from_uri(cls, uri):
         if not posixpath.basename(uri.path):
@@ -23,35 +113,336 @@ class MongoDriver(UriDriver):
 
         dbname = uri.path[1:]
 
-        return cls(MongoClient(uri.geturl())[dbname])
+        client_key, client = _acquire_client(uri)
+        driver = cls(client[dbname])
+        driver._client_key = client_key
+        driver._client_pid = os.getpid()
+        return driver
 
-    def __init__(self, db):
+    def __init__(self, db, batch_size=1000, ordered=False, keep_versions=False,
+                 track_references=False):
+        """batch_size: maximum number of operations sent in each bulk_write,
+            and of names in each query of getitems().
+        ordered: if True, update() stops at the first failed item. Otherwise
+            the server may apply the writes in any order and every item that
+            can be written is written.
+        keep_versions: remember the last version of every item read or
+            written, so that patch() can send only the fields that changed.
+            The versions are copies, so items read or written can be
+            modified freely.
+        track_references: keep, in REFERENCES_COLLECTION, one document
+            {section, name, targets} per item holding references, with an
+            index on targets, so that referrers() is one indexed query. It
+            is written before the items themselves, so it may list stale
+            referrers but never misses one. Items written while this was
+            off are not in it until rebuild_references() is called.
+        """
         self.db = db
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.track_references = track_references
+        self._versions = {} if keep_versions else None
+        self._indexed = set()
+        self._client_key = None
+        self._client_pid = None
+
+    def _close(self):
+        """Release the client if it was created by from_uri. A client passed
+        to the constructor (through db) belongs to the caller."""
+        if self._client_key is not None:
+            _release_client(self._client_key, self.db.client, self._client_pid)
+            self._client_key = None
+
+    def _collection(self, section):
+        """Return the collection for a section, to write to it. The first
+        time, make sure that it has a unique index on the item names.
+        Reads and deletes use self.db[section] directly, so that they work
+        for users that cannot create indexes and on collections holding
+        duplicated names."""
+        if section not in self._indexed:
+            self.db[section].create_index('__ref_name__', unique=True)
+            self._indexed.add(section)
+        return self.db[section]
+
+    def _references(self):
+        collection = self.db[self.REFERENCES_COLLECTION]
+        if self.REFERENCES_COLLECTION not in self._indexed:
+            collection.create_index([('section', 1), ('name', 1)], unique=True)
+            collection.create_index('targets')
+            self._indexed.add(self.REFERENCES_COLLECTION)
+        return collection
+
+    def _track(self, items):
+        """Update the reverse index for items, a list of (key, value), a
+        value of None meaning that the item was deleted."""
+        requests = []
+        for (section, name), v in items:
+            key = {'section': section, 'name': name}
+            targets = reference_targets(v) if v is not None else None
+            if targets:
+                requests.append(ReplaceOne(key, dict(key, targets=sorted(targets)),
+                                           upsert=True))
+            else:
+                requests.append(DeleteOne(key))
+        collection = self._references()
+        for i in range(0, len(requests), self.batch_size):
+            collection.bulk_write(requests[i:i + self.batch_size], ordered=False)
+
+    def rebuild_references(self):
+        """Rebuild the reverse index of references (see track_references)
+        from all the items."""
+        self._references().delete_many({})
+        for section in self.sections():
+            items = []
+            for fetch in self.db[section].find():
+                name, item = self._strip(fetch)
+                if reference_targets(item):
+                    items.append(((section, name), item))
+                    if len(items) >= self.batch_size:
+                        self._track(items)
+                        items = []
+            if items:
+                self._track(items)
+
+    def ensure_indexes(self, section, paths):
+        """Create an index for each dotted path, if it was not done already
+        (and, with the first one, the unique index on the item names)."""
+        for path in paths:
+            if (section, path) not in self._indexed:
+                self._collection(section).create_index(path)
+                self._indexed.add((section, path))
+
+    def forget_versions(self):
+        """Drop the remembered versions, see keep_versions."""
+        if self._versions is not None:
+            self._versions.clear()
 
     def __repr__(self):
         return "{}({!r})".format(type(self).__name__, self.db)
 
+    @staticmethod
+    def _strip(fetch):
+        """Turn a fetched document into an item, return (name, item)"""
+        item = dict(fetch)
+        name = item.pop('__ref_name__')
+        del item['_id']
+        return name, item
+
     def getitem(self, k):
         section, name = k
         fetch = self.db[section].find_one({'__ref_name__': name})
         if fetch is None:
             raise KeyError(k)
-        item = dict(fetch)
-        del item['__ref_name__']
-        del item['_id']
+        item = self._strip(fetch)[1]
+        if self._versions is not None:
+            self._versions[k] = _snapshot(item)
         return item
 
+    def getitems(self, keys):
+        """Fetch many items with one query per section and batch_size names
+        (a single $in could exceed the maximum query size)."""
+        names_by_section = collections.defaultdict(list)
+        for section, name in keys:
+            names_by_section[section].append(name)
+
+        items = {}
+        for section, names in names_by_section.items():
+            for i in range(0, len(names), self.batch_size):
+                cursor = self.db[section].find(
+                            {'__ref_name__': {'$in': names[i:i + self.batch_size]}})
+                for fetch in cursor:
+                    name, item = self._strip(fetch)
+                    items[(section, name)] = item
+        if self._versions is not None:
+            self._versions.update((k, _snapshot(v)) for k, v in items.items())
+        return items
+
     def setitem(self, k, v):
         section, name = k
         item = dict(v)
         item['__ref_name__'] = name
-        self.db[section].replace_one({'__ref_name__': name}, item, upsert=True)
+        if self.track_references:
+            self._track([(k, v)])
+        self._collection(section).replace_one({'__ref_name__': name}, item, upsert=True)
+        if self._versions is not None:
+            self._versions[k] = _snapshot(v)
+
+    def _bulk_write(self, section, names, requests):
+        """Send one batch of requests. Return (failures, applied): a list of
+        WriteFailure and the indexes of the requests the server applied."""
+        try:
+            self._collection(section).bulk_write(requests, ordered=self.ordered)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            concern_errors = e.details.get('writeConcernErrors', [])
+            failures = [WriteFailure((section, names[err['index']]),
+                                     err.get('code'), err.get('errmsg'))
+                            for err in errors]
+            failures.extend(WriteFailure(None, err.get('code'), err.get('errmsg'))
+                            for err in concern_errors)
+            if concern_errors:
+                # Whether the writes are kept is unknown.
+                return failures, []
+            failed = set(err['index'] for err in errors)
+            # An ordered bulk write skips everything after the first error.
+            end = min(failed) if failed and self.ordered else len(requests)
+            return failures, [i for i in range(end) if i not in failed]
+        return [], range(len(requests))
+
+    @staticmethod
+    def _replace_request(name, v, old):
+        item = dict(v)
+        item['__ref_name__'] = name
+        return ReplaceOne({'__ref_name__': name}, item, upsert=True)
+
+    @classmethod
+    def _patch_request(cls, name, v, old):
+        """Return an UpdateOne with the fields that changed from old, or None
+        if nothing changed. Fall back to a ReplaceOne when the old version is
+        unknown or the changes are not smaller than the whole item."""
+        diff = None if old is None else _diff(old, v)
+        if diff is None:
+            return cls._replace_request(name, v, old)
+
+        set_, unset = diff
+        if not set_ and not unset:
+            return None
+
+        operations = {}
+        if set_:
+            operations['$set'] = set_
+        if unset:
+            operations['$unset'] = unset
+        if len(bson.encode(operations)) >= len(bson.encode(v)):
+            return cls._replace_request(name, v, old)
+        return UpdateOne({'__ref_name__': name}, operations)
+
+    def _bulk(self, items, make_request):
+        """Send the requests made by make_request(name, value, old_version)
+        grouped by section, in batches of batch_size. If any item fails,
+        BulkUpdateError is raised after all the batches are sent (or, if
+        ordered is set, right after the failing batch).
+
+        The versions of the items (see keep_versions) are recorded only once
+        the server applied them. The versions of the items of a batch that
+        failed, or that raised any other error, are forgotten.
+        """
+        pending = collections.defaultdict(lambda: ([], [], []))
+        failures = []
+        versions = self._versions
+
+        def flush(section):
+            names, requests, snapshots = pending.pop(section)
+            try:
+                batch_failures, applied = self._bulk_write(section, names,
+                                                           requests)
+            except Exception:
+                if versions is not None:
+                    for name in names:
+                        versions.pop((section, name), None)
+                raise
+            if versions is not None:
+                applied = set(applied)
+                for i, name in enumerate(names):
+                    if i in applied:
+                        versions[(section, name)] = snapshots[i]
+                    else:
+                        versions.pop((section, name), None)
+            failures.extend(batch_failures)
+            return not (failures and self.ordered)
+
+        for (section, name), v in items:
+            old = versions.get((section, name)) if versions is not None else None
+            request = make_request(name, v, old)
+            if request is None:
+                continue
+            names, requests, snapshots = pending[section]
+            names.append(name)
+            requests.append(request)
+            if versions is not None:
+                snapshots.append(_snapshot(v))
+            if len(requests) >= self.batch_size and not flush(section):
+                break
+        else:
+            for section in list(pending):
+                if not flush(section):
+                    break
+
+        if failures:
+            raise BulkUpdateError(failures)
+
+    def update(self, items):
+        """Write items grouped by section, in batches of ReplaceOne operations.
+        See _bulk for error handling."""
+        if self.track_references:
+            items = list(items)
+            self._track(items)
+        self._bulk(items, self._replace_request)
+
+    def patch(self, items):
+        """Like update, but for items whose last version is known (see
+        keep_versions) send only the fields that changed, with $set and
+        $unset. Unchanged items are not sent at all.
+        """
+        if self.track_references:
+            items = list(items)
+            self._track(items)
+        self._bulk(items, self._patch_request)
+
+    def delitem(self, k):
+        section, name = k
+        result = self.db[section].delete_one({'__ref_name__': name})
+        if self._versions is not None:
+            self._versions.pop(k, None)
+        if self.track_references:
+            self._track([(k, None)])
+        if not result.deleted_count:
+            raise KeyError(k)
+
+    def delitems(self, keys):
+        """Delete with one delete_many per section and batch_size names."""
+        keys = list(keys)
+        names_by_section = collections.defaultdict(list)
+        for section, name in keys:
+            names_by_section[section].append(name)
+        for section, names in names_by_section.items():
+            for i in range(0, len(names), self.batch_size):
+                self.db[section].delete_many(
+                    {'__ref_name__': {'$in': names[i:i + self.batch_size]}})
+        if self._versions is not None:
+            for k in keys:
+                self._versions.pop(k, None)
+        if self.track_references:
+            self._track([(k, None) for k in keys])
+
+    def referrers(self, target_name):
+        """One indexed query if track_references is set, otherwise a scan
+        of every section (see Driver.referrers)."""
+        if not self.track_references:
+            return super().referrers(target_name)
+        cursor = self._references().find({'targets': target_name},
+                                         projection=['section', 'name'])
+        return [(d['section'], d['name']) for d in cursor]
+
+    def sections(self):
+        return [name for name in self.db.list_collection_names()
+                    if not name.startswith('system.')
+                        and name != self.REFERENCES_COLLECTION]
 
     def query_names(self, section, query=None):
-        cursor = self.db[section].find(filter=query, projection=['__ref_name__'])
+        cursor = self.db[section].find(filter=query,
+                                       projection=['__ref_name__'])
         return (obj['__ref_name__'] for obj in cursor)
 
-    def query_elements(self, section, projection, query=None):
-        cursor = self.db[section].find(filter=query, projection=projection)
+    def query_elements(self, section, projection, query=None, limit=None,
+                       skip=0, batch_size=None):
+        """See Driver.query_elements. The projection, limit, skip and
+        batch_size are applied by the server."""
+        mongo_projection = {path: 1 for path in projection_paths(projection)}
+        mongo_projection['_id'] = 0
+        cursor = self.db[section].find(filter=query, projection=mongo_projection,
+                                       skip=skip, limit=limit or 0)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
         return cursor
 
@@ -0,0 +1,245 @@
+"""SQLite backend.
+
+All items live in one table, one row per (section, name), with the value
+stored as JSON. Queries use the SQLite JSON functions, and dotted paths can
+be indexed per section with expression indexes.
+"""
+
+import hashlib
+import itertools
+import json
+import sqlite3
+import threading
+
+from .base import UriDriver, projection_paths
+from .built_in import compile_query
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+def _json_path(path):
+    """Turn a dotted path into a SQLite JSON path SQL literal."""
+    fields = ''.join('."{}"'.format(f.replace('"', '\\"')) for f in path.split('.'))
+    return "'${}'".format(fields.replace("'", "''"))
+
+def _value(json_type, value):
+    """json_extract gives 1 and 0 for true and false, turn them back into
+    booleans using json_type."""
+    if json_type == 'true':
+        return True
+    if json_type == 'false':
+        return False
+    return value
+
+def _nest(flat):
+    """Turn {'a.b': 1} into {'a': {'b': 1}}"""
+    nested = {}
+    for path, value in flat.items():
+        fields = path.split('.')
+        d = nested
+        for field in fields[:-1]:
+            d = d.setdefault(field, {})
+        d[fields[-1]] = value
+    return nested
+
+class SQLiteDriver(UriDriver):
+    URI_SCHEMES = ['sqlite']
+
+    # Keep IN lists below SQLITE_MAX_VARIABLE_NUMBER of old SQLite versions.
+    MAX_VARIABLES = 500
+
+    def __init__(self, filename=':memory:', indexes=None):
+        """indexes: dictionary mapping sections to lists of dotted paths. An
+        expression index is created for each of them so that equality queries
+        on that path do not scan the section.
+        """
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._conn:
+            if filename != ':memory:':
+                # Readers do not block the writer, nor the other way round.
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS documents ("
+                               "section TEXT NOT NULL, name TEXT NOT NULL, "
+                               "doc TEXT NOT NULL, "
+                               "PRIMARY KEY (section, name)) WITHOUT ROWID")
+
+        for section, paths in (indexes or {}).items():
+            self.create_index(section, paths)
+
+    @classmethod
+    def from_uri(cls, uri):
+        return cls(uri.path or ':memory:')
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.filename)
+
+    def _close(self):
+        with self._lock:
+            self._conn.close()
+
+    def create_index(self, section, paths):
+        """Index the dotted paths. Indexes cover (section, value) so the same
+        index serves every section that declares the path.
+        """
+        with self._lock, self._conn:
+            for path in paths:
+                index_name = 'ix_' + hashlib.md5(path.encode()).hexdigest()
+                self._conn.execute(
+                    'CREATE INDEX IF NOT EXISTS "{}" ON documents '
+                    '(section, json_extract(doc, {}))'.format(index_name,
+                                                             _json_path(path)))
+
+    def ensure_indexes(self, section, paths):
+        self.create_index(section, paths)
+
+    @staticmethod
+    def _dumps(v):
+        return json.dumps(v, separators=(',', ':'))
+
+    def getitem(self, k):
+        section, name = k
+        with self._lock:
+            row = self._conn.execute("SELECT doc FROM documents "
+                                     "WHERE section = ? AND name = ?",
+                                     (section, name)).fetchone()
+        if row is None:
+            raise KeyError(k)
+        return json.loads(row[0])
+
+    def getitems(self, keys):
+        names_by_section = {}
+        for section, name in keys:
+            names_by_section.setdefault(section, []).append(name)
+
+        items = {}
+        with self._lock:
+            for section, names in names_by_section.items():
+                for i in range(0, len(names), self.MAX_VARIABLES):
+                    chunk = names[i:i + self.MAX_VARIABLES]
+                    rows = self._conn.execute(
+                        "SELECT name, doc FROM documents WHERE section = ? "
+                        "AND name IN ({})".format(','.join('?' * len(chunk))),
+                        [section] + chunk)
+                    for name, doc in rows:
+                        items[(section, name)] = json.loads(doc)
+        return items
+
+    def setitem(self, k, v):
+        self.update([(k, v)])
+
+    def update(self, items):
+        """Write all items in one transaction."""
+        rows = ((section, name, self._dumps(v)) for (section, name), v in items)
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO documents "
+                                   "(section, name, doc) VALUES (?, ?, ?)", rows)
+
+    def delitem(self, k):
+        section, name = k
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM documents "
+                                        "WHERE section = ? AND name = ?",
+                                        (section, name))
+        if not cursor.rowcount:
+            raise KeyError(k)
+
+    def delitems(self, keys):
+        """Delete all the items in one transaction."""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM documents "
+                                   "WHERE section = ? AND name = ?", keys)
+
+    def referrers(self, target_name):
+        """Search the references with json_tree. This reads every document,
+        but inside SQLite, and keeps writes free of any index upkeep."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT d.section, d.name FROM documents AS d, "
+                "json_tree(d.doc) AS t WHERE t.key = 'target_name' "
+                "AND t.atom = ? "
+                "AND json_extract(d.doc, t.path || '._IS_REFERENCE') = 1",
+                (target_name,))
+            return [(section, name) for section, name in rows]
+
+    def _where(self, section, query):
+        """Translate a query into a WHERE clause.
+
+        Return (sql, parameters, residual), residual being the part of the
+        query that must be checked in python (comparisons with lists or
+        dictionaries).
+        """
+        conditions = ["section = ?"]
+        parameters = [section]
+        residual = {}
+        for path, value in (query or {}).items():
+            if isinstance(value, (dict, list)):
+                residual[path] = value
+            elif value is None:
+                conditions.append("json_type(doc, {}) = 'null'".format(_json_path(path)))
+            else:
+                conditions.append("json_extract(doc, {}) = ?".format(_json_path(path)))
+                parameters.append(value)
+        return " AND ".join(conditions), parameters, residual
+
+    def sections(self):
+        with self._lock:
+            return [section for section, in self._conn.execute(
+                        "SELECT DISTINCT section FROM documents")]
+
+    def query_names(self, section, query=None):
+        where, parameters, residual = self._where(section, query)
+        with self._lock:
+            if not residual:
+                rows = self._conn.execute("SELECT name FROM documents WHERE "
+                                          + where, parameters)
+                return [name for name, in rows]
+
+            rows = self._conn.execute("SELECT name, doc FROM documents WHERE "
+                                      + where, parameters).fetchall()
+        match = compile_query(residual)
+        return [name for name, doc in rows if match(json.loads(doc))]
+
+    def query_elements(self, section, projection, query=None, limit=None,
+                       skip=0, batch_size=None):
+        """See Driver.query_elements. Only the projected values are extracted
+        from the JSON, and rows are fetched batch_size at a time. limit and skip
+        are done in SQL unless part of the query must be checked in python.
+        """
+        paths = projection_paths(projection)
+        where, parameters, residual = self._where(section, query)
+        columns = ', '.join('json_type(doc, {0}), json_extract(doc, {0})'.format(
+                                _json_path(p)) for p in paths)
+        select = "SELECT json_array({}){} FROM documents WHERE {}".format(
+                    columns, ", doc" if residual else "", where)
+        if not residual and (limit is not None or skip):
+            select += " LIMIT ? OFFSET ?"
+            parameters += [-1 if limit is None else limit, skip]
+
+        def elements():
+            with self._lock:
+                cursor = self._conn.execute(select, parameters)
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(batch_size or 100)
+                if not rows:
+                    break
+                for row in rows:
+                    if residual and not match(json.loads(row[1])):
+                        continue
+                    values = json.loads(row[0])
+                    yield _nest({path: _value(values[2*i], values[2*i + 1])
+                                    for i, path in enumerate(paths)
+                                    if values[2*i] is not None})
+
+        match = compile_query(residual)
+        elements = elements()
+        if residual and (limit is not None or skip):
+            elements = itertools.islice(elements, skip,
+                                        None if limit is None else skip + limit)
+        return elements
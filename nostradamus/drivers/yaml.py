@@ -1,12 +1,21 @@
 """Dictionary driver with a yaml backend"""
 
+import contextlib
+import hashlib
+import io
+import os
+import time
+
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 from .base import UriDriver
 from .built_in import DictionaryDriver
 
-import hashlib
-
 __author__ = [  "Juan Carrano <jc@eiwa.ag>",
                 "Federico M. Pomar <fp@eiwa.ag>"
              ]
@@ -14,11 +23,38 @@ __copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
 __license__ = """Unauthorized copying of this file, via any medium is
                  strictly prohibited. Proprietary and confidential"""
 
+class _Dumper(SafeDumper):
+    """Also dump subclasses of dict and list (e.g. FrozenDict)."""
+
+_Dumper.add_multi_representer(dict, SafeDumper.represent_dict)
+_Dumper.add_multi_representer(list, SafeDumper.represent_list)
+
 
 class YAMLDriver(UriDriver):
+    """Keep the whole database in memory and in a YAML file.
+
+    Changes made to the file by someone else are detected by looking at the
+    file's mtime, size and inode. The contents are hashed to find out only
+    when the mtime is so close to the moment the file was last read or
+    written that a later modification may not have changed it (a "racy"
+    timestamp). This holds for the driver's own writes too: someone else may
+    write the file again within the same timestamp tick.
+
+    Every setitem()/update()/delitem() rewrites the file, unless it is done
+    inside a transaction(), in which case the file is written once at the
+    end.
+    """
     URI_SCHEMES = ['file']
 
-    def __init__(self, file_obj = None, filename = None):
+    # Modifications closer than this to a read of the file may not be
+    # visible in the mtime (coarse timestamps, e.g. FAT has 2 seconds).
+    TIMESTAMP_RESOLUTION_NS = 2 * 10**9
+
+    def __init__(self, file_obj = None, filename = None, indexes = None):
+        """indexes: see DictionaryDriver."""
+        self._filename = filename
+        self._indexes = {section: list(paths)
+                            for section, paths in (indexes or {}).items()}
         if file_obj is not None:
             self._file = file_obj
         else:
@@ -27,54 +63,180 @@ class YAMLDriver(UriDriver):
             except FileNotFoundError:
                 self._file = open(filename, 'w+')
 
-        self._prev_file_checksum = None
+        self._signature = None
+        self._checksum = None
+        # When the contents were last read, checked or written.
+        self._synced_ns = 0
+        self._transaction_depth = 0
+        self._dirty = False
         self._reload()
 
     @classmethod
     def from_uri(cls, uri):
         return cls(filename = uri.path)
 
-    def close(self):
+    def _close(self):
         self._file.close()
 
-    def _file_checksum(self):
-        hash_md5 = hashlib.md5()
+    def create_index(self, section, paths):
+        """See DictionaryDriver.create_index"""
+        self._indexes.setdefault(section, []).extend(paths)
+        self._dictd.create_index(section, paths)
+
+    def ensure_indexes(self, section, paths):
+        known = self._indexes.get(section, ())
+        missing = [path for path in paths if path not in known]
+        if missing:
+            self.create_index(section, missing)
+
+    def _file_signature(self):
+        """Return (mtime_ns, size, inode) or None if the file object is not
+        backed by a real file."""
+        if self._filename is not None:
+            try:
+                st = os.stat(self._filename)
+            except FileNotFoundError:
+                st = None
+            if st is not None and st.st_ino != os.fstat(self._file.fileno()).st_ino:
+                # The file was replaced (e.g. renamed over).
+                self._file.close()
+                self._file = open(self._filename, 'r+')
+
+        try:
+            st = os.fstat(self._file.fileno())
+        except (AttributeError, io.UnsupportedOperation):
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _is_ambiguous(self, signature):
+        """Whether the file may have been modified after it was last read
+        or written without its mtime changing."""
+        if signature is None:
+            return True
+        return signature[0] + self.TIMESTAMP_RESOLUTION_NS > self._synced_ns
+
+    @staticmethod
+    def _text_checksum(s):
+        return hashlib.md5(s.encode()).hexdigest()
+
+    def _read_text(self):
         self._file.seek(0)
-        for chunk in iter(lambda: self._file.buffer.read(4096), b""):
-            hash_md5.update(chunk)
-        return hash_md5.hexdigest() 
-
-    def _reload(self):
-        file_checksum = self._file_checksum()
-        if file_checksum != self._prev_file_checksum:
-            self._file.seek(0)
-            d = yaml.safe_load(self._file)
-            self._dictd = DictionaryDriver(d)
-            self._prev_file_checksum = file_checksum
-            print('reloaded')
+        return self._file.read()
+
+    def _reload(self, force=False):
+        signature = self._file_signature()
+        if not force and signature == self._signature:
+            if not self._is_ambiguous(signature):
+                return
+            now = time.time_ns()
+            s = self._read_text()
+            checksum = self._text_checksum(s)
+            if checksum == self._checksum:
+                # Unchanged as of now: once the mtime is older than the
+                # resolution, the signature alone is enough again.
+                self._synced_ns = now
+                return
+        else:
+            now = time.time_ns()
+            s = self._read_text()
+            checksum = None
+
+        self._synced_ns = now
+        if self._is_ambiguous(signature):
+            checksum = checksum or self._text_checksum(s)
+        else:
+            checksum = None
+        d = yaml.load(s, Loader=SafeLoader)
+        self._dictd = DictionaryDriver(d, indexes=self._indexes)
+        self._signature = signature
+        self._checksum = checksum
 
     def _dump(self):
-        s = yaml.safe_dump(self._dictd.d)
+        if self._transaction_depth:
+            self._dirty = True
+            return
+
+        s = yaml.dump(self._dictd.d, Dumper=_Dumper)
+        now = time.time_ns()
         # truncate the file only after the dump succeeded
         self._file.seek(0)
         self._file.truncate(0)
         self._file.write(s)
-        print('dumped')
+        self._file.flush()
+
+        self._signature = self._file_signature()
+        self._synced_ns = now
+        # The mtime of a file just written is always racy.
+        self._checksum = self._text_checksum(s)
+        self._dirty = False
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager that delays writing the file until the end of the
+        block. If the block raises, the changes are discarded and the contents
+        are reloaded from the file. Transactions can be nested.
+        """
+        self._reload()
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._dirty = False
+                self._reload(force=True)
+            raise
+        else:
+            self._transaction_depth -= 1
+            if not self._transaction_depth and self._dirty:
+                self._dump()
+
+    def _sync(self):
+        """Pick up changes from the file, unless there are pending changes
+        of our own."""
+        if not self._transaction_depth:
+            self._reload()
 
     def getitem(self, k):
-        self._reload()
+        self._sync()
         return self._dictd.getitem(k)
 
+    def getitems(self, keys):
+        self._sync()
+        return self._dictd.getitems(keys)
+
     def setitem(self, k, v):
-        self._reload()
+        self._sync()
         self._dictd.setitem(k, v)
         self._dump()
 
     def update(self, items):
-        self._reload()
+        self._sync()
         self._dictd.update(items)
         self._dump()
 
+    def delitem(self, k):
+        self._sync()
+        self._dictd.delitem(k)
+        self._dump()
+
+    def delitems(self, keys):
+        self._sync()
+        self._dictd.delitems(keys)
+        self._dump()
+
+    def referrers(self, target_name):
+        self._sync()
+        return self._dictd.referrers(target_name)
+
+    def sections(self):
+        self._sync()
+        return self._dictd.sections()
+
     def query_names(self, section, query=None):
-        self._reload()
+        self._sync()
         return self._dictd.query_names(section, query)
+
+    def query_elements(self, section, projection, query=None, **kwargs):
+        self._sync()
+        return self._dictd.query_elements(section, projection, query, **kwargs)
@@ -0,0 +1,198 @@
+"""Declarative fields for Serializable classes.
+
+Instead of writing from_dict, as_dict and __init__ by hand, a class can
+declare its fields:
+
+    class Tafirosis(Referenceable):
+        SECTION = 'tafirosisis'
+
+        cajeta_de_amarula = Value()
+        buta = Reference(Buta)
+        butas = Embedded(Buta.List, default=None)
+
+The metaclass (see WithListMeta) then generates the three methods, as
+straight-line code specialised for the fields of the class, and gives the
+class __slots__ for its fields. Methods defined in the class body are not
+replaced. Fields declared in base classes are inherited and come first.
+
+Serializable and Referenceable themselves have no __slots__ (name is kept
+in the instance __dict__), so they can be mixed with any other class. Pass
+slots=False in the class statement when the generated __slots__ would
+conflict with the ones of another base:
+
+    class Pichileta(Referenceable, slots=False):
+        ...
+"""
+
+from .drivers.built_in import thaw
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+_REQUIRED = object()
+
+class Field:
+    """Base class of field declarations.
+
+    key: key in the serialized dictionary, by default the attribute name.
+    default: value used when the argument is not given to the constructor or
+        the key is missing from the dictionary (a stored None is read as
+        None). It is shared by all instances, so it should not be mutable.
+        Without a default the field is required.
+    """
+    def __init__(self, key=None, default=_REQUIRED):
+        self.key = key
+        self.default = default
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        if self.key is None:
+            self.key = name
+
+    @property
+    def required(self):
+        return self.default is _REQUIRED
+
+    def __repr__(self):
+        return "{}(key={!r})".format(type(self).__name__, self.key)
+
+    # Code generation: each method returns a python expression. ns is the
+    # name under which the field is visible to the generated code.
+
+    def decode(self, value, ns):
+        """Expression turning the serialized value into the attribute."""
+        return value
+
+    def encode(self, attr, ns):
+        """Expression turning the attribute into its serialized value."""
+        return attr
+
+class Value(Field):
+    """A value stored as is: numbers, strings, lists and dictionaries of
+    them. Lists and dictionaries of frozen documents (see
+    ConcurrentDictionaryDriver) are copied, so they can be modified."""
+    def decode(self, value, ns):
+        return "_thaw({})".format(value)
+
+class Embedded(Field):
+    """A Serializable stored inside the document, including lists (e.g.
+    Pichingo.List, or Buta.List which holds references)."""
+    def __init__(self, cls, **kwargs):
+        super().__init__(**kwargs)
+        self.cls = cls
+
+    def decode(self, value, ns):
+        return "{}.cls.from_dict({}, read_func)".format(ns, value)
+
+    def encode(self, attr, ns):
+        return "{}.as_dict(write_func)".format(attr)
+
+class Reference(Field):
+    """A Referenceable stored in its own section."""
+    def __init__(self, cls, **kwargs):
+        super().__init__(**kwargs)
+        self.cls = cls
+
+    def decode(self, value, ns):
+        return "{}.cls.from_ref({}, read_func)".format(ns, value)
+
+    def encode(self, attr, ns):
+        return "{}.as_ref(write_func)".format(attr)
+
+def collect_fields(bases, namespace):
+    """Remove the Field declarations from a class namespace and return all
+    the fields of the class (the ones of the bases first) as a tuple, or
+    None if the class body declares none."""
+    declared = [(name, value) for name, value in namespace.items()
+                    if isinstance(value, Field)]
+    if not declared:
+        return None
+
+    fields = {}
+    for base in reversed(bases):
+        for klass in reversed(base.__mro__):
+            for field in getattr(klass, '_FIELDS', None) or ():
+                fields[field.name] = field
+
+    for name, field in declared:
+        del namespace[name]
+        field.__set_name__(None, name)
+        fields.pop(name, None)
+        fields[name] = field
+
+    return tuple(fields.values())
+
+def slot_names(bases, fields):
+    """Names of the fields that do not already have a slot in a base."""
+    inherited = set()
+    for base in bases:
+        for klass in base.__mro__:
+            slots = klass.__dict__.get('__slots__', ())
+            inherited.update((slots,) if isinstance(slots, str) else slots)
+    return tuple(f.name for f in fields if f.name not in inherited)
+
+def _compile(source, name, fields):
+    scope = {'_REQUIRED': _REQUIRED, '_thaw': thaw}
+    scope.update(('_f{}'.format(i), field) for i, field in enumerate(fields))
+    exec(compile(source, '<nostradamus.fields {}>'.format(name), 'exec'), scope)
+    return scope
+
+def make_init(fields, owner):
+    """Return an __init__ for the class owner that takes all the fields
+    (including inherited ones) as arguments, sets them and passes the
+    remaining keyword arguments (e.g. name) to the closest base class with a
+    hand-written __init__."""
+    base = next(klass for klass in owner.__mro__[1:]
+                    if '__init__' in klass.__dict__
+                        and not getattr(klass.__init__, '_generated', False))
+    params = [f.name for f in fields if f.required]
+    params += ["{}=_f{}.default".format(f.name, i)
+                for i, f in enumerate(fields) if not f.required]
+    lines = ["def __init__(self, {}, **kwargs):".format(", ".join(params)),
+             "    _base_init(self, **kwargs)"]
+    lines += ["    self.{0} = {0}".format(f.name) for f in fields]
+    scope = _compile("\n".join(lines), owner.__name__, fields)
+    scope['_base_init'] = base.__dict__['__init__']
+    init = scope['__init__']
+    init._generated = True
+    return init
+
+def make_from_dict(fields, owner_name):
+    lines = ["def from_dict(cls, d, read_func=None, **kwargs):"]
+    args = []
+    for i, f in enumerate(fields):
+        ns = '_f{}'.format(i)
+        if f.required:
+            args.append("{}={}".format(f.name, f.decode("d[{!r}]".format(f.key), ns)))
+        else:
+            lines.append("    if {!r} in d:".format(f.key))
+            lines.append("        v = d[{!r}]".format(f.key))
+            if f.decode("v", ns) == "v":
+                lines.append("        v{} = v".format(i))
+            else:
+                lines.append("        v{} = None if v is None else {}".format(
+                                i, f.decode("v", ns)))
+            lines.append("    else:")
+            lines.append("        v{} = {}.default".format(i, ns))
+            args.append("{}=v{}".format(f.name, i))
+    lines.append("    return cls({}, **kwargs)".format(", ".join(args)))
+    return classmethod(_compile("\n".join(lines), owner_name, fields)['from_dict'])
+
+def make_as_dict(fields, owner_name):
+    lines = ["def as_dict(self, write_func=None):"]
+    items = []
+    for i, f in enumerate(fields):
+        ns = '_f{}'.format(i)
+        attr = "self.{}".format(f.name)
+        if f.required or f.encode(attr, ns) == attr:
+            items.append("{!r}: {}".format(f.key, f.encode(attr, ns)))
+        else:
+            items.append("{!r}: None if {} is None else {}".format(
+                            f.key, attr, f.encode(attr, ns)))
+    lines.append("    return {{{}}}".format(", ".join(items)))
+    return _compile("\n".join(lines), owner_name, fields)['as_dict']
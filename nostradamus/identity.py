@@ -0,0 +1,104 @@
+"""Identity maps: caches of objects already read from the database.
+
+An identity map makes sure that reading the same name twice yields the same
+python object, and saves a driver fetch the second time. The policies
+differ on how long objects are kept:
+
+    IdentityMap: until it is dropped or invalidated. Use one per call or
+        per session.
+    LRUIdentityMap: at most `maxsize` objects, the least recently used ones
+        are forgotten first.
+    WeakIdentityMap: as long as the application holds a reference to the
+        object.
+"""
+
+import collections
+import weakref
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+class IdentityMap:
+    """Map (class, name) to the python object that represents it.
+    Unbounded, entries are kept until invalidated."""
+
+    def __init__(self):
+        self._objects = self._new_store()
+        self.hits = 0
+        self.misses = 0
+
+    def _new_store(self):
+        return {}
+
+    def get(self, key, default=None):
+        obj = self._objects.get(key)
+        if obj is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return obj
+
+    def __contains__(self, key):
+        return key in self._objects
+
+    def __setitem__(self, key, obj):
+        self._objects[key] = obj
+
+    def __len__(self):
+        return len(self._objects)
+
+    def invalidate(self, cls=None, name=None):
+        """Forget objects so that the next read fetches them again.
+        With no arguments, forget everything. With cls, forget all objects
+        of that class (and subclasses), with cls and name only that one.
+        """
+        if cls is None:
+            self._objects.clear()
+        elif name is not None:
+            self._objects.pop((cls, name), None)
+        else:
+            for key in [k for k in list(self._objects.keys())
+                            if issubclass(k[0], cls)]:
+                self._objects.pop(key, None)
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.stats())
+
+class LRUIdentityMap(IdentityMap):
+    """Identity map holding at most maxsize objects."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        super().__init__()
+
+    def _new_store(self):
+        return collections.OrderedDict()
+
+    def get(self, key, default=None):
+        obj = super().get(key, default)
+        if obj is not default:
+            self._objects.move_to_end(key)
+        return obj
+
+    def __setitem__(self, key, obj):
+        self._objects[key] = obj
+        self._objects.move_to_end(key)
+        while len(self._objects) > self.maxsize:
+            self._objects.popitem(last=False)
+
+class WeakIdentityMap(IdentityMap):
+    """Identity map that does not keep objects alive: an entry goes away when
+    the application drops the last reference to the object."""
+
+    def _new_store(self):
+        return weakref.WeakValueDictionary()
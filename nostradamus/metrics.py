@@ -0,0 +1,160 @@
+"""Counters for finding out where the time of reads and writes goes.
+
+DriverMetrics is filled by InstrumentedDriver (see
+nostradamus.drivers.instrumented): calls, latencies and documents/bytes
+per section. TraversalStats is filled by Database when given one: objects
+built or serialized, references followed, cache hits, and, in profiling
+mode, the time spent in from_dict/as_dict of each class.
+
+Everything can be exported with snapshot(), which returns plain
+dictionaries, lists and numbers (suitable for json.dumps).
+"""
+
+import collections
+import json
+import threading
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+def document_size(d):
+    """Approximate size in bytes of a document, as compact JSON."""
+    return len(json.dumps(d, separators=(',', ':'), default=repr))
+
+class Histogram:
+    """Latency histogram with power of two buckets: a value of t seconds
+    goes to the bucket with the smallest upper bound 2**i microseconds that
+    is larger than t."""
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound (in seconds) of the bucket holding the p-th fraction
+        of the values."""
+        if not self.count:
+            return None
+        wanted = p * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return min((1 << bucket) * 1e-6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                'buckets_us': {str(1 << b): n for b, n in sorted(self.buckets.items())}}
+
+class DriverMetrics:
+    """Per driver method: calls, errors and latency. Per section: documents
+    read, written and returned by queries, and their size when
+    measure_bytes is True (it costs one json.dumps per document).
+    """
+    def __init__(self, measure_bytes=True):
+        self.measure_bytes = measure_bytes
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = collections.Counter()
+            self.errors = collections.Counter()
+            self.latency = collections.defaultdict(Histogram)
+            self.sections = collections.defaultdict(collections.Counter)
+
+    def record_call(self, method, seconds, error=False):
+        with self._lock:
+            self.calls[method] += 1
+            if error:
+                self.errors[method] += 1
+            self.latency[method].add(seconds)
+
+    def record_documents(self, section, kind, docs):
+        """kind: 'read', 'written' or 'queried'."""
+        n = 0
+        size = 0
+        for d in docs:
+            n += 1
+            if self.measure_bytes:
+                size += document_size(d)
+        with self._lock:
+            counter = self.sections[section]
+            counter[kind] += n
+            if self.measure_bytes:
+                counter[kind + '_bytes'] += size
+
+    def record_count(self, section, kind, n=1):
+        with self._lock:
+            self.sections[section][kind] += n
+
+    def snapshot(self):
+        with self._lock:
+            return {'calls': dict(self.calls),
+                    'errors': dict(self.errors),
+                    'latency': {method: h.snapshot()
+                                    for method, h in self.latency.items()},
+                    'sections': {section: dict(c)
+                                    for section, c in self.sections.items()}}
+
+class TraversalStats:
+    """Counters filled by Database.
+
+    calls: number of read/read_many/write/... calls.
+    read: 'objects' built, 'references' found while prefetching,
+        'cache_hits' of the read cache (identity map), 'documents' fetched
+        and 'round_trips' (getitems calls).
+    write: 'objects' serialized, 'references' followed, 'dedups' (objects
+        found already in the write cache), 'skipped_clean' and 'documents'
+        sent to the driver.
+
+    With profile=True, the time spent in from_dict and as_dict is added up
+    per class. For from_dict this includes the objects built from inside
+    it, which are few since referenced objects are built first.
+    """
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.reset()
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.read = collections.Counter()
+        self.write = collections.Counter()
+        # (class name, method) -> [calls, seconds]
+        self.classes = collections.defaultdict(lambda: [0, 0.0])
+
+    def add_time(self, cls, method, seconds):
+        entry = self.classes[(cls.__qualname__, method)]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def snapshot(self):
+        snapshot = {'calls': dict(self.calls),
+                    'read': dict(self.read),
+                    'write': dict(self.write)}
+        if self.profile:
+            classes = {}
+            for (name, method), (calls, seconds) in self.classes.items():
+                classes.setdefault(name, {})[method] = {'calls': calls,
+                                                        'seconds': seconds}
+            snapshot['classes'] = classes
+        return snapshot
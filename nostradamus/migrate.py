@@ -0,0 +1,278 @@
+"""Copy raw documents between drivers, or to and from JSON-lines files.
+
+Documents are moved as they are stored, without building objects, in
+batches: names are listed with query_names, read with getitems and
+written with update, batch_size at a time, so memory use is bounded by the
+batch size (plus the names of the section being copied).
+
+    copy(source, target)            driver to driver, section by section
+    dump(source, f)                 driver to JSON lines
+    load(f, target)                 JSON lines to driver
+
+source and target are drivers or URIs for new_driver. Each line of a dump
+is {"section": ..., "name": ..., "doc": ...}.
+
+With a checkpoint file, progress is saved after every batch and an
+interrupted copy/load started again with the same arguments continues
+where it stopped. For copy, names are processed in sorted order so that
+the position can be remembered as the last name copied.
+
+The same functionality is available from the command line:
+
+    nostradamus-migrate copy file:///data.yaml mongodb://host/db
+    nostradamus-migrate dump sqlite:///data.db data.jsonl.gz
+    nostradamus-migrate load data.jsonl.gz mongodb://host/db --checkpoint ck.json
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import gzip
+import itertools
+import json
+import os
+import sys
+import threading
+
+from .drivers.base import new_driver
+
+__author__ = [  "Juan Carrano <jc@eiwa.ag>",
+                "Federico M. Pomar <fp@eiwa.ag>"
+             ]
+__copyright__ = "Copyright 2016 EIWA S.A. All rights reserved."
+__license__ = """Unauthorized copying of this file, via any medium is
+                 strictly prohibited. Proprietary and confidential"""
+
+DEFAULT_BATCH_SIZE = 1000
+
+class Checkpoint:
+    """Progress of a migration, saved as JSON. The file is replaced
+    atomically, so it is always either the old or the new state."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.state = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self.state = json.load(f)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.state.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.state[key] = value
+            if self.filename is None:
+                return
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+
+@contextlib.contextmanager
+def _driver(driver_or_uri):
+    """Use a driver, opening it from a URI if needed (and closing it
+    afterwards)."""
+    if isinstance(driver_or_uri, str):
+        driver = new_driver(driver_or_uri)
+        try:
+            yield driver
+        finally:
+            driver.close()
+    else:
+        yield driver_or_uri
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _section_documents(driver, section, batch_size, after=None):
+    """Yield lists of ((section, name), doc) for a section, in sorted name
+    order, skipping names up to after."""
+    names = sorted(driver.query_names(section))
+    if after is not None:
+        names = [name for name in names if name > after]
+    for batch in _batches(names, batch_size):
+        docs = driver.getitems([(section, name) for name in batch])
+        yield [((section, name), docs[(section, name)]) for name in batch
+                    if (section, name) in docs]
+
+def copy_section(source, target, section, batch_size=DEFAULT_BATCH_SIZE,
+                 checkpoint=None, progress=None):
+    """Copy one section, return the number of documents copied."""
+    checkpoint = checkpoint or Checkpoint()
+    key = 'copy:' + section
+    state = checkpoint.get(key, {'after': None, 'copied': 0, 'done': False})
+    if state['done']:
+        return 0
+
+    copied = 0
+    for items in _section_documents(source, section, batch_size, state['after']):
+        if items:
+            target.update(items)
+            copied += len(items)
+            state = {'after': items[-1][0][1], 'copied': state['copied'] + len(items),
+                     'done': False}
+            checkpoint.set(key, state)
+            if progress is not None:
+                progress(section, state['copied'])
+    checkpoint.set(key, dict(state, done=True))
+    return copied
+
+def copy(source, target, sections=None, batch_size=DEFAULT_BATCH_SIZE,
+         parallel=1, checkpoint=None, progress=None):
+    """Copy all the documents of the given sections (all of them by
+    default) from source to target. With parallel > 1, that many sections
+    are copied at the same time, in threads; both drivers must then be
+    thread-safe.
+
+    checkpoint: filename or Checkpoint to resume an interrupted copy.
+    progress: callable taking (section, documents copied so far).
+
+    Return a dictionary mapping each section to the documents copied.
+    """
+    if not isinstance(checkpoint, Checkpoint):
+        checkpoint = Checkpoint(checkpoint)
+
+    with _driver(source) as source, _driver(target) as target:
+        if sections is None:
+            sections = source.sections()
+
+        def copy_one(section):
+            return copy_section(source, target, section, batch_size, checkpoint,
+                                progress)
+
+        if parallel > 1:
+            with concurrent.futures.ThreadPoolExecutor(parallel) as executor:
+                counts = list(executor.map(copy_one, sections))
+        else:
+            counts = [copy_one(section) for section in sections]
+    return dict(zip(sections, counts))
+
+def _open(filename, mode):
+    """Open a text file, '-' being stdin/stdout, compressed if the name ends
+    in .gz"""
+    if filename == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return contextlib.nullcontext(stream)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+def dump(source, f, sections=None, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Write the documents of source to f (a text file object or filename)
+    as JSON lines. Return the number of documents written."""
+    if isinstance(f, str):
+        with _open(f, 'w') as f:
+            return dump(source, f, sections, batch_size, progress)
+
+    n = 0
+    with _driver(source) as source:
+        for section in (sections if sections is not None else source.sections()):
+            for items in _section_documents(source, section, batch_size):
+                for (section, name), doc in items:
+                    f.write(json.dumps({'section': section, 'name': name,
+                                        'doc': doc}, separators=(',', ':')))
+                    f.write('\n')
+                n += len(items)
+                if progress is not None:
+                    progress(section, n)
+    return n
+
+def load(f, target, sections=None, batch_size=DEFAULT_BATCH_SIZE,
+         checkpoint=None, progress=None):
+    """Write the documents in the JSON lines file f (a text file object or
+    filename) to target, batch_size at a time. Only the given sections are
+    loaded, if not None. With a checkpoint, an interrupted load skips the
+    lines already loaded. Return the number of documents written."""
+    if isinstance(f, str):
+        with _open(f, 'r') as f:
+            return load(f, target, sections, batch_size, checkpoint, progress)
+
+    if not isinstance(checkpoint, Checkpoint):
+        checkpoint = Checkpoint(checkpoint)
+    done = checkpoint.get('load:lines', 0)
+    sections = set(sections) if sections is not None else None
+
+    n = 0
+    with _driver(target) as target:
+        lines = itertools.islice(enumerate(f, 1), done, None)
+        for batch in _batches(lines, batch_size):
+            items = []
+            for lineno, line in batch:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if sections is None or record['section'] in sections:
+                    items.append(((record['section'], record['name']), record['doc']))
+            if items:
+                target.update(items)
+                n += len(items)
+            checkpoint.set('load:lines', batch[-1][0])
+            if progress is not None:
+                progress(None, n)
+    return n
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='nostradamus-migrate',
+                                     description="Copy documents between drivers "
+                                                 "and JSON-lines files.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    copy_parser = commands.add_parser('copy', help="copy from a driver to another")
+    copy_parser.add_argument('source', help="source driver URI")
+    copy_parser.add_argument('target', help="target driver URI")
+    copy_parser.add_argument('--parallel', type=int, default=1,
+                             help="sections copied at the same time")
+
+    dump_parser = commands.add_parser('dump', help="write a driver to JSON lines")
+    dump_parser.add_argument('source', help="source driver URI")
+    dump_parser.add_argument('file', help="output file, - for stdout, "
+                                          "compressed if it ends in .gz")
+
+    load_parser = commands.add_parser('load', help="write JSON lines to a driver")
+    load_parser.add_argument('file', help="input file, - for stdin, "
+                                          "compressed if it ends in .gz")
+    load_parser.add_argument('target', help="target driver URI")
+
+    for p in (copy_parser, dump_parser, load_parser):
+        p.add_argument('--sections', help="comma separated sections, "
+                                          "all of them by default")
+        p.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        p.add_argument('--quiet', action='store_true')
+    for p in (copy_parser, load_parser):
+        p.add_argument('--checkpoint', help="file to save the progress to, "
+                                            "and to resume from")
+
+    args = parser.parse_args(argv)
+    sections = args.sections.split(',') if args.sections else None
+
+    def progress(section, n):
+        if not args.quiet:
+            print("{}: {}".format(section or args.command, n), file=sys.stderr)
+
+    if args.command == 'copy':
+        counts = copy(args.source, args.target, sections, args.batch_size,
+                      args.parallel, args.checkpoint, progress)
+        total = sum(counts.values())
+    elif args.command == 'dump':
+        total = dump(args.source, args.file, sections, args.batch_size, progress)
+    else:
+        total = load(args.file, args.target, sections, args.batch_size,
+                     args.checkpoint, progress)
+
+    if not args.quiet:
+        print("{} documents".format(total), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Tests for AsyncDatabase and the asynchronous drivers."""
+
+import asyncio
+
+import pytest
+
+from nostradamus import Database, Referenceable, Reference, Embedded, Value
+from nostradamus.aio import AsyncDatabase
+from nostradamus.drivers.aio import AsyncDictionaryDriver, ThreadedAsyncDriver
+from nostradamus.drivers.built_in import DictionaryDriver
+
+class Item(Referenceable):
+    SECTION = 'items'
+    v = Value(default=0)
+
+class Basket(Referenceable):
+    SECTION = 'baskets'
+    items = Embedded(Item.List)
+    owner = Reference(Item)
+
+class CountingAsyncDriver(AsyncDictionaryDriver):
+    """Records the keys of each getitems() call and the number of calls in
+    flight at the same time."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+        self.in_flight = self.max_in_flight = 0
+
+    async def getitems(self, keys):
+        keys = list(keys)
+        self.calls.append(keys)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().getitems(keys)
+        finally:
+            self.in_flight -= 1
+
+def make_baskets(n_baskets, width):
+    return [Basket(name='b{}'.format(i),
+                   items=Item.List(Item(name='i{}-{}'.format(i, j), v=j)
+                                   for j in range(width)),
+                   owner=Item(name='owner{}'.format(i)))
+            for i in range(n_baskets)]
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_write_and_read():
+    driver = AsyncDictionaryDriver()
+    db = AsyncDatabase(driver)
+    run(db.write_many(make_baskets(2, 3)))
+    baskets = run(db.read_many([(Basket, 'b0'), (Basket, 'b1')]))
+    assert [[item.v for item in b.items] for b in baskets] == [[0, 1, 2]] * 2
+    assert baskets[1].owner.name == 'owner1'
+    sync = Database(driver.driver).read((Basket, 'b0'))
+    assert [item.name for item in sync.items] == \
+        [item.name for item in baskets[0].items]
+
+def test_read_fetches_one_level_per_round():
+    driver = CountingAsyncDriver()
+    run(AsyncDatabase(driver).write_many(make_baskets(3, 4)))
+    db = AsyncDatabase(driver, batch_size=5, concurrency=2)
+    run(db.read_many([(Basket, 'b{}'.format(i)) for i in range(3)]))
+    assert [len(keys) for keys in driver.calls] == [3, 5, 5, 5]
+    assert driver.max_in_flight == 2
+
+def test_read_missing():
+    db = AsyncDatabase(AsyncDictionaryDriver())
+    with pytest.raises(KeyError):
+        run(db.read((Basket, 'nothing')))
+
+def test_threaded_driver():
+    driver = ThreadedAsyncDriver(DictionaryDriver())
+    db = AsyncDatabase(driver)
+    run(db.write(make_baskets(1, 2)[0]))
+    basket = run(db.read((Basket, 'b0')))
+    assert [item.v for item in basket.items] == [0, 1]
+    assert sorted(run(db.query_names(Item))) == ['i0-0', 'i0-1', 'owner0']
+
+def test_query_elements():
+    async def elements(db):
+        return [e async for e in db.query_elements(Item, ['v'], {'v': 1})]
+    for driver in (AsyncDictionaryDriver(),
+                   ThreadedAsyncDriver(DictionaryDriver())):
+        db = AsyncDatabase(driver)
+        run(db.write_many(make_baskets(2, 2)))
+        assert run(elements(db)) == [{'v': 1}, {'v': 1}]
+
+def test_synchronous_access_is_refused():
+    db = AsyncDatabase(AsyncDictionaryDriver())
+    with pytest.raises(NotImplementedError, match='AsyncDriver'):
+        db._db.query_names(Item)
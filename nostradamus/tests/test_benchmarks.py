@@ -0,0 +1,42 @@
+"""Smoke tests for the benchmarks, run at a tiny scale."""
+
+import json
+
+from nostradamus.benchmarks import DRIVERS, OPERATIONS, SHAPES, run, \
+                                   compare, main
+
+def test_run_every_combination():
+    report = run(scale=0.005)
+    results = report['results']
+    assert len(results) == len(DRIVERS) * len(SHAPES) * len(OPERATIONS)
+    assert set((r['driver'], r['shape'], r['op']) for r in results) == \
+        set((d, s, o) for d in DRIVERS for s in SHAPES for o in OPERATIONS)
+    for r in results:
+        assert r['calls'] > 0 and r['seconds'] >= 0
+        assert r['latency']['p50'] <= r['latency']['max']
+        assert (r['objects'] is None) == r['op'].startswith('query')
+        assert r['peak_memory'] is None
+
+def test_memory():
+    report = run(['dict'], ['wide'], ['read'], scale=0.01, memory=True)
+    assert report['results'][0]['peak_memory'] > 0
+
+def test_compare():
+    report = run(['dict'], ['deep'], ['write', 'read'], scale=0.01)
+    baseline = json.loads(json.dumps(report))
+    assert compare(report, baseline) == []
+    for r in baseline['results']:
+        if r['op'] == 'read':
+            r['seconds'] = r['seconds'] / 10
+    assert [key[:3] for key in compare(report, baseline)] == \
+        [('dict', 'deep', 'read')]
+
+def test_main(tmp_path):
+    output = str(tmp_path / 'out.json')
+    argv = ['--drivers', 'dict,mongo', '--shapes', 'embedded', '--scale',
+            '0.01', '--operations', 'write,query_elements', '--output', output]
+    assert main(argv) == 0
+    with open(output) as f:
+        report = json.load(f)
+    assert len(report['results']) == 4
+    assert main(argv + ['--compare', output, '--threshold', '1e6']) == 0
@@ -0,0 +1,186 @@
+"""Tests for the drivers built on python objects."""
+
+import copy
+import pickle
+import threading
+
+import pytest
+
+from nostradamus import Database, Referenceable, Value
+from nostradamus.drivers.built_in import (DictionaryDriver, ChainDriver,
+    ConcurrentDictionaryDriver, FrozenDict, FrozenList, compile_query, freeze,
+    thaw)
+
+class LookupCounter(DictionaryDriver):
+    """DictionaryDriver that records the keys looked up."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookups = []
+
+    def getitem(self, k):
+        self.lookups.append(k)
+        return super().getitem(k)
+
+    def getitems(self, keys):
+        keys = list(keys)
+        self.lookups.extend(keys)
+        return super().getitems(keys)
+
+def items(n):
+    return [(('s', str(i)), {'i': i, 'sub': {'mod': i % 3}, 'pair': [i % 2, 0]})
+            for i in range(n)]
+
+def test_compile_query():
+    match = compile_query({'a.b': 1, 'c': [1, 2]})
+    assert match({'a': {'b': 1}, 'c': [1, 2]})
+    assert not match({'a': {'b': 2}, 'c': [1, 2]})
+    assert not match({'a': 1, 'c': [1, 2]})
+    assert not match({'c': [1, 2]})
+    assert compile_query(None)({'anything': 1})
+
+@pytest.mark.parametrize('query', [{'sub.mod': 1}, {'pair': [1, 0]},
+                                   {'sub': {'mod': 2}}, {'sub.mod': 1, 'i': 4},
+                                   {'sub.mod': [1]}])
+def test_indexed_queries_match_scans(query):
+    plain = DictionaryDriver()
+    indexed = DictionaryDriver(indexes={'s': ['sub.mod', 'pair', 'sub']})
+    for driver in (plain, indexed):
+        driver.update(items(20))
+        driver.setitem(('s', '4'), {'i': 4, 'sub': {'mod': 1}, 'pair': [1, 0]})
+        driver.setitem(('s', '7'), {'i': 7})
+        driver.delitem(('s', '10'))
+    assert sorted(indexed.query_names('s', query)) == \
+        sorted(plain.query_names('s', query))
+    assert sorted(indexed.query_names('s', query)) == \
+        sorted(name for name, obj in plain.d['s'].items()
+                    if compile_query(query)(obj))
+
+def test_index_follows_updates():
+    driver = DictionaryDriver(indexes={'s': ['sub.mod']})
+    driver.update(items(6))
+    assert sorted(driver.query_names('s', {'sub.mod': 0})) == ['0', '3']
+    driver.setitem(('s', '3'), {'sub': {'mod': 1}})
+    driver.delitem(('s', '0'))
+    assert driver.query_names('s', {'sub.mod': 0}) == []
+    assert sorted(driver.query_names('s', {'sub.mod': 1})) == ['1', '3', '4']
+
+def test_create_index_on_existing_items():
+    driver = DictionaryDriver()
+    driver.update(items(6))
+    driver.create_index('s', ['sub.mod'])
+    assert sorted(driver.query_names('s', {'sub.mod': 2})) == ['2', '5']
+
+def make_chain(**kwargs):
+    first, second = LookupCounter(), LookupCounter()
+    second.update([(('s', 'a'), {'v': 1}), (('s', 'b'), {'v': 2})])
+    return ChainDriver([first, second], **kwargs), first, second
+
+def test_chain_negative_cache():
+    chain, first, second = make_chain(negative_cache_size=10)
+    for i in range(3):
+        assert chain.getitem(('s', 'a')) == {'v': 1}
+        with pytest.raises(KeyError):
+            chain.getitem(('s', 'missing'))
+    assert first.lookups == [('s', 'a'), ('s', 'missing')]
+    assert second.lookups == [('s', 'a'), ('s', 'missing'), ('s', 'a'),
+                              ('s', 'a')]
+    assert chain.getitems([('s', 'a'), ('s', 'b'), ('s', 'missing')]) == \
+        {('s', 'a'): {'v': 1}, ('s', 'b'): {'v': 2}}
+    assert ('s', 'missing') not in first.lookups[2:]
+
+def test_chain_negative_cache_follows_writes():
+    chain, first, second = make_chain(negative_cache_size=10)
+    chain.getitem(('s', 'a'))
+    chain.update([(('s', 'a'), {'v': 10})])
+    assert chain.getitem(('s', 'a')) == {'v': 10}
+    chain.delitem(('s', 'a'))
+    with pytest.raises(KeyError):
+        chain.getitem(('s', 'a'))
+    assert chain.getitems([('s', 'a')]) == {}
+
+def test_chain_negative_cache_is_bounded():
+    chain, first, second = make_chain(negative_cache_size=2)
+    chain.getitem(('s', 'a'))
+    chain.getitem(('s', 'b'))
+    chain.getitems([('s', 'missing')])
+    assert len(chain._absent[0]) == 2
+    del first.lookups[:]
+    chain.getitem(('s', 'a'))
+    assert first.lookups == [('s', 'a')]
+
+def test_chain_read_through():
+    chain, first, second = make_chain(read_through=True, negative_cache_size=10)
+    assert chain.getitem(('s', 'a')) == {'v': 1}
+    assert first.getitem(('s', 'a')) == {'v': 1}
+    assert chain.getitems([('s', 'a'), ('s', 'b')]) == \
+        {('s', 'a'): {'v': 1}, ('s', 'b'): {'v': 2}}
+    assert first.getitem(('s', 'b')) == {'v': 2}
+    del second.lookups[:]
+    assert chain.getitems([('s', 'a'), ('s', 'b')]) == \
+        {('s', 'a'): {'v': 1}, ('s', 'b'): {'v': 2}}
+    assert second.lookups == []
+
+def test_chain_without_read_through():
+    chain, first, second = make_chain()
+    chain.getitem(('s', 'a'))
+    chain.getitems([('s', 'b')])
+    assert first.getitems([('s', 'a'), ('s', 'b')]) == {}
+
+def test_frozen_documents():
+    doc = freeze({'a': [1, {'b': 2}], 'c': (3,)})
+    assert doc == {'a': [1, {'b': 2}], 'c': [3]}
+    with pytest.raises(TypeError):
+        doc['a'].append(4)
+    with pytest.raises(TypeError):
+        doc['a'][1]['b'] = 3
+    for copied in (thaw(doc), copy.deepcopy(doc), pickle.loads(pickle.dumps(doc))):
+        assert copied == doc
+        assert type(copied) is dict and type(copied['a']) is list
+        assert type(copied['a'][1]) is dict
+    assert type(doc.copy()) is dict
+    plain = {'a': [1]}
+    assert thaw(plain) is plain
+
+def test_concurrent_driver_returns_frozen_documents():
+    driver = ConcurrentDictionaryDriver(indexes={'s': ['sub.mod']})
+    driver.update(items(10))
+    doc = driver.getitem(('s', '1'))
+    assert isinstance(doc, FrozenDict) and isinstance(doc['pair'], FrozenList)
+    assert driver.getitems([('s', '1')])[('s', '1')] is doc
+    assert sorted(driver.query_names('s', {'sub.mod': 1})) == ['1', '4', '7']
+
+class Tagged(Referenceable):
+    SECTION = 'tagged'
+    tags = Value()
+    extra = Value(default=None)
+
+def test_value_fields_are_modifiable():
+    db = Database(ConcurrentDictionaryDriver())
+    db.write(Tagged(name='t', tags=['a'], extra={'k': [1]}))
+    obj = db.read((Tagged, 't'))
+    obj.tags.append('b')
+    obj.extra['k'].append(2)
+    db.write(obj)
+    assert Database(db._driver).read((Tagged, 't')).tags == ['a', 'b']
+    assert db._driver.getitem(('tagged', 't'))['extra'] == {'k': [1, 2]}
+
+def test_concurrent_readers_see_whole_updates():
+    driver = ConcurrentDictionaryDriver(buckets=4)
+    driver.update([(('s', str(i)), {'v': 0}) for i in range(50)])
+    errors = []
+
+    def read():
+        for _ in range(200):
+            snapshot = set(d['v'] for d in driver.snapshot()['s'].values())
+            if len(snapshot) != 1:
+                errors.append(snapshot)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for t in readers:
+        t.start()
+    for v in range(1, 50):
+        driver.update([(('s', str(i)), {'v': v}) for i in range(50)])
+    for t in readers:
+        t.join()
+    assert errors == []
+    assert set(d['v'] for d in driver.snapshot()['s'].values()) == {49}
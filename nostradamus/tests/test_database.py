@@ -0,0 +1,311 @@
+"""Tests for Database: reading and writing object graphs."""
+
+import pytest
+
+from nostradamus import Database, Referenceable, WeakIdentityMap
+from nostradamus.drivers.built_in import DictionaryDriver
+
+class CountingDriver(DictionaryDriver):
+    """Records the keys asked for in each getitem/getitems call, and the
+    keys written by each update."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+        self.writes = []
+
+    def update(self, items):
+        items = list(items)
+        self.writes.append(sorted(k for k, v in items))
+        super().update(items)
+
+    def getitem(self, k):
+        self.calls.append([k])
+        return super().getitem(k)
+
+    def getitems(self, keys):
+        keys = list(keys)
+        self.calls.append(keys)
+        return super().getitems(keys)
+
+class Leaf(Referenceable):
+    SECTION = 'leaves'
+    built = 0
+
+    def __init__(self, v=0, **kwargs):
+        super().__init__(**kwargs)
+        self.v = v
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        Leaf.built += 1
+        return cls(v=d['v'], **kwargs)
+
+    def as_dict(self, write_func=None):
+        return {'v': self.v}
+
+class Hub(Referenceable):
+    SECTION = 'hubs'
+
+    def __init__(self, leaves=(), **kwargs):
+        super().__init__(**kwargs)
+        self.leaves = Leaf.List(leaves)
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        return cls(Leaf.List.from_dict(d['leaves'], read_func), **kwargs)
+
+    def as_dict(self, write_func=None):
+        return {'leaves': self.leaves.as_dict(write_func)}
+
+class Shelf(Referenceable):
+    """Stored like Hub, but reads the leaves lazily."""
+    SECTION = 'hubs'
+
+    def __init__(self, leaves=(), **kwargs):
+        super().__init__(**kwargs)
+        self.leaves = Leaf.CompactList(leaves)
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        self = cls(**kwargs)
+        self.leaves = Leaf.CompactList.from_dict(d['leaves'], read_func)
+        return self
+
+    def as_dict(self, write_func=None):
+        return {'leaves': self.leaves.as_dict(write_func)}
+
+class Link(Referenceable):
+    SECTION = 'links'
+
+    def __init__(self, next=None, **kwargs):
+        super().__init__(**kwargs)
+        self.next = next
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        next = Link.from_ref(d['next'], read_func) if d['next'] else None
+        return cls(next=next, **kwargs)
+
+    def as_dict(self, write_func=None):
+        return {'next': self.next.as_ref(write_func) if self.next else None}
+
+def make_hubs(driver, n_hubs, width, shared=0):
+    """Write n_hubs hubs of width leaves, the first shared ones common to
+    all the hubs."""
+    common = [Leaf(v=i, name='common-{}'.format(i)) for i in range(shared)]
+    hubs = [Hub(common + [Leaf(v=i, name='leaf-{}-{}'.format(h, i))
+                            for i in range(width - shared)],
+                name='hub-{}'.format(h))
+            for h in range(n_hubs)]
+    Database(driver).write_many(hubs)
+    return hubs
+
+def make_chain(n):
+    head = None
+    for i in range(n):
+        head = Link(next=head, name='link-{}'.format(i))
+    return head
+
+def chain_length(link):
+    n = 0
+    while link is not None:
+        n += 1
+        link = link.next
+    return n
+
+def test_deep_chain_round_trip():
+    n = 100000
+    driver = DictionaryDriver()
+    Database(driver).write(make_chain(n))
+    assert len(driver.query_names('links')) == n
+
+    # A weak identity map must not let the chain be dropped while building it.
+    db = Database(driver, identity_map=WeakIdentityMap())
+    head = db.read((Link, 'link-{}'.format(n - 1)))
+    assert chain_length(head) == n
+    assert head.next.next.name == 'link-{}'.format(n - 3)
+
+def test_deep_chain_read_many():
+    driver = DictionaryDriver()
+    Database(driver).write(make_chain(5000))
+    db = Database(driver, identity_map=WeakIdentityMap())
+    first, middle = db.read_many([(Link, 'link-4999'), (Link, 'link-2499')])
+    assert chain_length(first) == 5000
+    assert chain_length(middle) == 2500
+    assert first.next.next is not None
+
+def test_read_fetches_one_level_per_call():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 50)
+    Leaf.built = 0
+    hub = Database(driver).read((Hub, 'hub-0'))
+    assert [v.v for v in hub.leaves] == list(range(50))
+    assert [len(keys) for keys in driver.calls] == [1, 50]
+    # Leaves hold no references: they are deserialized only once.
+    assert Leaf.built == 50
+
+def test_read_many_shares_levels():
+    driver = CountingDriver()
+    make_hubs(driver, 3, 10, shared=4)
+    hubs = list(Database(driver).read_many([(Hub, 'hub-{}'.format(h))
+                                            for h in range(3)]))
+    assert [len(keys) for keys in driver.calls] == [3, 4 + 3 * 6]
+    assert hubs[0].leaves[0] is hubs[2].leaves[0]
+    assert hubs[0].leaves[5] is not hubs[1].leaves[5]
+
+def test_read_missing_reference():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 3)
+    driver.delitem(('leaves', 'leaf-0-1'))
+    with pytest.raises(KeyError):
+        Database(driver).read((Hub, 'hub-0'))
+
+def test_lazy_read_fetches_references_on_first_use():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 5)
+    driver.calls = []
+    Leaf.built = 0
+    hub = Database(driver, lazy=True).read((Hub, 'hub-0'))
+    assert len(driver.calls) == 1
+    leaf = hub.leaves[2]
+    assert isinstance(leaf, Leaf) and leaf.name == 'leaf-0-2'
+    assert Leaf.built == 0
+
+    assert leaf.v == 2
+    # The other leaves of the list were fetched together.
+    assert [len(keys) for keys in driver.calls] == [1, 5]
+    assert [l.v for l in hub.leaves] == list(range(5))
+    assert len(driver.calls) == 2
+
+def test_lazy_write_skips_unresolved_references():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 3)
+    db = Database(driver, lazy=True)
+    hub = db.read((Hub, 'hub-0'))
+    hub.leaves[0].v = 10
+    driver.writes = []
+    db.write(hub)
+    assert driver.writes == [[('hubs', 'hub-0'), ('leaves', 'leaf-0-0')]]
+    assert driver.getitem(('leaves', 'leaf-0-0')) == {'v': 10}
+    assert len(driver.getitem(('hubs', 'hub-0'))['leaves']['contents']) == 3
+
+def test_track_changes_sends_only_modified_documents():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 3)
+    db = Database(driver, track_changes=True)
+    hub = db.read((Hub, 'hub-0'))
+    driver.writes = []
+    db.write(hub)
+    assert driver.writes == []
+    hub.leaves[1].v = 10
+    db.write(hub)
+    assert driver.writes == [[('leaves', 'leaf-0-1')]]
+    db.write(hub)
+    assert driver.writes == [[('leaves', 'leaf-0-1')]]
+
+def test_skip_clean_does_not_serialize_clean_references():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 3)
+    db = Database(driver, track_changes=True)
+    hub = db.read((Hub, 'hub-0'))
+    hub.leaves[0].v = 10
+    hub.leaves.append(Leaf(v=3, name='new'))
+    driver.writes = []
+    db.write(hub, skip_clean=True)
+    # The modified leaf was not marked dirty, so it is skipped.
+    assert driver.writes == [[('hubs', 'hub-0'), ('leaves', 'new')]]
+    db.mark_dirty(hub.leaves[0])
+    db.write(hub, skip_clean=True)
+    assert driver.writes[-1] == [('leaves', 'leaf-0-0')]
+    assert driver.getitem(('leaves', 'leaf-0-0')) == {'v': 10}
+
+def test_invalidate_forgets_fingerprints():
+    driver = CountingDriver()
+    make_hubs(driver, 2, 2)
+    db = Database(driver, track_changes=True)
+    hubs = list(db.read_many([(Hub, 'hub-0'), (Hub, 'hub-1')]))
+    # Written behind the database's back.
+    driver.setitem(('leaves', 'leaf-0-0'), {'v': 5})
+    driver.setitem(('leaves', 'leaf-1-0'), {'v': 5})
+    driver.writes = []
+    db.invalidate(Leaf, 'leaf-0-0')
+    db.write_many(hubs, skip_clean=True)
+    assert driver.writes == [[('leaves', 'leaf-0-0')]]
+    db.invalidate(Leaf)
+    db.write_many(hubs, skip_clean=True)
+    assert driver.writes[-1] == [('leaves', 'leaf-0-0'), ('leaves', 'leaf-0-1'),
+                                 ('leaves', 'leaf-1-0'), ('leaves', 'leaf-1-1')]
+    assert driver.getitem(('leaves', 'leaf-1-0')) == {'v': 0}
+    db.invalidate()
+    db.write_many(hubs)
+    assert driver.writes[-1] == [('hubs', 'hub-0'), ('hubs', 'hub-1'),
+                                 ('leaves', 'leaf-0-0'), ('leaves', 'leaf-0-1'),
+                                 ('leaves', 'leaf-1-0'), ('leaves', 'leaf-1-1')]
+
+def test_compact_list_reads_elements_on_use():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 10)
+    driver.calls = []
+    Leaf.built = 0
+    shelf = Database(driver).read((Shelf, 'hub-0'))
+    assert len(driver.calls) == 1 and Leaf.built == 0
+    assert len(shelf.leaves) == 10
+    assert shelf.leaves.names[3] == 'leaf-0-3'
+
+    assert shelf.leaves[3].v == 3 and shelf.leaves[-1].v == 9
+    assert Leaf.built == 2
+    assert shelf.leaves.is_loaded(-1) and not shelf.leaves.is_loaded(0)
+    assert [leaf.v for leaf in shelf.leaves[2:5]] == [2, 3, 4]
+
+    Leaf.CompactList.BATCH_SIZE = 4
+    try:
+        driver.calls = []
+        assert [leaf.v for leaf in shelf.leaves] == list(range(10))
+    finally:
+        del Leaf.CompactList.BATCH_SIZE
+    # Leaves 2, 3, 4 and 9 were already loaded.
+    assert [sorted(keys) for keys in driver.calls] == \
+        [[('leaves', 'leaf-0-0'), ('leaves', 'leaf-0-1')],
+         [('leaves', 'leaf-0-5'), ('leaves', 'leaf-0-6'), ('leaves', 'leaf-0-7')],
+         [('leaves', 'leaf-0-8')]]
+
+def test_compact_list_writes_unread_elements_by_name():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 5)
+    stored = driver.getitem(('hubs', 'hub-0'))
+    db = Database(driver)
+    shelf = db.read((Shelf, 'hub-0'))
+    driver.calls = []
+    driver.writes = []
+    db.write(shelf)
+    assert driver.calls == []
+    assert driver.writes == [[('hubs', 'hub-0')]]
+    assert driver.getitem(('hubs', 'hub-0')) == stored
+    hub = db.read((Hub, 'hub-0'))
+    assert [leaf.v for leaf in hub.leaves] == list(range(5))
+
+def test_compact_list_editing():
+    driver = CountingDriver()
+    make_hubs(driver, 1, 5)
+    db = Database(driver)
+    shelf = db.read((Shelf, 'hub-0'))
+    leaves = shelf.leaves
+    third = leaves[2]
+    del leaves[0]
+    leaves.insert(0, Leaf(v=10, name='first'))
+    leaves.append(Leaf(v=11, name='last'))
+    leaves[1] = Leaf(v=12, name='second')
+    assert leaves[2] is third
+    assert leaves.names == ['first', 'second', 'leaf-0-2', 'leaf-0-3',
+                            'leaf-0-4', 'last']
+    with pytest.raises(TypeError):
+        leaves[0:2] = []
+    db.write(shelf)
+    hub = Database(driver).read((Hub, 'hub-0'))
+    assert [leaf.v for leaf in hub.leaves] == [10, 12, 2, 3, 4, 11]
+
+def test_compact_list_without_database():
+    leaves = Leaf.CompactList.from_dict(
+        {'contents': [{'_IS_REFERENCE': True, 'target_name': 'x'}]})
+    with pytest.raises(KeyError):
+        leaves[0]
@@ -0,0 +1,147 @@
+"""Tests for Database.delete and Database.collect_orphans."""
+
+import pytest
+
+from nostradamus import Database, Referenceable, Reference, Value, \
+                        ReferentialIntegrityError
+from nostradamus.drivers.built_in import DictionaryDriver, \
+                                         ConcurrentDictionaryDriver
+from nostradamus.drivers.sqlite import SQLiteDriver
+
+class Owner(Referenceable):
+    SECTION = 'owners'
+    n = Value(default=0)
+
+class Pet(Referenceable):
+    SECTION = 'pets'
+    owner = Reference(Owner)
+
+class Visit(Referenceable):
+    SECTION = 'visits'
+    pet = Reference(Pet)
+
+class Checkup(Referenceable):
+    """from_dict needs the actual owner before it reads the vet, so the
+    references cannot all be found without building the objects."""
+    SECTION = 'checkups'
+
+    def __init__(self, owner, vet, **kwargs):
+        super().__init__(**kwargs)
+        self.owner = owner
+        self.vet = vet
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        owner = Owner.from_ref(d['owner'], read_func)
+        owner.n
+        return cls(owner, Owner.from_ref(d['vet'], read_func), **kwargs)
+
+    def as_dict(self, write_func=None):
+        return {'owner': self.owner.as_ref(write_func),
+                'vet': self.vet.as_ref(write_func)}
+
+class Kennel(Referenceable):
+    """Holds its pets in a CompactRefList, which from_dict does not read."""
+    SECTION = 'kennels'
+
+    def __init__(self, pets=(), **kwargs):
+        super().__init__(**kwargs)
+        self.pets = Pet.CompactList(pets)
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        self = cls(**kwargs)
+        self.pets = Pet.CompactList.from_dict(d['pets'], read_func)
+        return self
+
+    def as_dict(self, write_func=None):
+        return {'pets': self.pets.as_dict(write_func)}
+
+DRIVERS = [DictionaryDriver, ConcurrentDictionaryDriver, SQLiteDriver]
+
+@pytest.fixture(params=DRIVERS, ids=lambda cls: cls.__name__)
+def driver(request):
+    driver = request.param()
+    yield driver
+    driver.close()
+
+def names(driver, section):
+    return sorted(driver.query_names(section))
+
+def test_delete_restrict(driver):
+    db = Database(driver)
+    owner = Owner(name='o')
+    db.write(Visit(name='v', pet=Pet(name='p', owner=owner)))
+
+    with pytest.raises(ReferentialIntegrityError) as e:
+        db.delete(owner)
+    assert e.value.referrers == [('pets', 'p')]
+    assert names(driver, 'owners') == ['o']
+
+    assert db.delete((Visit, 'v')) == [('visits', 'v')]
+    assert names(driver, 'visits') == []
+
+def test_delete_cascade(driver):
+    db = Database(driver)
+    owner = Owner(name='o')
+    db.write(Visit(name='v', pet=Pet(name='p', owner=owner)))
+    db.write(Pet(name='other', owner=Owner(name='o2')))
+
+    deleted = db.delete(owner, cascade=True)
+    assert sorted(deleted) == [('owners', 'o'), ('pets', 'p'), ('visits', 'v')]
+    assert names(driver, 'pets') == ['other']
+    assert names(driver, 'owners') == ['o2']
+
+def test_delete_same_name_other_section(driver):
+    db = Database(driver)
+    db.write(Pet(name='x', owner=Owner(name='o')))
+    db.write(Owner(name='x'))
+    # The pet named x refers to nothing named x in the owners section.
+    assert db.delete((Owner, 'x')) == [('owners', 'x')]
+
+def test_delete_restrict_when_references_cannot_be_probed(driver):
+    db = Database(driver)
+    vet = Owner(name='vet')
+    db.write(Checkup(Owner(name='o'), vet, name='c'))
+    with pytest.raises(ReferentialIntegrityError):
+        db.delete(vet)
+    assert db.read((Checkup, 'c')).vet.name == 'vet'
+
+def test_delete_restrict_with_compact_list(driver):
+    db = Database(driver)
+    owner = Owner(name='o')
+    pets = [Pet(name=name, owner=owner) for name in ('a', 'b')]
+    db.write(Kennel(pets, name='k'))
+    with pytest.raises(ReferentialIntegrityError) as e:
+        db.delete(pets[1])
+    assert e.value.referrers == [('kennels', 'k')]
+    assert names(driver, 'pets') == ['a', 'b']
+
+    deleted = db.delete(pets[0], cascade=True)
+    assert sorted(deleted) == [('kennels', 'k'), ('pets', 'a')]
+    assert db.delete(pets[1]) == [('pets', 'b')]
+
+def test_collect_orphans(driver):
+    db = Database(driver)
+    db.write(Visit(name='v', pet=Pet(name='p', owner=Owner(name='o'))))
+    db.write(Pet(name='stray', owner=Owner(name='gone')))
+
+    collector = db.orphan_collector([Visit], batch_size=1)
+    collector.step()
+    # Written while the collection runs: must survive.
+    db.write(Pet(name='late', owner=Owner(name='late-owner')))
+    assert collector.run() == 2
+
+    assert names(driver, 'pets') == ['late', 'p']
+    assert names(driver, 'owners') == ['late-owner', 'o']
+    assert db.collect_orphans([(Visit, 'v')]) == 2
+    assert names(driver, 'pets') == ['p']
+
+def test_collect_orphans_keeps_compact_list_elements(driver):
+    db = Database(driver)
+    owner = Owner(name='o')
+    db.write(Kennel([Pet(name='p', owner=owner)], name='k'))
+    db.write(Pet(name='stray', owner=owner))
+    assert db.collect_orphans([Kennel]) == 1
+    assert names(driver, 'pets') == ['p']
+    assert db.read((Kennel, 'k')).pets[0].owner.name == 'o'
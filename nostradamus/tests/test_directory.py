@@ -0,0 +1,75 @@
+"""Tests for DirectoryDriver."""
+
+import os
+
+import pytest
+
+from nostradamus.drivers.base import new_driver
+from nostradamus.drivers.directory import DirectoryDriver
+
+class CountingMisses(DirectoryDriver):
+    """Counts the reads that missed the cache."""
+    misses = 0
+
+    def _cached(self, k, signature):
+        data = super()._cached(k, signature)
+        if data is None:
+            self.misses += 1
+        return data
+
+def test_round_trip(tmp_path):
+    driver = DirectoryDriver(str(tmp_path), shard_levels=2)
+    names = ['a', '.hidden', 'with/slash', 'ü']
+    driver.update([(('s/t', name), {'name': name}) for name in names])
+    assert sorted(driver.query_names('s/t')) == sorted(names)
+    assert driver.sections() == ['s/t']
+    for name in names:
+        assert driver.getitem(('s/t', name)) == {'name': name}
+    driver.delitem(('s/t', 'a'))
+    with pytest.raises(KeyError):
+        driver.getitem(('s/t', 'a'))
+    with pytest.raises(KeyError):
+        driver.delitem(('s/t', 'a'))
+
+def test_documents_do_not_alias_the_cache(tmp_path):
+    driver = DirectoryDriver(str(tmp_path))
+    driver.setitem(('s', 'a'), {'tags': ['x'], 'sub': {'v': 1}})
+    doc = driver.getitem(('s', 'a'))
+    doc['tags'].append('y')
+    doc['sub']['v'] = 2
+    assert driver.getitem(('s', 'a')) == {'tags': ['x'], 'sub': {'v': 1}}
+    items = driver.getitems([('s', 'a')])
+    items[('s', 'a')]['new'] = True
+    assert driver.getitem(('s', 'a')) == {'tags': ['x'], 'sub': {'v': 1}}
+
+def test_cache_follows_the_files(tmp_path):
+    driver = CountingMisses(str(tmp_path))
+    driver.setitem(('s', 'a'), {'v': 1})
+    for i in range(3):
+        assert driver.getitem(('s', 'a')) == {'v': 1}
+    assert driver.misses == 1
+
+    other = DirectoryDriver(str(tmp_path))
+    other.setitem(('s', 'a'), {'v': 22})
+    assert driver.getitem(('s', 'a')) == {'v': 22}
+    os.unlink(other._path(('s', 'a')))
+    with pytest.raises(KeyError):
+        driver.getitem(('s', 'a'))
+
+def test_query_names(tmp_path):
+    driver = DirectoryDriver(str(tmp_path), shard_levels=0)
+    driver.update([(('s', str(i)), {'i': i, 'even': i % 2 == 0})
+                   for i in range(6)])
+    assert sorted(driver.query_names('s', {'even': True})) == ['0', '2', '4']
+    assert driver.query_names('missing') == []
+    assert not [f for f in os.listdir(driver._section_dir('s'))
+                if not f.endswith('.json')]
+
+def test_from_uri(tmp_path):
+    driver = new_driver('dir://{}?shard_levels=0&cache_size=2&fsync=1'.format(
+                            tmp_path), shared=False)
+    assert (driver.shard_levels, driver.cache_size, driver.fsync) == (0, 2, True)
+    driver.update([(('s', str(i)), {'i': i}) for i in range(5)])
+    assert len(driver.getitems([('s', str(i)) for i in range(5)])) == 5
+    assert len(driver._cache) == 2
+    driver.close()
@@ -0,0 +1,125 @@
+"""Tests of the Driver contract, run against every driver."""
+
+import os
+
+import pytest
+
+from nostradamus import Database, Referenceable, Value
+from nostradamus.drivers.base import Driver, new_driver, project
+from nostradamus.drivers.built_in import (DictionaryDriver,
+    ConcurrentDictionaryDriver, ChainDriver)
+from nostradamus.drivers.directory import DirectoryDriver
+from nostradamus.drivers.log import LogDriver
+from nostradamus.drivers.mongo import MongoDriver
+from nostradamus.drivers.sqlite import SQLiteDriver
+from nostradamus.drivers.yaml import YAMLDriver
+from nostradamus.benchmarks.mongo_standin import MongoStandIn
+
+DRIVERS = {
+    'dict': lambda tmp_path: DictionaryDriver(),
+    'concurrent': lambda tmp_path: ConcurrentDictionaryDriver(),
+    'chain': lambda tmp_path: ChainDriver([DictionaryDriver(),
+                                           DictionaryDriver()]),
+    'directory': lambda tmp_path: DirectoryDriver(str(tmp_path / 'dir')),
+    'log': lambda tmp_path: LogDriver(str(tmp_path / 'db.log')),
+    'mongo': lambda tmp_path: MongoDriver(MongoStandIn()),
+    'sqlite': lambda tmp_path: SQLiteDriver(),
+    'yaml': lambda tmp_path: YAMLDriver(filename=str(tmp_path / 'db.yaml')),
+}
+
+@pytest.fixture(params=sorted(DRIVERS))
+def driver(request, tmp_path):
+    driver = DRIVERS[request.param](tmp_path)
+    driver.update([(('s', str(i)), {'i': i, 'sub': {'mod': i % 3, 'x': 'x'},
+                                    'tags': ['a', 'b']})
+                   for i in range(10)])
+    return driver
+
+def test_project():
+    doc = {'a': 1, 'b': {'c': 2, 'd': 3}}
+    assert project(doc, ['a', 'b.c', 'b.e', 'z']) == {'a': 1, 'b': {'c': 2}}
+    assert project(doc, []) == {}
+
+def test_query_elements_projection(driver):
+    elements = list(driver.query_elements('s', ['i', 'sub.mod'],
+                                          {'sub.mod': 1}))
+    assert sorted(elements, key=lambda e: e['i']) == \
+        [{'i': i, 'sub': {'mod': 1}} for i in (1, 4, 7)]
+
+def test_query_elements_mapping_projection(driver):
+    elements = list(driver.query_elements('s', {'tags': 1, 'i': 0},
+                                          {'i': 2}))
+    assert elements == [{'tags': ['a', 'b']}]
+
+def test_query_elements_limit_skip(driver):
+    everything = sorted(e['i'] for e in driver.query_elements('s', ['i']))
+    assert everything == list(range(10))
+    page = [e['i'] for e in driver.query_elements('s', ['i'], limit=3,
+                                                   skip=2, batch_size=2)]
+    assert len(page) == 3 and set(page) <= set(everything)
+    assert list(driver.query_elements('s', ['i'], skip=10)) == []
+    assert list(driver.query_elements('missing', ['i'])) == []
+
+def test_generic_query_elements_streams():
+    class Counting(DictionaryDriver):
+        query_elements = Driver.query_elements
+        def getitems(self, keys):
+            batches.append(len(keys))
+            return super().getitems(keys)
+    batches = []
+    driver = Counting()
+    driver.update([(('s', str(i)), {'i': i}) for i in range(10)])
+    elements = driver.query_elements('s', ['i'], batch_size=4)
+    assert batches == []
+    assert sorted(e['i'] for e in elements) == list(range(10))
+    assert batches == [4, 4, 2]
+
+class Summary(Referenceable):
+    SECTION = 'summary'
+    title = Value()
+    size = Value()
+
+def test_database_query_elements():
+    db = Database(DictionaryDriver())
+    db.write_many([Summary(name='a', title='A', size=1),
+                   Summary(name='b', title='B', size=2)])
+    elements = db.query_elements(Summary, ['title'], {'size': 2})
+    assert list(elements) == [{'title': 'B'}]
+
+def test_new_driver_is_shared(tmp_path):
+    uri = 'log://' + str(tmp_path / 'db.log')
+    driver = new_driver(uri)
+    assert new_driver(uri) is driver
+    driver.close()
+    driver.setitem(('s', 'a'), {'v': 1})
+    driver.close()
+    other = new_driver(uri)
+    assert other is not driver
+    assert other.getitem(('s', 'a')) == {'v': 1}
+    other.close()
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_forked_child_does_not_use_inherited_drivers(tmp_path):
+    uri = 'log://' + str(tmp_path / 'db.log')
+    driver = new_driver(uri)
+    driver.setitem(('s', 'a'), {'v': 1})
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            try:
+                driver.getitem(('s', 'a'))
+            except RuntimeError:
+                driver.close()
+                child = new_driver(uri)
+                if child is not driver and child.getitem(('s', 'a')) == {'v': 1}:
+                    child.close()
+                    status = 0
+        finally:
+            os._exit(status)
+    assert os.waitpid(pid, 0)[1] == 0
+    # The parent's driver is still open and usable.
+    assert driver.getitem(('s', 'a')) == {'v': 1}
+    assert new_driver(uri) is driver
+    driver.close()
+    driver.close()
@@ -0,0 +1,84 @@
+"""Tests for the declarative fields."""
+
+import weakref
+
+import pytest
+
+from nostradamus import Database, Referenceable, Serializable, Value, \
+                        Embedded, Reference
+from nostradamus.drivers.built_in import DictionaryDriver
+
+class Point(Serializable):
+    x = Value()
+    y = Value(default=0)
+
+class Place(Referenceable):
+    SECTION = 'places'
+    label = Value(default='unnamed')
+    point = Embedded(Point, default=None)
+
+class Trip(Referenceable):
+    SECTION = 'trips'
+    start = Reference(Place)
+    stops = Embedded(Place.List, default=None)
+
+def test_generated_methods():
+    point = Point(1)
+    assert (point.x, point.y) == (1, 0)
+    assert point.as_dict() == {'x': 1, 'y': 0}
+    assert Point.from_dict({'x': 2, 'y': 3}).as_dict() == {'x': 2, 'y': 3}
+    with pytest.raises(TypeError):
+        Point()
+
+def test_default_only_for_missing_keys():
+    assert Place.from_dict({}, name='p').label == 'unnamed'
+    place = Place.from_dict({'label': None, 'point': None}, name='p')
+    assert place.label is None and place.point is None
+    assert Point.from_dict({'x': 1}).y == 0
+    assert Point.from_dict({'x': 1, 'y': None}).y is None
+
+def test_none_round_trip():
+    db = Database(DictionaryDriver())
+    start = Place(name='start', label=None, point=Point(1, None))
+    db.write(Trip(name='t', start=start))
+    trip = db.read((Trip, 't'))
+    assert trip.stops is None
+    assert trip.start.label is None
+    assert trip.start.point.y is None
+    assert trip.start.as_dict() == {'label': None, 'point': {'x': 1, 'y': None}}
+
+def test_references_round_trip():
+    db = Database(DictionaryDriver())
+    a, b = Place(name='a', label='A'), Place(name='b', point=Point(2, 3))
+    db.write(Trip(name='t', start=a, stops=Place.List([a, b])))
+    trip = db.read((Trip, 't'))
+    assert trip.start is trip.stops[0]
+    assert [p.label for p in trip.stops] == ['A', 'unnamed']
+    assert trip.stops[1].point.as_dict() == {'x': 2, 'y': 3}
+
+def test_fields_are_slots():
+    assert set(Place.__slots__) == {'label', 'point'}
+    place = Place(name='p')
+    assert 'label' not in place.__dict__
+    assert weakref.ref(place)() is place
+
+class SlottedMixin:
+    __slots__ = ('extra',)
+
+def test_mixing_with_slotted_classes():
+    class Mixed(SlottedMixin, Referenceable):
+        SECTION = 'mixed'
+        @classmethod
+        def from_dict(cls, d, read_func=None, **kwargs):
+            return cls(**kwargs)
+        def as_dict(self, write_func=None):
+            return {}
+
+    class MixedFields(SlottedMixin, Referenceable, slots=False):
+        SECTION = 'mixed'
+        v = Value()
+
+    obj = MixedFields(name='m', v=1)
+    obj.extra = 2
+    assert obj.as_dict() == {'v': 1}
+    Mixed(name='m').extra = 1
@@ -0,0 +1,64 @@
+"""Tests for the identity maps and their use by Database."""
+
+import gc
+
+from nostradamus import Database, Referenceable, Value, \
+                        IdentityMap, LRUIdentityMap, WeakIdentityMap
+from nostradamus.drivers.built_in import DictionaryDriver
+
+class Item(Referenceable):
+    SECTION = 'items'
+    v = Value(default=0)
+
+class Key:
+    """Weak references need an object that is not a builtin."""
+
+def test_identity_map_invalidate():
+    m = IdentityMap()
+    a, b = Item(name='a'), Item(name='b')
+    m[(Item, 'a')] = a
+    m[(Item, 'b')] = b
+    assert m.get((Item, 'a')) is a
+    assert m.get((Item, 'c')) is None
+    assert m.stats() == {'hits': 1, 'misses': 1, 'size': 2}
+
+    m.invalidate(Item, 'a')
+    assert (Item, 'a') not in m and (Item, 'b') in m
+    m.invalidate(Item)
+    assert len(m) == 0
+
+def test_lru_identity_map_evicts_least_recently_used():
+    m = LRUIdentityMap(maxsize=2)
+    objs = [Key() for i in range(3)]
+    m['a'] = objs[0]
+    m['b'] = objs[1]
+    m.get('a')
+    m['c'] = objs[2]
+    assert 'a' in m and 'c' in m and 'b' not in m
+
+def test_weak_identity_map_drops_unused_objects():
+    m = WeakIdentityMap()
+    obj = Key()
+    m['a'] = obj
+    assert m.get('a') is obj
+    del obj
+    gc.collect()
+    assert 'a' not in m
+
+def test_reads_without_shared_map_are_independent():
+    driver = DictionaryDriver()
+    Database(driver).write(Item(name='a', v=1))
+    db = Database(driver)
+    assert db.read((Item, 'a')) is not db.read((Item, 'a'))
+
+def test_shared_map():
+    driver = DictionaryDriver()
+    Database(driver).write(Item(name='a', v=1))
+    db = Database(driver, identity_map=LRUIdentityMap(10))
+    first = db.read((Item, 'a'))
+    assert db.read((Item, 'a')) is first
+
+    Database(driver).write(Item(name='a', v=2))
+    assert db.read((Item, 'a')).v == 1
+    db.invalidate(Item, 'a')
+    assert db.read((Item, 'a')).v == 2
@@ -0,0 +1,70 @@
+"""Tests for InstrumentedDriver."""
+
+import types
+
+import pytest
+
+from nostradamus import Database, Referenceable, Value
+from nostradamus.drivers.built_in import DictionaryDriver
+from nostradamus.drivers.instrumented import InstrumentedDriver
+from nostradamus.drivers.sqlite import SQLiteDriver
+
+def filled(driver):
+    driver.update([(('s', str(i)), {'i': i, 'even': i % 2 == 0})
+                   for i in range(6)])
+    return InstrumentedDriver(driver)
+
+def test_query_return_types():
+    for inner in (DictionaryDriver(), SQLiteDriver()):
+        driver = filled(inner)
+        names = driver.query_names('s', {'even': True})
+        assert type(names) is type(inner.query_names('s', {'even': True}))
+        assert sorted(names) == ['0', '2', '4']
+        elements = driver.query_elements('s', ['i'], {'even': False})
+        expected = inner.query_elements('s', ['i'], {'even': False})
+        assert isinstance(elements, list) == isinstance(expected, list)
+        assert sorted(e['i'] for e in elements) == [1, 3, 5]
+
+def test_list_results_are_recorded_at_once():
+    driver = filled(DictionaryDriver())
+    names = driver.query_names('s')
+    assert isinstance(names, list)
+    snapshot = driver.metrics.snapshot()
+    assert snapshot['calls']['query_names'] == 1
+    assert snapshot['sections']['s']['queried'] == 6
+
+def test_iterators_are_recorded_when_exhausted():
+    driver = filled(SQLiteDriver())
+    elements = driver.query_elements('s', ['i'], limit=4)
+    assert isinstance(elements, types.GeneratorType)
+    assert 'query_elements' not in driver.metrics.snapshot()['calls']
+    assert len(list(elements)) == 4
+    snapshot = driver.metrics.snapshot()
+    assert snapshot['calls']['query_elements'] == 1
+    assert snapshot['sections']['s']['queried'] == 4
+    assert 'query_elements' not in snapshot['errors']
+
+def test_reads_and_writes():
+    driver = InstrumentedDriver(DictionaryDriver())
+    driver.update([(('s', 'a'), {'v': 1}), (('t', 'b'), {'v': 2})])
+    assert driver.getitems([('s', 'a'), ('s', 'x')]) == {('s', 'a'): {'v': 1}}
+    with pytest.raises(KeyError):
+        driver.getitem(('t', 'x'))
+    snapshot = driver.metrics.snapshot()
+    assert snapshot['calls'] == {'update': 1, 'getitems': 1, 'getitem': 1}
+    assert snapshot['errors'] == {}
+    assert snapshot['sections']['s']['written'] == 1
+    assert snapshot['sections']['s']['read'] == 1
+    assert snapshot['sections']['s']['misses'] == 1
+    assert snapshot['sections']['t']['misses'] == 1
+
+class Counter(Referenceable):
+    SECTION = 'counters'
+    v = Value()
+
+def test_database_over_instrumented_driver():
+    driver = InstrumentedDriver(DictionaryDriver())
+    db = Database(driver)
+    db.write_many(Counter(name=str(i), v=i) for i in range(3))
+    assert sorted(db.query_names(Counter, {'v': 1})) == ['1']
+    assert db.read((Counter, '2')).v == 2
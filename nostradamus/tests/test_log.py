@@ -0,0 +1,102 @@
+"""Tests for LogDriver: recovery of torn writes and compaction."""
+
+import threading
+
+from nostradamus.drivers.log import LogDriver
+
+def line_count(filename):
+    with open(filename, 'rb') as f:
+        return len(f.readlines())
+
+def reopen(driver):
+    driver.close()
+    return LogDriver(driver.filename, compact_ratio=None)
+
+def test_torn_tail_is_cut_off(tmp_path):
+    filename = str(tmp_path / 'db.log')
+    driver = LogDriver(filename, compact_ratio=None)
+    driver.update([(('a', 'x'), {'v': 1}), (('a', 'y'), {'v': 2})])
+    driver.close()
+    with open(filename, 'rb') as f:
+        good = f.read()
+
+    # A batch without its commit record, followed by half a line.
+    with open(filename, 'ab') as f:
+        f.write(LogDriver._encode(['a', 'z', {'v': 3}]))
+        f.write(LogDriver._encode(['a', 'x', {'v': 4}])[:12])
+
+    driver = LogDriver(filename, compact_ratio=None)
+    assert sorted(driver.query_names('a')) == ['x', 'y']
+    assert driver.getitem(('a', 'x')) == {'v': 1}
+    with open(filename, 'rb') as f:
+        assert f.read() == good
+
+    # New batches go after the last good one.
+    driver.setitem(('a', 'z'), {'v': 5})
+    driver = reopen(driver)
+    assert driver.getitems([('a', 'x'), ('a', 'z')]) == {('a', 'x'): {'v': 1},
+                                                         ('a', 'z'): {'v': 5}}
+    driver.close()
+
+def test_corrupt_record_is_cut_off(tmp_path):
+    filename = str(tmp_path / 'db.log')
+    driver = LogDriver(filename, compact_ratio=None)
+    driver.setitem(('a', 'x'), 1)
+    driver.setitem(('a', 'x'), 2)
+    driver.close()
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    lines = data.splitlines(keepends=True)
+    # Flip a byte in the payload of the second version.
+    lines[2] = lines[2][:-2] + b'9\n'
+    with open(filename, 'wb') as f:
+        f.write(b''.join(lines))
+
+    driver = LogDriver(filename, compact_ratio=None)
+    assert driver.getitem(('a', 'x')) == 1
+    driver.close()
+
+def test_tombstones(tmp_path):
+    filename = str(tmp_path / 'db.log')
+    driver = LogDriver(filename, compact_ratio=None)
+    driver.update([(('a', 'x'), 1), (('a', 'y'), 2)])
+    driver.delitems([('a', 'x'), ('a', 'missing')])
+    driver = reopen(driver)
+    assert driver.query_names('a') == ['y']
+
+    driver.compact()
+    # The live item and one commit record.
+    assert line_count(filename) == 2
+    driver = reopen(driver)
+    assert driver.query_names('a') == ['y']
+    assert driver.getitem(('a', 'y')) == 2
+    driver.close()
+
+def test_compaction_during_writes(tmp_path):
+    filename = str(tmp_path / 'db.log')
+    driver = LogDriver(filename, compact_ratio=None)
+    for i in range(200):
+        driver.setitem(('a', str(i % 20)), i)
+
+    expected = {}
+    def writer():
+        for i in range(200, 1000):
+            key = ('a', str(i % 50))
+            driver.setitem(key, i)
+            expected[key] = i
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    for _ in range(5):
+        driver.compact()
+    thread.join()
+    driver.compact()
+
+    for i in range(20):
+        expected.setdefault(('a', str(i)), 180 + i)
+    assert driver.getitems(expected) == expected
+    driver = reopen(driver)
+    assert driver.getitems(expected) == expected
+    assert line_count(filename) == len(expected) + 1
+    driver.close()
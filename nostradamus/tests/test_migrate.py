@@ -0,0 +1,103 @@
+"""Tests for nostradamus.migrate."""
+
+import pytest
+
+from nostradamus import migrate
+from nostradamus.drivers.built_in import DictionaryDriver
+from nostradamus.drivers.sqlite import SQLiteDriver
+
+def filled(driver=None):
+    driver = driver if driver is not None else DictionaryDriver()
+    driver.update([((section, '{:02}'.format(i)), {'i': i, 'sub': {'s': section}})
+                   for section in ('a', 'b') for i in range(10)])
+    return driver
+
+def contents(driver):
+    return {(section, name): driver.getitem((section, name))
+            for section in driver.sections()
+            for name in driver.query_names(section)}
+
+class Interrupt(Exception):
+    pass
+
+class FailingDriver(DictionaryDriver):
+    """Fails the update number fail_at (counting from 1)."""
+    def __init__(self, fail_at):
+        super().__init__()
+        self.fail_at = fail_at
+        self.updates = 0
+
+    def update(self, items):
+        self.updates += 1
+        if self.updates == self.fail_at:
+            raise Interrupt()
+        super().update(items)
+
+def test_copy():
+    source = filled()
+    target = SQLiteDriver()
+    counts = migrate.copy(source, target, batch_size=3, parallel=2)
+    assert counts == {'a': 10, 'b': 10}
+    assert contents(target) == contents(source)
+
+def test_copy_sections():
+    target = DictionaryDriver()
+    assert migrate.copy(filled(), target, sections=['b']) == {'b': 10}
+    assert target.sections() == ['b']
+
+def test_copy_resumes_from_checkpoint(tmp_path):
+    source = filled()
+    checkpoint = str(tmp_path / 'ck.json')
+    target = FailingDriver(fail_at=3)
+    with pytest.raises(Interrupt):
+        migrate.copy(source, target, sections=['a'], batch_size=3,
+                     checkpoint=checkpoint)
+    assert len(contents(target)) == 6
+
+    target.fail_at = None
+    assert migrate.copy(source, target, sections=['a'], batch_size=3,
+                        checkpoint=checkpoint) == {'a': 4}
+    assert contents(target) == {k: v for k, v in contents(source).items()
+                                if k[0] == 'a'}
+    assert migrate.copy(source, target, sections=['a'],
+                        checkpoint=checkpoint) == {'a': 0}
+
+@pytest.mark.parametrize('filename', ['dump.jsonl', 'dump.jsonl.gz'])
+def test_dump_and_load(tmp_path, filename):
+    source = filled()
+    filename = str(tmp_path / filename)
+    assert migrate.dump(source, filename, batch_size=4) == 20
+    target = DictionaryDriver()
+    assert migrate.load(filename, target, batch_size=7) == 20
+    assert contents(target) == contents(source)
+
+    target = DictionaryDriver()
+    assert migrate.load(filename, target, sections=['a']) == 10
+    assert target.sections() == ['a']
+
+def test_load_resumes_from_checkpoint(tmp_path):
+    filename = str(tmp_path / 'dump.jsonl')
+    checkpoint = str(tmp_path / 'ck.json')
+    migrate.dump(filled(), filename)
+    target = FailingDriver(fail_at=2)
+    with pytest.raises(Interrupt):
+        migrate.load(filename, target, batch_size=8, checkpoint=checkpoint)
+    assert len(contents(target)) == 8
+    target.fail_at = None
+    assert migrate.load(filename, target, batch_size=8,
+                        checkpoint=checkpoint) == 12
+    assert contents(target) == contents(filled())
+
+def test_command_line(tmp_path):
+    source = 'sqlite://' + str(tmp_path / 'source.db')
+    target = 'sqlite://' + str(tmp_path / 'target.db')
+    dumped = str(tmp_path / 'dump.jsonl')
+    with migrate._driver(source) as driver:
+        filled(driver)
+    assert migrate.main(['copy', source, target, '--quiet']) == 0
+    assert migrate.main(['dump', target, dumped, '--sections', 'a',
+                         '--quiet']) == 0
+    with open(dumped) as f:
+        assert len(f.readlines()) == 10
+    with migrate._driver(target) as driver:
+        assert len(contents(driver)) == 20
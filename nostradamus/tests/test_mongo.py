@@ -0,0 +1,153 @@
+"""Tests for MongoDriver, run against the in-process stand-in used by the
+benchmarks."""
+
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+
+from nostradamus import Database, Referenceable, Value
+from nostradamus.drivers.base import BulkUpdateError
+from nostradamus.drivers.mongo import MongoDriver
+from nostradamus.benchmarks.mongo_standin import MongoStandIn, Collection
+
+class FailingCollection(Collection):
+    """Collection whose bulk writes fail for the names in failing, like a
+    server would: an ordered bulk write stops at the first error, an
+    unordered one writes everything else."""
+    def __init__(self, failing=()):
+        super().__init__()
+        self.failing = set(failing)
+        self.batches = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.batches.append(len(requests))
+        errors = []
+        for i, request in enumerate(requests):
+            if request._filter.get('__ref_name__') in self.failing:
+                errors.append({'index': i, 'code': 11000, 'errmsg': 'failed'})
+                if ordered:
+                    break
+            else:
+                super().bulk_write([request])
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+def failing_driver(failing=(), **kwargs):
+    db = MongoStandIn()
+    db['s'] = FailingCollection(failing)
+    return MongoDriver(db, **kwargs)
+
+def stored_names(driver):
+    return sorted(driver.query_names('s'))
+
+class Tagged(Referenceable):
+    SECTION = 'tagged'
+    tags = Value()
+
+def stored(driver, name):
+    return driver.db['tagged'].find_one({'__ref_name__': name})['tags']
+
+def test_patch_after_in_place_mutation():
+    driver = MongoDriver(MongoStandIn(), keep_versions=True)
+    db = Database(driver)
+    obj = Tagged(name='t', tags=['a'])
+    db.write(obj, patch=True)
+
+    obj.tags.append('b')
+    db.write(obj, patch=True)
+    assert stored(driver, 't') == ['a', 'b']
+
+    obj.tags.append('c')
+    db.write(obj, patch=True)
+    assert stored(driver, 't') == ['a', 'b', 'c']
+
+def test_patch_after_read_and_mutation():
+    driver = MongoDriver(MongoStandIn(), keep_versions=True)
+    Database(driver).write(Tagged(name='t', tags=['a']))
+
+    db = Database(driver)
+    obj = db.read((Tagged, 't'))
+    obj.tags.append('b')
+    db.write(obj, patch=True)
+    assert stored(driver, 't') == ['a', 'b']
+
+def test_getitems_split_by_batch_size():
+    driver = MongoDriver(MongoStandIn(), batch_size=2)
+    driver.update([(('s', str(i)), {'i': i}) for i in range(5)])
+    queries = []
+    find = driver.db['s'].find
+    def counting_find(filter=None, *args, **kwargs):
+        queries.append(filter['__ref_name__']['$in'])
+        return find(filter, *args, **kwargs)
+    driver.db['s'].find = counting_find
+
+    keys = [('s', str(i)) for i in range(5)] + [('s', 'missing')]
+    assert driver.getitems(keys) == {('s', str(i)): {'i': i} for i in range(5)}
+    assert [len(names) for names in queries] == [2, 2, 2]
+
+def test_update_in_batches():
+    driver = failing_driver(batch_size=2)
+    driver.update([(('s', str(i)), {'i': i}) for i in range(5)])
+    assert driver.db['s'].batches == [2, 2, 1]
+    assert stored_names(driver) == [str(i) for i in range(5)]
+
+def test_update_unordered_writes_all_it_can():
+    driver = failing_driver(['b'], batch_size=2)
+    with pytest.raises(BulkUpdateError) as e:
+        driver.update([(('s', name), {'v': 1}) for name in 'abcd'])
+    assert [f.key for f in e.value.failures] == [('s', 'b')]
+    assert stored_names(driver) == ['a', 'c', 'd']
+
+def test_update_ordered_stops_at_first_failure():
+    driver = failing_driver(['b'], batch_size=2, ordered=True)
+    with pytest.raises(BulkUpdateError) as e:
+        driver.update([(('s', name), {'v': 1}) for name in 'abcd'])
+    assert [f.key for f in e.value.failures] == [('s', 'b')]
+    assert stored_names(driver) == ['a']
+    assert driver.db['s'].batches == [2]
+
+def test_versions_of_failed_items_are_forgotten():
+    driver = failing_driver(batch_size=10, ordered=True, keep_versions=True)
+    driver.update([(('s', name), {'v': 0}) for name in 'abcd'])
+    driver.db['s'].failing = {'b'}
+    with pytest.raises(BulkUpdateError):
+        driver.patch([(('s', name), {'v': 1}) for name in 'abcd'])
+    # a was written; b failed and c, d were skipped, so they still hold v=0
+    # and must not be patched from v=1.
+    assert driver._versions == {('s', 'a'): {'v': 1}}
+    driver.db['s'].failing = set()
+    driver.patch([(('s', name), {'v': 1}) for name in 'abcd'])
+    assert [d['v'] for d in driver.db['s'].find()] == [1, 1, 1, 1]
+
+def test_versions_forgotten_on_connection_error():
+    class Disconnecting(Collection):
+        def bulk_write(self, requests, ordered=True):
+            super().bulk_write(requests[:1], ordered)
+            raise AutoReconnect('connection lost')
+    db = MongoStandIn()
+    driver = MongoDriver(db, keep_versions=True)
+    driver.update([(('s', name), {'v': 0}) for name in 'ab'])
+    db['s'] = Disconnecting()
+    for name in 'ab':
+        db['s'].replace_one({'__ref_name__': name},
+                            {'__ref_name__': name, 'v': 0}, upsert=True)
+    with pytest.raises(AutoReconnect):
+        driver.patch([(('s', name), {'v': 1}) for name in 'ab'])
+    assert driver._versions == {}
+
+def test_reads_do_not_create_indexes():
+    class ReadOnly(Collection):
+        def create_index(self, keys, **kwargs):
+            raise OperationFailure('not authorized')
+    db = MongoStandIn()
+    db['s'] = ReadOnly()
+    db['s'].replace_one({'__ref_name__': 'a'}, {'__ref_name__': 'a', 'v': 1},
+                        upsert=True)
+
+    driver = MongoDriver(db)
+    assert driver.getitem(('s', 'a')) == {'v': 1}
+    assert driver.getitems([('s', 'a'), ('s', 'b')]) == {('s', 'a'): {'v': 1}}
+    assert list(driver.query_names('s')) == ['a']
+    assert list(driver.query_elements('s', ['v'])) == [{'v': 1}]
+    assert 's' not in driver._indexed
+    with pytest.raises(OperationFailure):
+        driver.setitem(('s', 'b'), {'v': 2})
@@ -0,0 +1,142 @@
+"""Tests for Session: batching writes into few driver calls."""
+
+import gc
+import weakref
+
+import pytest
+
+from nostradamus import Database, Referenceable, ConsistencyError, \
+                        WeakIdentityMap
+from nostradamus.drivers.built_in import DictionaryDriver
+
+class CountingDriver(DictionaryDriver):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.updates = []
+
+    def update(self, items):
+        items = list(items)
+        self.updates.append(len(items))
+        super().update(items)
+
+class Leaf(Referenceable):
+    SECTION = 'leaves'
+    serialized = 0
+
+    def __init__(self, v=0, **kwargs):
+        super().__init__(**kwargs)
+        self.v = v
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        return cls(v=d['v'], **kwargs)
+
+    def as_dict(self, write_func=None):
+        Leaf.serialized += 1
+        return {'v': self.v}
+
+class Hub(Referenceable):
+    SECTION = 'hubs'
+
+    def __init__(self, leaves=(), **kwargs):
+        super().__init__(**kwargs)
+        self.leaves = list(leaves)
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        return cls([Leaf.from_ref(ref, read_func) for ref in d['leaves']],
+                   **kwargs)
+
+    def as_dict(self, write_func=None):
+        return {'leaves': [leaf.as_ref(write_func) for leaf in self.leaves]}
+
+class Event(Referenceable):
+    SECTION = 'events'
+
+    def __init__(self, hub, **kwargs):
+        super().__init__(**kwargs)
+        self.hub = hub
+
+    @classmethod
+    def from_dict(cls, d, read_func=None, **kwargs):
+        return cls(Hub.from_ref(d['hub'], read_func), **kwargs)
+
+    def as_dict(self, write_func=None):
+        return {'hub': self.hub.as_ref(write_func)}
+
+def test_flush_by_document_count():
+    driver = CountingDriver()
+    db = Database(driver)
+    with db.session(max_documents=10) as s:
+        for i in range(25):
+            s.write(Leaf(v=i, name='l{}'.format(i)))
+        assert len(s) == 5
+        assert s.read((Leaf, 'l24')).v == 24
+    assert driver.updates == [10, 10, 5]
+    assert s.flushes == 3
+    assert len(driver.query_names('leaves')) == 25
+
+def test_discard_on_error():
+    driver = CountingDriver()
+    db = Database(driver)
+    with pytest.raises(RuntimeError):
+        with db.session() as s:
+            s.write(Leaf(name='l'))
+            raise RuntimeError
+    assert driver.updates == []
+
+def test_shared_subgraph_serialized_once():
+    driver = CountingDriver()
+    db = Database(driver)
+    hub = Hub([Leaf(v=i, name='l{}'.format(i)) for i in range(100)], name='h')
+    Leaf.serialized = 0
+    with db.session(max_documents=None) as s:
+        for i in range(20):
+            s.write(Event(hub, name='e{}'.format(i)))
+    assert Leaf.serialized == 100
+    assert driver.updates == [121]
+
+def test_rewriting_pending_object_serializes_it_again():
+    db = Database(CountingDriver())
+    leaf = Leaf(v=1, name='l')
+    with db.session() as s:
+        s.write(leaf)
+        leaf.v = 2
+        s.write(leaf)
+    assert db.read((Leaf, 'l')).v == 2
+
+def test_consistency_across_writes():
+    driver = CountingDriver()
+    db = Database(driver)
+    with db.session() as s:
+        s.write(Leaf(v=1, name='l'))
+        with pytest.raises(ConsistencyError):
+            s.write(Leaf(v=2, name='l'))
+        assert len(s) == 1
+    assert db.read((Leaf, 'l')).v == 1
+
+def test_pending_bytes_counts_each_document_once():
+    db = Database(CountingDriver())
+    leaf = Leaf(v=1, name='l')
+    with db.session(max_bytes=10**6) as s:
+        s.write(leaf)
+        size = s._pending_bytes
+        assert size > 0
+        for _ in range(10):
+            s.write(leaf)
+        assert s._pending_bytes == size
+        s.flush()
+        assert s._pending_bytes == 0
+
+def test_flushed_objects_can_be_freed():
+    db = Database(CountingDriver())
+    refs = []
+    with db.session(max_documents=100, identity_map=WeakIdentityMap()) as s:
+        for i in range(1000):
+            leaf = Leaf(v=i, name=str(i))
+            refs.append(weakref.ref(leaf))
+            s.write(leaf)
+        del leaf
+        gc.collect()
+        assert sum(ref() is not None for ref in refs) == len(s)
+    assert db.read((Leaf, '999')).v == 999
@@ -0,0 +1,46 @@
+"""Tests for SQLiteDriver."""
+
+from nostradamus.drivers.sqlite import SQLiteDriver
+
+def make_driver(**kwargs):
+    driver = SQLiteDriver(**kwargs)
+    driver.update([(('s', str(i)), {'i': i, 'even': i % 2 == 0,
+                                    'sub': {'mod': i % 3}, 'tags': ['x']})
+                   for i in range(10)])
+    return driver
+
+def test_getitems_many_names():
+    driver = SQLiteDriver()
+    driver.MAX_VARIABLES = 3
+    driver.update([(('s', str(i)), {'i': i}) for i in range(10)])
+    keys = [('s', str(i)) for i in range(10)] + [('s', 'missing'), ('t', '1')]
+    assert driver.getitems(keys) == {('s', str(i)): {'i': i} for i in range(10)}
+
+def test_query_names():
+    driver = make_driver(indexes={'s': ['sub.mod']})
+    assert sorted(driver.query_names('s', {'sub.mod': 1})) == ['1', '4', '7']
+    assert sorted(driver.query_names('s', {'sub.mod': 0, 'even': True})) == \
+        ['0', '6']
+    assert driver.query_names('other') == []
+
+def test_query_elements_types():
+    driver = make_driver()
+    elements = list(driver.query_elements('s', ['even', 'sub.mod', 'tags'],
+                                          {'i': 3}))
+    assert elements == [{'even': False, 'sub': {'mod': 0}, 'tags': ['x']}]
+    assert elements[0]['even'] is False
+
+def test_query_elements_limit_skip():
+    driver = make_driver()
+    elements = driver.query_elements('s', ['i'], {'sub.mod': 0}, limit=2,
+                                     skip=1)
+    assert sorted(e['i'] for e in elements) in ([3, 6], [3, 9], [6, 9])
+
+def test_file_round_trip(tmp_path):
+    filename = str(tmp_path / 'db.sqlite')
+    driver = SQLiteDriver(filename)
+    driver.setitem(('s', 'a'), {'v': [1, 2]})
+    driver.close()
+    driver = SQLiteDriver(filename)
+    assert driver.getitem(('s', 'a')) == {'v': [1, 2]}
+    driver.close()
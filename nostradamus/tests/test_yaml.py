@@ -0,0 +1,78 @@
+"""Tests for YAMLDriver: change detection and transactions."""
+
+import os
+
+import pytest
+
+from nostradamus.drivers.yaml import YAMLDriver
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / 'db.yaml')
+
+def rewrite(filename, text, keep_mtime=False):
+    """Write the file from outside the driver, in place."""
+    st = os.stat(filename)
+    with open(filename, 'r+') as f:
+        f.truncate(0)
+        f.write(text)
+    if keep_mtime:
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def test_external_change_within_timestamp_tick(filename):
+    driver = YAMLDriver(filename=filename)
+    driver.setitem(('s', 'a'), {'v': 1})
+    with open(filename) as f:
+        text = f.read()
+    # Same size, same mtime: only the contents tell them apart.
+    rewrite(filename, text.replace('1', '2'), keep_mtime=True)
+    assert driver.getitem(('s', 'a')) == {'v': 2}
+
+def test_external_change_after_timestamp_tick(filename):
+    driver = YAMLDriver(filename=filename)
+    driver.setitem(('s', 'a'), {'v': 1})
+    other = YAMLDriver(filename=filename)
+    other.setitem(('s', 'b'), {'v': 2})
+    assert sorted(driver.query_names('s')) == ['a', 'b']
+
+def test_settled_file_is_not_read_again(filename):
+    driver = YAMLDriver(filename=filename)
+    driver.setitem(('s', 'a'), {'v': 1})
+    driver.TIMESTAMP_RESOLUTION_NS = 0
+    # Checks the contents once more, as the write itself is racy.
+    assert driver.getitem(('s', 'a')) == {'v': 1}
+    reads = []
+    read_text = driver._read_text
+    driver._read_text = lambda: reads.append(1) or read_text()
+    for i in range(3):
+        assert driver.getitem(('s', 'a')) == {'v': 1}
+    assert reads == []
+
+def test_replaced_file(filename):
+    driver = YAMLDriver(filename=filename)
+    driver.setitem(('s', 'a'), {'v': 1})
+    with open(filename + '.new', 'w') as f:
+        f.write('s: {b: {v: 2}}\n')
+    os.replace(filename + '.new', filename)
+    assert driver.query_names('s') == ['b']
+
+def test_transaction_writes_once(filename):
+    driver = YAMLDriver(filename=filename)
+    dumps = []
+    dump = driver._dump
+    driver._dump = lambda: dumps.append(driver._transaction_depth) or dump()
+    with driver.transaction():
+        driver.setitem(('s', 'a'), {'v': 1})
+        with driver.transaction():
+            driver.setitem(('s', 'b'), {'v': 2})
+    assert dumps == [1, 2, 0]
+    assert sorted(YAMLDriver(filename=filename).query_names('s')) == ['a', 'b']
+
+def test_transaction_discarded_on_error(filename):
+    driver = YAMLDriver(filename=filename)
+    driver.setitem(('s', 'a'), {'v': 1})
+    with pytest.raises(RuntimeError):
+        with driver.transaction():
+            driver.setitem(('s', 'b'), {'v': 2})
+            raise RuntimeError
+    assert driver.query_names('s') == ['a']
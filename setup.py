@@ -13,6 +13,7 @@ setup(name='nostradamus',
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
         'Intended Audience :: Developers',
         'Topic :: Database :: Front-Ends'
       ],
@@ -21,10 +22,14 @@ setup(name='nostradamus',
       author='Juan I Carrano <jc@eiwa.ag>, Federico M Pomar <fp@eiwa.ag>',
       author_email='fp@eiwa.ag',
       license='Proprietary',
-      packages=['nostradamus', 'nostradamus.drivers'],
+      packages=['nostradamus', 'nostradamus.drivers', 'nostradamus.benchmarks'],
+      python_requires='>=3.7',
       install_requires=[
           'pymongo', 'pyyaml'
       ],
+      entry_points={
+          'console_scripts': ['nostradamus-migrate=nostradamus.migrate:main'],
+      },
       include_package_data=True,
       zip_safe=True
     )